@@ -0,0 +1,224 @@
+from sqlalchemy import inspect, DateTime, Numeric
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal
+from decouple import config
+from app import serialization
+import json
+import time
+
+CACHE_ENABLED = config("CACHE_ENABLED", default=True, cast=bool)
+# Vigencia de cada entrada (segundos) y máximo de entradas en memoria por proceso
+CACHE_TTL = config("CACHE_TTL", default=60, cast=int)
+CACHE_MAX_ENTRIES = config("CACHE_MAX_ENTRIES", default=10000, cast=int)
+# Segundo nivel compartido entre procesos; "local" usa el reemplazo en memoria
+CACHE_BACKEND = config("CACHE_BACKEND", default="")
+
+_MISSING = object()
+
+
+# Cache LRU en memoria con vencimiento por entrada
+class LRUCache:
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: int = CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return _MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        self._entries.pop(key, None)
+
+    def delete_prefix(self, prefix: str):
+        for key in [key for key in self._entries if key.startswith(prefix)]:
+            del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Reemplazo local de un backend compartido (Redis o similar): misma interfaz asíncrona
+# y los valores viajan serializados, así el código no depende de compartir objetos
+class LocalBackend:
+    def __init__(self):
+        self._data = {}
+
+    async def get(self, key: str):
+        entry = self._data.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            self._data.pop(key, None)
+            return None
+        return entry[0]
+
+    async def set(self, key: str, value: bytes, ttl: int):
+        self._data[key] = (value, time.monotonic() + ttl)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._data.pop(key, None)
+
+    async def delete_prefix(self, prefix: str):
+        for key in [key for key in self._data if key.startswith(prefix)]:
+            del self._data[key]
+
+
+def snapshot(obj, relations=()) -> dict:
+    # Copia de las columnas de una fila (y de las relaciones indicadas) sin estado de sesión
+    data = {attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs}
+    for name in relations:
+        related = getattr(obj, name)
+        data[name] = snapshot(related) if related is not None else None
+    return data
+
+
+def _split(path: str):
+    relation, _, name = path.rpartition(".")
+    return relation, name
+
+
+def _without(data: dict, private=()) -> dict:
+    # Copia del snapshot sin las columnas privadas ("columna" o "relación.columna")
+    data = dict(data)
+    for path in private:
+        relation, name = _split(path)
+        if not relation:
+            data.pop(name, None)
+        elif data.get(relation) is not None:
+            data[relation] = {key: value for key, value in data[relation].items() if key != name}
+    return data
+
+
+def _merge(data: dict, secrets: dict):
+    # Completa el snapshot con las columnas privadas leídas de la base, por ruta
+    for path, value in secrets.items():
+        relation, name = _split(path)
+        target = data[relation] if relation else data
+        if target is not None:
+            target[name] = value
+
+
+def dumps(data: dict) -> bytes:
+    # JSON y no pickle: lo que se lee del backend compartido nunca ejecuta código
+    return serialization.dumps(data)
+
+
+def loads(model, raw: bytes) -> dict:
+    return _typed(model, json.loads(raw))
+
+
+def _typed(model, data: dict) -> dict:
+    # Devuelve a fechas y decimales los valores que en JSON viajan como texto o número
+    mapper = inspect(model)
+    for key, value in data.items():
+        if value is None:
+            continue
+        if key in mapper.relationships:
+            data[key] = _typed(mapper.relationships[key].mapper.class_, value)
+        elif key in mapper.columns:
+            column_type = mapper.columns[key].type
+            if isinstance(column_type, DateTime):
+                data[key] = datetime.fromisoformat(value)
+            elif isinstance(column_type, Numeric) and column_type.asdecimal:
+                data[key] = Decimal(str(value))
+    return data
+
+
+def restore(model, data: dict):
+    # Instancia nueva, fuera de toda sesión, a partir de un snapshot
+    mapper = inspect(model)
+    values = {}
+    for key, value in data.items():
+        if key in mapper.relationships:
+            value = restore(mapper.relationships[key].mapper.class_, value) if value is not None else None
+        values[key] = value
+    return model(**values)
+
+
+# Cache de lectura (read-through) para filas que cambian poco: usuarios, certificados y
+# clientes. Busca en memoria, después en el backend compartido si hay uno y por último
+# en la base. Las escrituras de crud invalidan las claves afectadas en ambos niveles;
+# las copias en memoria de otros procesos vencen a los CACHE_TTL segundos.
+#
+# Las columnas indicadas en private (la clave privada de un certificado, la contraseña
+# del usuario, también dentro de una relación como "user.password_hash") quedan solo en
+# memoria: no se envían al backend compartido y, si la entrada viene de ahí, se leen de
+# la base con load_private, que recibe el snapshot y devuelve {ruta: valor}.
+class ReadThroughCache:
+    def __init__(self, local: LRUCache = None, backend=None, ttl: int = CACHE_TTL, enabled: bool = CACHE_ENABLED):
+        self.local = local or LRUCache(ttl=ttl)
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def get(self, key: str, model, loader, relations=(), private=(), load_private=None):
+        if not self.enabled:
+            return await loader()
+        data = self.local.get(key)
+        if data is not _MISSING:
+            self.hits += 1
+            return restore(model, data)
+        if self.backend is not None:
+            raw = await self.backend.get(key)
+            if raw is not None:
+                data = loads(model, raw)
+                secrets = await load_private(data) if private else {}
+                if secrets is not None:
+                    self.backend_hits += 1
+                    _merge(data, secrets)
+                    self.local.set(key, data)
+                    return restore(model, data)
+
+        self.misses += 1
+        obj = await loader()
+        if obj is not None:
+            data = snapshot(obj, relations)
+            self.local.set(key, data)
+            if self.backend is not None:
+                await self.backend.set(key, dumps(_without(data, private)), self.ttl)
+        return obj
+
+    async def invalidate(self, *keys: str):
+        self.invalidations += len(keys)
+        for key in keys:
+            self.local.delete(key)
+        if self.backend is not None:
+            await self.backend.delete(*keys)
+
+    async def invalidate_prefix(self, prefix: str):
+        self.invalidations += 1
+        self.local.delete_prefix(prefix)
+        if self.backend is not None:
+            await self.backend.delete_prefix(prefix)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__ if self.backend is not None else None,
+            "entries": len(self.local),
+            "hits": self.hits,
+            "backend_hits": self.backend_hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+cache = ReadThroughCache(backend=LocalBackend() if CACHE_BACKEND == "local" else None)
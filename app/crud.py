@@ -2,18 +2,135 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.exc import NoResultFound
 from . import models, schemas
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy import insert, update, delete
+from decimal import Decimal, ROUND_HALF_UP
 from app.models import Certificate, Authorization
 from app.schemas import CertificateCreate, AuthorizationCreate
+from app.services.tickets import ticket_cache
+from app.services.keystore import keystore
+from app.services import caea, sales
+from app.pagination import paginate, page
+from app.cache import cache
+from app.metrics import traced
+from datetime import datetime
+import inspect
 import logging
 
+logger = logging.getLogger(__name__)
+
+# Helpers de escritura: una sola sentencia con RETURNING cuando el motor lo soporta
+# (PostgreSQL, SQLite >= 3.35) y el camino SELECT + commit + refresh si no
+def _supports(db: AsyncSession, feature: str) -> bool:
+    return getattr(db.bind.dialect, feature, False)
+
+async def _save(db: AsyncSession, obj, before_commit=None):
+    # before_commit: corrutina que corre después de escribir, en la misma transacción
+    db.add(obj)
+    if before_commit:
+        await db.flush()
+        await before_commit()
+    await db.commit()
+    # El INSERT del flush ya trae con RETURNING la clave y los valores por defecto del servidor
+    if not _supports(db, "insert_returning"):
+        await db.refresh(obj)
+    return obj
+
+async def _update(db: AsyncSession, model, pk_column, pk_value, values: dict, before_commit=None):
+    if not values:
+        result = await db.execute(select(model).where(pk_column == pk_value))
+        return result.scalars().first()
+    if _supports(db, "update_returning"):
+        stmt = (
+            update(model)
+            .where(pk_column == pk_value)
+            .values(**values)
+            .returning(model)
+            .execution_options(populate_existing=True)
+        )
+        db_obj = (await db.scalars(stmt)).first()
+        if db_obj and before_commit:
+            await before_commit()
+        await db.commit()
+        return db_obj
+    result = await db.execute(select(model).where(pk_column == pk_value))
+    db_obj = result.scalars().first()
+    if db_obj:
+        for key, value in values.items():
+            setattr(db_obj, key, value)
+        if before_commit:
+            await db.flush()
+            await before_commit()
+        await db.commit()
+        await db.refresh(db_obj)
+    return db_obj
+
+async def _delete(db: AsyncSession, model, pk_column, pk_value, before=(), before_commit=None):
+    # before: sentencias que se ejecutan antes en la misma transacción (hijos sin ON DELETE)
+    for stmt in before:
+        await db.execute(stmt)
+    if _supports(db, "delete_returning"):
+        db_obj = (await db.scalars(delete(model).where(pk_column == pk_value).returning(model))).first()
+    else:
+        db_obj = (await db.execute(select(model).where(pk_column == pk_value))).scalars().first()
+        if db_obj:
+            await db.execute(delete(model).where(pk_column == pk_value))
+    if db_obj:
+        if before_commit:
+            await before_commit()
+        await db.commit()
+    else:
+        await db.rollback()
+    return db_obj
+
+# Listados: con fields=(columnas...) se seleccionan solo esas columnas y se devuelven
+# filas Row en lugar de objetos ORM (sin identity map ni estado por objeto)
+def _select(model, fields: tuple = None):
+    return select(*fields) if fields else select(model)
+
+async def _rows(db: AsyncSession, stmt, fields: tuple = None) -> list:
+    result = await db.execute(stmt)
+    return result.all() if fields else result.scalars().all()
+
+# Columnas que el cache no envía al backend compartido (ver ReadThroughCache): se leen
+# de la base por clave primaria cuando la entrada viene de ahí
+USER_SECRETS = ("password_hash",)
+CERTIFICATE_SECRETS = ("private_key",)
+LATEST_CERTIFICATE_SECRETS = CERTIFICATE_SECRETS + tuple(f"user.{name}" for name in USER_SECRETS)
+
+def _secrets(db: AsyncSession, model, paths: tuple):
+    # Carga las columnas privadas (propias o de una relación) de la fila del snapshot
+    mapper = model.__mapper__
+    key = mapper.primary_key[0]
+
+    async def load(data: dict):
+        columns = []
+        joins = set()
+        for path in paths:
+            relation, _, name = path.rpartition(".")
+            target = mapper.relationships[relation].mapper.class_ if relation else model
+            if relation:
+                joins.add(relation)
+            columns.append(getattr(target, name).label(path))
+        stmt = select(*columns).where(key == data[key.key])
+        for relation in joins:
+            stmt = stmt.join(getattr(model, relation))
+        row = (await db.execute(stmt)).one_or_none()
+        return dict(row._mapping) if row is not None else None
+    return load
+
 # Users CRUD operations
 async def get_user(db: AsyncSession, user_id: int):
-    result = await db.execute(select(models.User).filter(models.User.user_id == user_id))
-    return result.scalars().first()
+    async def load():
+        result = await db.execute(select(models.User).filter(models.User.user_id == user_id))
+        return result.scalars().first()
+    return await cache.get(f"user:{user_id}", models.User, load,
+                           private=USER_SECRETS, load_private=_secrets(db, models.User, USER_SECRETS))
 
 async def create_user(db: AsyncSession, user: schemas.UserCreate):
-    logging.debug(f"Creando usuario en la base de datos: {user.model_dump()}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Creando usuario en la base de datos: %s", user.model_dump(exclude={"password_hash"}))
     try:
         db_user = models.User(
             username=user.username,
@@ -21,39 +138,46 @@ async def create_user(db: AsyncSession, user: schemas.UserCreate):
             email=user.email,
             cuit=user.cuit,
             full_name=user.full_name,
+            caea_enabled=user.caea_enabled,
             is_active=True
         )
-        db.add(db_user)
-        await db.commit()
-        await db.refresh(db_user)
-        logging.debug(f"Usuario creado: {db_user}")
+        await _save(db, db_user)
+        logger.debug("Usuario creado: %s", db_user)
         return db_user
     except Exception as e:
-        logging.error(f"Error al crear usuario: {e}")
+        logger.error("Error al crear usuario: %s", e)
         raise
 
+async def _invalidate_user(user_id: int):
+    # El último certificado se cachea junto con su usuario
+    await cache.invalidate(f"user:{user_id}", f"latest_certificate:{user_id}")
+
 async def update_user(db: AsyncSession, user_id: int, user_update: schemas.UserUpdate):
-    result = await db.execute(select(models.User).filter(models.User.user_id == user_id))
-    db_user = result.scalars().first()
-    if db_user:
-        for key, value in user_update.model_dump(exclude_unset=True).items():
-            setattr(db_user, key, value)
-        await db.commit()
-        await db.refresh(db_user)
+    db_user = await _update(db, models.User, models.User.user_id, user_id, user_update.model_dump(exclude_unset=True))
+    await _invalidate_user(user_id)
     return db_user
 
 async def delete_user(db: AsyncSession, user_id: int):
-    result = await db.execute(select(models.User).filter(models.User.user_id == user_id))
-    db_user = result.scalars().first()
-    if db_user:
-        await db.delete(db_user)
-        await db.commit()
+    # Igual que el ORM con las relaciones clients/invoices: se desvinculan en lugar de borrarse.
+    # Los totales mensuales, los jobs de CAE y los CAEA del usuario no tienen sentido sin él
+    # (user_id NOT NULL) y se borran
+    db_user = await _delete(db, models.User, models.User.user_id, user_id, before=[
+        update(models.Client).where(models.Client.user_id == user_id).values(user_id=None),
+        update(models.Invoice).where(models.Invoice.user_id == user_id).values(user_id=None),
+        delete(models.SalesMonth).where(models.SalesMonth.user_id == user_id),
+        delete(models.CaeJob).where(models.CaeJob.user_id == user_id),
+        delete(models.Caea).where(models.Caea.user_id == user_id),
+    ])
+    await _invalidate_user(user_id)
+    await cache.invalidate_prefix("client:")
     return db_user
 
 # Clients CRUD operations
 async def get_client(db: AsyncSession, client_id: int):
-    result = await db.execute(select(models.Client).filter(models.Client.client_id == client_id))
-    return result.scalars().first()
+    async def load():
+        result = await db.execute(select(models.Client).filter(models.Client.client_id == client_id))
+        return result.scalars().first()
+    return await cache.get(f"client:{client_id}", models.Client, load)
 
 async def create_client(db: AsyncSession, client: schemas.ClientCreate):
     db_client = models.Client(
@@ -66,27 +190,27 @@ async def create_client(db: AsyncSession, client: schemas.ClientCreate):
         address=client.address,
         is_active=True
     )
-    db.add(db_client)
-    await db.commit()
-    await db.refresh(db_client)
-    return db_client
+    return await _save(db, db_client)
+
+async def list_clients(db: AsyncSession, user_id: int = None, is_active: bool = None,
+                       cursor: str = None, limit: int = 50, fields: tuple = None):
+    columns = (models.Client.client_id,)
+    stmt = _select(models.Client, fields)
+    if user_id is not None:
+        stmt = stmt.where(models.Client.user_id == user_id)
+    if is_active is not None:
+        stmt = stmt.where(models.Client.is_active.is_(is_active))
+    rows = await _rows(db, paginate(stmt, columns, cursor, limit), fields)
+    return page(rows, columns, limit)
 
 async def update_client(db: AsyncSession, client_id: int, client_update: schemas.ClientUpdate):
-    result = await db.execute(select(models.Client).filter(models.Client.client_id == client_id))
-    db_client = result.scalars().first()
-    if db_client:
-        for key, value in client_update.model_dump(exclude_unset=True).items():
-            setattr(db_client, key, value)
-        await db.commit()
-        await db.refresh(db_client)
+    db_client = await _update(db, models.Client, models.Client.client_id, client_id, client_update.model_dump(exclude_unset=True))
+    await cache.invalidate(f"client:{client_id}")
     return db_client
 
 async def delete_client(db: AsyncSession, client_id: int):
-    result = await db.execute(select(models.Client).filter(models.Client.client_id == client_id))
-    db_client = result.scalars().first()
-    if db_client:
-        await db.delete(db_client)
-        await db.commit()
+    db_client = await _delete(db, models.Client, models.Client.client_id, client_id)
+    await cache.invalidate(f"client:{client_id}")
     return db_client
 
 # Invoices CRUD operations
@@ -94,7 +218,64 @@ async def get_invoice(db: AsyncSession, invoice_id: int):
     result = await db.execute(select(models.Invoice).filter(models.Invoice.invoice_id == invoice_id))
     return result.scalars().first()
 
+async def list_invoices(db: AsyncSession, user_id: int = None, client_id: int = None, status: str = None,
+                        invoice_type: str = None, point_of_sale: int = None, date_from: datetime = None,
+                        date_to: datetime = None, cursor: str = None, limit: int = 50, fields: tuple = None):
+    # Más recientes primero; ver los índices ix_invoice_* en models.Invoice
+    columns = (models.Invoice.date, models.Invoice.invoice_id)
+    stmt = _select(models.Invoice, fields)
+    if user_id is not None:
+        stmt = stmt.where(models.Invoice.user_id == user_id)
+    if client_id is not None:
+        stmt = stmt.where(models.Invoice.client_id == client_id)
+    if status is not None:
+        stmt = stmt.where(models.Invoice.status == status)
+    if point_of_sale is not None:
+        stmt = stmt.where(models.Invoice.point_of_sale == point_of_sale)
+    if invoice_type is not None:
+        stmt = stmt.where(models.Invoice.invoice_type == invoice_type)
+    if date_from is not None:
+        stmt = stmt.where(models.Invoice.date >= date_from)
+    if date_to is not None:
+        stmt = stmt.where(models.Invoice.date <= date_to)
+    rows = await _rows(db, paginate(stmt, columns, cursor, limit, descending=True), fields)
+    return page(rows, columns, limit)
+
+def compute_items(items: list):
+    # Importes de cada ítem y totales de la factura, redondeados a centavos
+    cent = Decimal("0.01")
+    rows = []
+    net_total = Decimal("0")
+    tax_total = Decimal("0")
+    for item in items:
+        quantity = Decimal(str(item.quantity))
+        unit_price = Decimal(str(item.unit_price))
+        tax_rate = Decimal(str(item.tax_rate)) if item.tax_rate is not None else None
+        total_price = (quantity * unit_price).quantize(cent, rounding=ROUND_HALF_UP)
+        tax_amount = (total_price * tax_rate / 100).quantize(cent, rounding=ROUND_HALF_UP) if tax_rate else Decimal("0")
+        rows.append({
+            "description": item.description,
+            "quantity": quantity,
+            "unit_price": unit_price,
+            "total_price": total_price,
+            "tax_rate": tax_rate,
+            "tax_amount": tax_amount,
+        })
+        net_total += total_price
+        tax_total += tax_amount
+    return rows, net_total, tax_total, net_total + tax_total
+
 async def create_invoice(db: AsyncSession, invoice: schemas.InvoiceCreate):
+    db_invoice, _ = await _create_invoice(db, invoice, submit=False)
+    return db_invoice
+
+async def create_and_enqueue_invoice(db: AsyncSession, invoice: schemas.InvoiceCreate):
+    # Alta con pedido de CAE: la factura y su job se guardan en la misma transacción, así
+    # un reintento nunca encuentra la factura sin job. Devuelve (factura, job o None si no
+    # quedó en borrador, p. ej. autorizada con CAEA)
+    return await _create_invoice(db, invoice, submit=True)
+
+async def _create_invoice(db: AsyncSession, invoice: schemas.InvoiceCreate, submit: bool):
     db_invoice = models.Invoice(
         user_id=invoice.user_id,
         client_id=invoice.client_id,
@@ -109,34 +290,87 @@ async def create_invoice(db: AsyncSession, invoice: schemas.InvoiceCreate):
         cae_expiration_date=invoice.cae_expiration_date,
         status=invoice.status
     )
-    db.add(db_invoice)
-    await db.commit()
-    await db.refresh(db_invoice)
-    return db_invoice
+    item_rows = []
+    if invoice.items:
+        # Con ítems, los totales guardados siempre surgen de ellos
+        item_rows, db_invoice.net_amount, db_invoice.tax_amount, db_invoice.total_amount = compute_items(invoice.items)
+    # Si algo falla antes del commit (p. ej. el alta del job) se descarta todo: ni factura ni
+    # totales quedan a medias y la transacción no retiene la base hasta que se cierre la sesión
+    try:
+        db.add(db_invoice)
+        # Usuarios en modo CAEA: el comprobante se autoriza localmente con el CAEA de la quincena
+        if invoice.status == "draft" and not invoice.cae:
+            await caea.stamp(db, db_invoice)
+        submit = submit and db_invoice.status == "draft"
+        if submit:
+            db_invoice.status = "pending"
+        await sales.record_created(db, db_invoice, item_rows)
 
-async def update_invoice(db: AsyncSession, invoice_id: int, invoice_update: schemas.InvoiceUpdate):
-    result = await db.execute(select(models.Invoice).filter(models.Invoice.invoice_id == invoice_id))
-    db_invoice = result.scalars().first()
-    if db_invoice:
-        for key, value in invoice_update.model_dump(exclude_unset=True).items():
-            setattr(db_invoice, key, value)
+        db_items = []
+        db_job = None
+        if item_rows or submit:
+            await db.flush()
+        if submit:
+            db_job = models.CaeJob(invoice_id=db_invoice.invoice_id, user_id=db_invoice.user_id, status="queued")
+            db.add(db_job)
+        if item_rows:
+            for row in item_rows:
+                row["invoice_id"] = db_invoice.invoice_id
+            if _supports(db, "insert_returning"):
+                # Un solo INSERT ... VALUES (...), (...) RETURNING para todos los ítems
+                # (sin sort_by_parameter_order, que en algunos motores obliga a insertar fila por fila)
+                stmt = insert(models.InvoiceItem).returning(models.InvoiceItem)
+                db_items = sorted((await db.scalars(stmt, item_rows)).all(), key=lambda item: item.item_id)
+            else:
+                db_items = [models.InvoiceItem(**row) for row in item_rows]
+                db.add_all(db_items)
         await db.commit()
+    except BaseException:
+        await db.rollback()
+        raise
+    if not _supports(db, "insert_returning"):
         await db.refresh(db_invoice)
-    return db_invoice
+        if db_job is not None:
+            await db.refresh(db_job)
+    set_committed_value(db_invoice, "items", db_items)
+    return db_invoice, db_job
+
+async def update_invoice(db: AsyncSession, invoice_id: int, invoice_update: schemas.InvoiceUpdate):
+    values = invoice_update.model_dump(exclude_unset=True)
+    # Los totales mensuales se ajustan en la misma transacción que el UPDATE
+    await sales.record_updated(db, invoice_id, values)
+    return await _update(db, models.Invoice, models.Invoice.invoice_id, invoice_id, values)
 
 async def delete_invoice(db: AsyncSession, invoice_id: int):
-    result = await db.execute(select(models.Invoice).filter(models.Invoice.invoice_id == invoice_id))
-    db_invoice = result.scalars().first()
-    if db_invoice:
-        await db.delete(db_invoice)
-        await db.commit()
-    return db_invoice
+    await sales.record_deleted(db, invoice_id)
+    return await _delete(db, models.Invoice, models.Invoice.invoice_id, invoice_id, before=[
+        delete(models.InvoiceItem).where(models.InvoiceItem.invoice_id == invoice_id),
+        delete(models.CaeJob).where(models.CaeJob.invoice_id == invoice_id),
+    ])
+
+async def enqueue_cae_job(db: AsyncSession, db_invoice: models.Invoice):
+    # La factura pasa a "pending" y el job queda en la misma transacción que el cambio de estado
+    await sales.record_status(db, {db_invoice.invoice_id: "pending"})
+    db_invoice.status = "pending"
+    db_job = models.CaeJob(invoice_id=db_invoice.invoice_id, user_id=db_invoice.user_id, status="queued")
+    return await _save(db, db_job)
+
+async def get_cae_job(db: AsyncSession, job_id: int):
+    result = await db.execute(select(models.CaeJob).filter(models.CaeJob.job_id == job_id))
+    return result.scalars().first()
 
 # Invoice Items CRUD operations
 async def get_invoice_item(db: AsyncSession, item_id: int):
     result = await db.execute(select(models.InvoiceItem).filter(models.InvoiceItem.item_id == item_id))
     return result.scalars().first()
 
+async def list_invoice_items(db: AsyncSession, invoice_id: int, cursor: str = None, limit: int = 50,
+                             fields: tuple = None):
+    columns = (models.InvoiceItem.item_id,)
+    stmt = _select(models.InvoiceItem, fields).where(models.InvoiceItem.invoice_id == invoice_id)
+    rows = await _rows(db, paginate(stmt, columns, cursor, limit), fields)
+    return page(rows, columns, limit)
+
 async def create_invoice_item(db: AsyncSession, invoice_item: schemas.InvoiceItemCreate):
     db_item = models.InvoiceItem(
         invoice_id=invoice_item.invoice_id,
@@ -147,33 +381,61 @@ async def create_invoice_item(db: AsyncSession, invoice_item: schemas.InvoiceIte
         tax_rate=invoice_item.tax_rate,
         tax_amount=invoice_item.tax_amount
     )
-    db.add(db_item)
-    await db.commit()
-    await db.refresh(db_item)
-    return db_item
+    return await _save(db, db_item, before_commit=await _item_sales(db, invoice_item.invoice_id))
+
+async def _item_sales(db: AsyncSession, invoice_id: int):
+    # Los ítems cambian las líneas por alícuota de la factura: se toman antes del cambio
+    # y la diferencia se suma a los totales mensuales antes del commit
+    before = await sales.snapshot(db, [invoice_id])
+    async def record():
+        await sales.record_snapshot(db, [invoice_id], before)
+    return record
+
+async def _item_invoice_id(db: AsyncSession, item_id: int):
+    result = await db.execute(select(models.InvoiceItem.invoice_id).where(models.InvoiceItem.item_id == item_id))
+    return result.scalar_one_or_none()
 
 async def update_invoice_item(db: AsyncSession, item_id: int, item_update: schemas.InvoiceItemUpdate):
-    result = await db.execute(select(models.InvoiceItem).filter(models.InvoiceItem.item_id == item_id))
-    db_item = result.scalars().first()
-    if db_item:
-        for key, value in item_update.model_dump(exclude_unset=True).items():
-            setattr(db_item, key, value)
-        await db.commit()
-        await db.refresh(db_item)
-    return db_item
+    values = item_update.model_dump(exclude_unset=True)
+    record = None
+    if sales.ITEM_FIELDS.intersection(values):
+        invoice_id = await _item_invoice_id(db, item_id)
+        record = await _item_sales(db, invoice_id) if invoice_id is not None else None
+    return await _update(db, models.InvoiceItem, models.InvoiceItem.item_id, item_id, values, before_commit=record)
 
 async def delete_invoice_item(db: AsyncSession, item_id: int):
-    result = await db.execute(select(models.InvoiceItem).filter(models.InvoiceItem.item_id == item_id))
-    db_item = result.scalars().first()
-    if db_item:
-        await db.delete(db_item)
-        await db.commit()
-    return db_item
+    invoice_id = await _item_invoice_id(db, item_id)
+    record = await _item_sales(db, invoice_id) if invoice_id is not None else None
+    return await _delete(db, models.InvoiceItem, models.InvoiceItem.item_id, item_id, before_commit=record)
 
 # Certificates CRUD operations
 async def get_certificate(db: AsyncSession, certificate_id: int):
-    result = await db.execute(select(models.Certificate).filter(models.Certificate.certificate_id == certificate_id))
-    return result.scalars().first()
+    async def load():
+        result = await db.execute(select(models.Certificate).filter(models.Certificate.certificate_id == certificate_id))
+        return result.scalars().first()
+    return await cache.get(f"certificate:{certificate_id}", models.Certificate, load,
+                           private=CERTIFICATE_SECRETS, load_private=_secrets(db, models.Certificate, CERTIFICATE_SECRETS))
+
+async def get_latest_certificate(db: AsyncSession, user_id: int):
+    async def load():
+        result = await db.execute(
+            select(models.Certificate)
+            .where(models.Certificate.user_id == user_id)
+            .options(selectinload(models.Certificate.user))
+            .order_by(models.Certificate.created_at.desc(), models.Certificate.certificate_id.desc())
+            .limit(1)
+        )
+        return result.scalar_one_or_none()
+    return await cache.get(f"latest_certificate:{user_id}", models.Certificate, load, relations=("user",),
+                           private=LATEST_CERTIFICATE_SECRETS,
+                           load_private=_secrets(db, models.Certificate, LATEST_CERTIFICATE_SECRETS))
+
+async def _invalidate_certificate(certificate_id: int, user_id: int = None):
+    await cache.invalidate(f"certificate:{certificate_id}")
+    if user_id is not None:
+        await cache.invalidate(f"latest_certificate:{user_id}")
+    else:
+        await cache.invalidate_prefix("latest_certificate:")
 
 async def create_certificate(db: AsyncSession, certificate: CertificateCreate, user_id: int):
     db_certificate = Certificate(
@@ -182,42 +444,39 @@ async def create_certificate(db: AsyncSession, certificate: CertificateCreate, u
         private_key=certificate.private_key,
         user_id=user_id
     )
-    db.add(db_certificate)
-    await db.commit()
-    await db.refresh(db_certificate)
+    db_certificate = await _save(db, db_certificate)
+    await cache.invalidate(f"latest_certificate:{user_id}")
     return db_certificate
 
 async def update_certificate(db: AsyncSession, certificate_id: int, cert_update: schemas.CertificateUpdate):
-    result = await db.execute(select(models.Certificate).filter(models.Certificate.certificate_id == certificate_id))
-    db_certificate = result.scalars().first()
-    if db_certificate:
-        for key, value in cert_update.model_dump(exclude_unset=True).items():
-            setattr(db_certificate, key, value)
-        await db.commit()
-        await db.refresh(db_certificate)
+    update_data = cert_update.model_dump(exclude_unset=True)
+    # Los tickets de acceso emitidos con el material anterior dejan de servir
+    if "certificate" in update_data or "private_key" in update_data:
+        await ticket_cache.purge(db, certificate_id)
+        keystore.evict(certificate_id)
+    db_certificate = await _update(db, models.Certificate, models.Certificate.certificate_id, certificate_id, update_data)
+    await _invalidate_certificate(certificate_id, db_certificate.user_id if db_certificate else None)
     return db_certificate
 
 async def delete_certificate(db: AsyncSession, certificate_id: int):
-    result = await db.execute(select(models.Certificate).filter(models.Certificate.certificate_id == certificate_id))
-    db_certificate = result.scalars().first()
+    db_certificate = await _delete(db, models.Certificate, models.Certificate.certificate_id, certificate_id, before=[
+        delete(models.Authorization).where(models.Authorization.certificate_id == certificate_id),
+        delete(models.AccessTicket).where(models.AccessTicket.certificate_id == certificate_id),
+    ])
     if db_certificate:
-        await db.delete(db_certificate)
-        await db.commit()
+        ticket_cache.invalidate(certificate_id)
+        keystore.evict(certificate_id)
+    await _invalidate_certificate(certificate_id, db_certificate.user_id if db_certificate else None)
     return db_certificate
 
-async def create_authorization(db: AsyncSession, user_id: int, service: str):
-    db_auth = Authorization(user_id=user_id, service=service, status="pending")
-    db.add(db_auth)
-    await db.commit()
-    await db.refresh(db_auth)
-    return db_auth
+async def create_authorization(db: AsyncSession, certificate_id: int, service: str, status: str = "pending"):
+    db_auth = Authorization(certificate_id=certificate_id, service=service, status=status)
+    return await _save(db, db_auth)
 
 async def update_authorization_status(db: AsyncSession, authorization_id: int, status: str):
-    stmt = select(Authorization).where(Authorization.authorization_id == authorization_id)
-    result = await db.execute(stmt)
-    db_auth = result.scalar_one_or_none()
-    if db_auth:
-        db_auth.status = status
-        await db.commit()
-        await db.refresh(db_auth)
-    return db_auth
\ No newline at end of file
+    return await _update(db, Authorization, Authorization.authorization_id, authorization_id, {"status": status})
+
+# Cada operación pública del módulo se mide como un tramo "crud.<nombre>"
+for _name, _fn in list(globals().items()):
+    if not _name.startswith("_") and inspect.iscoroutinefunction(_fn) and _fn.__module__ == __name__:
+        globals()[_name] = traced(f"crud.{_name}")(_fn)
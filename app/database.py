@@ -1,18 +1,326 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
 from decouple import config
+from contextlib import contextmanager
+from contextvars import ContextVar
 import asyncio
-from sqlalchemy import text
+import logging
+import time
+from sqlalchemy import text, event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from fastapi import Request
+from app.metrics import registry, span, http_request_duration, db_queries_per_request, db_query_duration_per_request
 
 # Leer la URL de conexión desde el archivo .env
 DATABASE_URL = config("DATABASE_URL", default=None)
 
+logger = logging.getLogger(__name__)
+
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL is not set. Please define it in your .env file.")
 
+# Tamaño del pool: conexiones permanentes, extra bajo demanda y espera máxima por una libre
+DB_POOL_SIZE = config("DB_POOL_SIZE", default=10, cast=int)
+DB_MAX_OVERFLOW = config("DB_MAX_OVERFLOW", default=10, cast=int)
+DB_POOL_TIMEOUT = config("DB_POOL_TIMEOUT", default=30.0, cast=float)
+# Las conexiones con más de DB_POOL_RECYCLE segundos se reemplazan al sacarlas del pool
+DB_POOL_RECYCLE = config("DB_POOL_RECYCLE", default=1800, cast=int)
+# Ping al sacar una conexión: "always" (pool_pre_ping), "idle" (solo si estuvo ociosa
+# más de DB_PING_IDLE_SECONDS) o "never"
+DB_PRE_PING = config("DB_PRE_PING", default="idle")
+DB_PING_IDLE_SECONDS = config("DB_PING_IDLE_SECONDS", default=30.0, cast=float)
+
+
+# Pool que mide cuánto espera cada petición para obtener una conexión y si la obtuvo
+# con el pool saturado (sin conexiones libres ni lugar para abrir otra)
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        saturated = self.checkedin() == 0 and self.checkedout() >= self.size() + max(self._max_overflow, 0)
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            _record_checkout(time.perf_counter() - start, saturated)
+
+
+def _engine_options(url: str) -> dict:
+    options = {"pool_pre_ping": DB_PRE_PING == "always"}
+    # SQLite (aiosqlite) no usa pool: abre la conexión al archivo en cada uso, o comparte
+    # una sola si es en memoria. Se deja el pool que elige el dialecto.
+    if not url.startswith("sqlite"):
+        options.update(poolclass=InstrumentedPool, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                       pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE)
+    return options
+
+
 # Crear el motor de conexión
-engine = create_async_engine(DATABASE_URL, pool_pre_ping=True)
-async_session = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
+engine = create_async_engine(DATABASE_URL, **_engine_options(DATABASE_URL))
+# expire_on_commit=False: los objetos siguen legibles después del commit sin otro SELECT
+async_session = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine, class_=AsyncSession)
+
+# Réplica de solo lectura opcional para listados, consultas y exportaciones
+DATABASE_READ_URL = config("DATABASE_READ_URL", default=None)
+# Atraso máximo tolerado de la réplica (segundos): si lo supera, o si el cliente escribió
+# hace menos que eso, la lectura va a la base principal
+DB_REPLICA_MAX_LAG = config("DB_REPLICA_MAX_LAG", default=5.0, cast=float)
+# Cada cuánto se vuelve a medir el atraso de la réplica
+DB_REPLICA_LAG_CHECK_INTERVAL = config("DB_REPLICA_LAG_CHECK_INTERVAL", default=5.0, cast=float)
+
+if DATABASE_READ_URL:
+    read_engine = create_async_engine(DATABASE_READ_URL, **_engine_options(DATABASE_READ_URL))
+    read_session = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=read_engine,
+                                class_=AsyncSession)
+else:
+    read_engine = engine
+    read_session = async_session
+
+# Alternativa barata a pool_pre_ping: solo se hace ping a las conexiones que estuvieron
+# ociosas un rato, que son las que el servidor o un firewall pudo haber cortado
+def _on_checkin(dbapi_connection, connection_record):
+    connection_record.info["checked_in_at"] = time.monotonic()
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    if DB_PRE_PING != "idle":
+        return
+    checked_in_at = connection_record.info.get("checked_in_at")
+    if checked_in_at is None or time.monotonic() - checked_in_at < DB_PING_IDLE_SECONDS:
+        return
+    try:
+        engine.dialect.do_ping(dbapi_connection)
+    except Exception:
+        # El pool descarta la conexión y reintenta con otra
+        raise exc.DisconnectionError()
+
+for _engine in {engine, read_engine}:
+    event.listen(_engine.sync_engine.pool, "checkin", _on_checkin)
+    event.listen(_engine.sync_engine.pool, "checkout", _on_checkout)
+
+# Contador de consultas: cuenta las sentencias enviadas a la base dentro del contexto
+# activo (una petición HTTP o un bloque count_queries()), y las esperas por conexiones
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.checkouts = 0
+        self.checkout_wait = 0.0
+        self.saturated = 0
+        self.writes = 0
+
+_query_counter: ContextVar = ContextVar("query_counter", default=None)
+
+def _record_checkout(wait: float, saturated: bool):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter.checkouts += 1
+        counter.checkout_wait += wait
+        counter.saturated += saturated
+
+# El inicio se guarda en el contexto de ejecución de cada sentencia, no en la conexión:
+# si la sentencia falla no hay after_cursor_execute, y el contexto se descarta con ella
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_query_start", None)
+    elapsed = time.perf_counter() - start if start is not None else 0.0
+    counter = _query_counter.get()
+    if counter is not None:
+        counter.count += 1
+        counter.duration += elapsed
+        if statement.lstrip()[:6].upper() in ("INSERT", "UPDATE", "DELETE"):
+            counter.writes += 1
+
+# Las consultas a la réplica también cuentan para la petición
+for _engine in {engine, read_engine}:
+    event.listen(_engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(_engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    token = _query_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_counter.reset(token)
+
+# Esperas por conexiones del pool agregadas por ruta (plantilla, no la URL concreta)
+class PoolMetrics:
+    def __init__(self):
+        self.routes = {}
+
+    def record(self, route: str, counter: QueryCounter):
+        stats = self.routes.setdefault(route, {"requests": 0, "checkouts": 0, "wait_total": 0.0,
+                                               "wait_max": 0.0, "saturated": 0})
+        stats["requests"] += 1
+        stats["checkouts"] += counter.checkouts
+        stats["wait_total"] += counter.checkout_wait
+        stats["wait_max"] = max(stats["wait_max"], counter.checkout_wait)
+        stats["saturated"] += counter.saturated
+
+    def stats(self) -> dict:
+        return {
+            "pool": engine.sync_engine.pool.status(),
+            "read_pool": read_engine.sync_engine.pool.status() if read_engine is not engine else None,
+            "routes": {
+                route: {
+                    "requests": stats["requests"],
+                    "checkouts": stats["checkouts"],
+                    "wait_avg_ms": round(stats["wait_total"] / stats["checkouts"] * 1000, 3),
+                    "wait_max_ms": round(stats["wait_max"] * 1000, 3),
+                    "saturated": stats["saturated"],
+                }
+                for route, stats in self.routes.items()
+            },
+        }
+
+pool_metrics = PoolMetrics()
+
+def _pool_connections() -> dict:
+    # Conexiones por motor: en uso, libres, extra (overflow) y tamaño configurado
+    values = {}
+    for name, pool in (("primary", engine.sync_engine.pool), ("replica", read_engine.sync_engine.pool)):
+        if name == "replica" and read_engine is engine:
+            continue
+        for state, method in (("checked_out", "checkedout"), ("checked_in", "checkedin"),
+                              ("overflow", "overflow"), ("size", "size")):
+            if hasattr(pool, method):
+                values[(name, state)] = getattr(pool, method)()
+    return values
+
+registry.gauge("db_pool_connections", "Conexiones del pool por motor y estado", ("engine", "state"),
+               collect=_pool_connections)
+registry.gauge("db_pool_saturated_checkouts", "Conexiones obtenidas con el pool saturado, por ruta", ("route",),
+               collect=lambda: {(route, ): stats["saturated"] for route, stats in pool_metrics.routes.items()})
+
+# Middleware ASGI que cuenta las consultas de cada petición y, si DB_QUERY_HEADER
+# está activo, las informa en el header X-DB-Queries. Si la petición escribió en la base,
+# la respuesta lleva el momento de la escritura en el header X-DB-Last-Write y en la
+# cookie db_last_write, para que las lecturas siguientes del mismo cliente vean sus cambios.
+DB_QUERY_HEADER = config("DB_QUERY_HEADER", default=False, cast=bool)
+LAST_WRITE_HEADER = "x-db-last-write"
+LAST_WRITE_COOKIE = "db_last_write"
+
+class QueryCountMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+        with count_queries() as counter:
+            async def send_wrapper(message):
+                nonlocal status
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                    headers = list(message.get("headers", []))
+                    if DB_QUERY_HEADER:
+                        headers.append((b"x-db-queries", str(counter.count).encode()))
+                    if counter.writes and replica.enabled:
+                        headers.extend(_last_write_headers(time.time()))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = getattr(scope.get("route"), "path", None) or "unmatched"
+                http_request_duration.observe(time.perf_counter() - start, method=scope["method"], route=route,
+                                              status=status)
+                db_queries_per_request.observe(counter.count, route=route)
+                db_query_duration_per_request.observe(counter.duration, route=route)
+                if counter.checkouts:
+                    pool_metrics.record(route, counter)
+
+def _last_write_headers(written_at: float) -> list:
+    value = f"{written_at:.3f}"
+    max_age = int(DB_REPLICA_MAX_LAG) + 1
+    return [
+        (LAST_WRITE_HEADER.encode(), value.encode()),
+        (b"set-cookie", f"{LAST_WRITE_COOKIE}={value}; Max-Age={max_age}; Path=/; HttpOnly; SameSite=Lax".encode()),
+    ]
+
+def last_write(scope):
+    # Momento de la última escritura del cliente (epoch), según lo que envió en el header
+    # X-DB-Last-Write o en la cookie db_last_write; None si no envió nada válido
+    values = []
+    for name, value in scope.get("headers", []):
+        if name == LAST_WRITE_HEADER.encode():
+            values.append(value.decode("latin-1"))
+        elif name == b"cookie":
+            for part in value.decode("latin-1").split(";"):
+                key, _, cookie = part.strip().partition("=")
+                if key == LAST_WRITE_COOKIE:
+                    values.append(cookie)
+    written = []
+    for value in values:
+        try:
+            written.append(float(value))
+        except ValueError:
+            continue
+    return max(written) if written else None
+
+# Decide si una lectura puede ir a la réplica. El atraso se mide como mucho cada
+# lag_check_interval segundos (en PostgreSQL, con pg_last_xact_replay_timestamp); si no se
+# puede medir o supera max_lag, se lee de la principal. Un cliente que escribió hace
+# menos de max_lag segundos (según last_write) también lee de la principal para ver sus
+# propios cambios.
+class ReplicaRouter:
+    def __init__(self, max_lag: float = DB_REPLICA_MAX_LAG, lag_check_interval: float = DB_REPLICA_LAG_CHECK_INTERVAL):
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.enabled = read_engine is not engine
+        self.lag = 0.0
+        self._lag_checked_at = None
+        self._lag_lock = asyncio.Lock()
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+    async def _measure_lag(self) -> float:
+        if read_engine.dialect.name != "postgresql":
+            return 0.0
+        async with read_engine.connect() as connection:
+            lag = (await connection.execute(text(
+                "SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"
+            ))).scalar()
+        return float(lag or 0.0)
+
+    async def current_lag(self) -> float:
+        now = time.monotonic()
+        if self._lag_checked_at is None or now - self._lag_checked_at >= self.lag_check_interval:
+            async with self._lag_lock:
+                if self._lag_checked_at is None or now - self._lag_checked_at >= self.lag_check_interval:
+                    try:
+                        self.lag = await self._measure_lag()
+                    except Exception as e:
+                        logger.warning("No se pudo medir el atraso de la réplica: %s", e)
+                        self.lag = float("inf")
+                    self._lag_checked_at = time.monotonic()
+        return self.lag
+
+    async def use_replica(self, written_at: float = None) -> bool:
+        if not self.enabled:
+            return False
+        if written_at is not None and time.time() - written_at < self.max_lag:
+            return False
+        return await self.current_lag() <= self.max_lag
+
+    async def session_factory(self, written_at: float = None):
+        if await self.use_replica(written_at):
+            self.replica_reads += 1
+            return read_session
+        self.primary_reads += 1
+        return async_session
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "lag": self.lag, "max_lag": self.max_lag,
+                "replica_reads": self.replica_reads, "primary_reads": self.primary_reads}
+
+replica = ReplicaRouter()
 
 # Declarative base para los modelos
 Base = declarative_base()
@@ -26,13 +334,33 @@ async def test_connection():
     except Exception as e:
         print(f"Database connection failed: {e}")
 
-# Dependency para obtener una sesión asincrónica de la base de datos
+# Termina la transacción de solo lectura en curso para devolver la conexión al pool
+# antes de una llamada lenta (AFIP). Con expire_on_commit=False los objetos ya cargados
+# siguen legibles; si hay cambios sin guardar no se toca la sesión.
+async def release_connection(session: AsyncSession):
+    if session.in_transaction() and not (session.new or session.dirty or session.deleted):
+        await session.commit()
+
+# Dependency para obtener una sesión asincrónica de la base de datos. La sesión no toma
+# una conexión del pool hasta la primera consulta.
 async def get_db():
-    async with async_session() as session:
-        try:
-            yield session
-        finally:
-            await session.close()
+    with span("db.session"):
+        async with async_session() as session:
+            try:
+                yield session
+            finally:
+                await session.close()
+
+# Dependency para lecturas que toleran un atraso acotado (listados, reportes, exportaciones):
+# usa la réplica si está configurada y al día, y si no la base principal
+async def get_read_db(request: Request):
+    session_factory = await replica.session_factory(last_write(request.scope))
+    with span("db.read_session"):
+        async with session_factory() as session:
+            try:
+                yield session
+            finally:
+                await session.close()
 
 # Si ejecutas el archivo directamente, prueba la conexión
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+from decouple import config
+from app.metrics import registry
+import json
+import logging
+import random
+import threading
+import time
+import traceback
+import uuid
+
+# Incluir el error y el traceback en la respuesta 500 (solo para desarrollo)
+ERROR_DETAILS = config("ERROR_DETAILS", default=False, cast=bool)
+# Como máximo ERROR_LOG_LIMIT errores registrados por (ruta, excepción) cada ERROR_LOG_WINDOW
+# segundos; el resto solo se cuenta y se informa en el siguiente registro
+ERROR_LOG_LIMIT = config("ERROR_LOG_LIMIT", default=10, cast=int)
+ERROR_LOG_WINDOW = config("ERROR_LOG_WINDOW", default=60.0, cast=float)
+# Fracción de los errores registrados que incluyen el traceback; el primero de cada
+# ventana siempre lo incluye
+ERROR_TRACE_SAMPLE_RATE = config("ERROR_TRACE_SAMPLE_RATE", default=0.1, cast=float)
+
+logger = logging.getLogger(__name__)
+
+unhandled_errors = registry.counter(
+    "http_unhandled_errors_total", "Excepciones no manejadas por ruta y tipo", ("route", "exception"))
+suppressed_error_logs = registry.counter(
+    "http_unhandled_errors_suppressed_total", "Errores no registrados por el límite de logs", ("route", "exception"))
+
+
+# Límite de registros por clave en ventanas fijas
+class ErrorLogLimiter:
+    def __init__(self, limit: int = ERROR_LOG_LIMIT, window: float = ERROR_LOG_WINDOW,
+                 sample_rate: float = ERROR_TRACE_SAMPLE_RATE):
+        self.limit = limit
+        self.window = window
+        self.sample_rate = sample_rate
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def admit(self, key) -> tuple:
+        # Devuelve (registrar, incluir traceback, errores suprimidos desde el último registro)
+        now = time.monotonic()
+        with self._lock:
+            state = self._windows.get(key)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state else 0
+                self._windows[key] = [now, 1, 0]
+                return True, True, suppressed
+            if state[1] >= self.limit:
+                state[2] += 1
+                return False, False, 0
+            state[1] += 1
+            suppressed, state[2] = state[2], 0
+        return True, random.random() < self.sample_rate, suppressed
+
+
+# Middleware ASGI puro: no envuelve request/response en objetos de Starlette ni agrega
+# una tarea por petición como @app.middleware("http"). Ante una excepción no manejada
+# responde 500 con un id para buscar el error en los logs.
+class ErrorMiddleware:
+    def __init__(self, app, details: bool = ERROR_DETAILS, limiter: ErrorLogLimiter = None):
+        self.app = app
+        self.details = details
+        self.limiter = limiter or ErrorLogLimiter()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = False
+
+        async def send_wrapper(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            error_id = uuid.uuid4().hex[:12]
+            self.log(scope, e, error_id)
+            if started:
+                # La respuesta ya empezó (p. ej. un streaming): no se puede cambiar el status
+                raise
+            content = {"detail": "Internal Server Error", "error_id": error_id}
+            if self.details:
+                content.update(error=str(e), trace=traceback.format_exc())
+            body = json.dumps(content).encode()
+            await send({"type": "http.response.start", "status": 500, "headers": [
+                (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+            await send({"type": "http.response.body", "body": body})
+
+    def log(self, scope, error: Exception, error_id: str):
+        route = getattr(scope.get("route"), "path", None) or "unmatched"
+        exception = type(error).__name__
+        unhandled_errors.inc(route=route, exception=exception)
+        log, with_trace, suppressed = self.limiter.admit((route, exception))
+        if not log:
+            suppressed_error_logs.inc(route=route, exception=exception)
+            return
+        logger.error("Unhandled error %s en %s %s (id=%s, suprimidos=%s): %s", exception, scope["method"], route,
+                     error_id, suppressed, error, exc_info=error if with_trace else None,
+                     extra={"error_id": error_id, "route": route, "method": scope["method"],
+                            "exception": exception, "suppressed": suppressed})
@@ -1,10 +1,21 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-from app.routers import users, clients, invoices, certificates, invoice_items, authorizations
-from app.database import engine
+from fastapi.responses import JSONResponse, PlainTextResponse
+from decouple import config
+from app.routers import users, clients, invoices, certificates, invoice_items, authorizations, afip, cae_jobs, caea, cache, database, sales
+from app.database import engine, read_engine, QueryCountMiddleware
+from app.metrics import registry
+from app.errors import ErrorMiddleware
+from app.services.afip_gateway import gateway, AfipGatewayError, AfipUnavailableError, AfipTimeoutError
+from app.services.jobs import job_pool
+from app.services.caea import caea_scheduler
+from app.services.wsfe_params import param_cache
+from app.services.keystore import keystore
+from app.services.renewals import renewal_scheduler
+from app.services.idempotency import idempotency_store, IdempotencyError
+from contextlib import asynccontextmanager
 from pydantic_settings import BaseSettings
 import logging
-import traceback
+import math
 
 class Settings(BaseSettings):
     database_url: str
@@ -14,29 +25,58 @@ class Settings(BaseSettings):
 
 settings = Settings()
 
+# Recursos que viven lo mismo que la aplicación
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    param_cache.start()
+    job_pool.start()
+    caea_scheduler.start()
+    renewal_scheduler.start()
+    idempotency_store.start()
+    yield
+    await idempotency_store.stop()
+    await renewal_scheduler.stop()
+    await caea_scheduler.stop()
+    await job_pool.stop()
+    await param_cache.stop()
+    gateway.shutdown()
+    keystore.shutdown()
+    await engine.dispose()
+    if read_engine is not engine:
+        await read_engine.dispose()
+
 # Configuración principal de la aplicación
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Configurar logging
-logging.basicConfig(level=logging.DEBUG)
+# DEBUG registra cada tramo medido (sesiones, crud, AFIP); no usarlo en producción
+LOG_LEVEL = config("LOG_LEVEL", default="INFO")
+logging.basicConfig(level=LOG_LEVEL.upper())
 logger = logging.getLogger(__name__)
 
-# Middleware para capturar errores y mostrar más detalles
-@app.middleware("http")
-async def catch_exceptions_middleware(request: Request, call_next):
-    try:
-        return await call_next(request)
-    except Exception as e:
-        # Capturar el error completo
-        error_trace = traceback.format_exc()
-        logger.error(f"Unhandled error: {e}")
-        logger.error(f"Traceback: {error_trace}")
-        
-        # Retornar un JSON con detalles del error
-        return JSONResponse(
-            status_code=500,
-            content={"detail": "Internal Server Error", "error": str(e), "trace": error_trace},
-        )
+app.add_middleware(QueryCountMiddleware)
+# Último en agregarse: envuelve a los demás y convierte las excepciones no manejadas en 500
+app.add_middleware(ErrorMiddleware)
+
+# Errores del gateway de AFIP: 503 con Retry-After si conviene reintentar más tarde
+@app.exception_handler(AfipGatewayError)
+async def afip_gateway_exception_handler(request: Request, exc: AfipGatewayError):
+    if isinstance(exc, AfipTimeoutError):
+        return JSONResponse(status_code=504, content={"detail": str(exc)})
+    retry_after = exc.retry_after if isinstance(exc, AfipUnavailableError) else 1
+    return JSONResponse(status_code=503, content={"detail": str(exc)},
+                        headers={"Retry-After": str(max(math.ceil(retry_after), 1))})
+
+# Idempotency-Key inválida, reutilizada con otro cuerpo (422) o todavía en curso (409)
+@app.exception_handler(IdempotencyError)
+async def idempotency_exception_handler(request: Request, exc: IdempotencyError):
+    headers = {"Retry-After": str(math.ceil(exc.retry_after))} if exc.retry_after else None
+    return JSONResponse(status_code=exc.status_code, content={"detail": str(exc)}, headers=headers)
+
+# Métricas en formato de texto de Prometheus, fuera de /api/v1 como esperan los scrapers
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 # Registrar los routers (endpoints)
 app.include_router(users.router, prefix="/api/v1")
@@ -44,4 +84,10 @@ app.include_router(clients.router, prefix="/api/v1")
 app.include_router(invoices.router, prefix="/api/v1")
 app.include_router(certificates.router, prefix="/api/v1")
 app.include_router(invoice_items.router, prefix="/api/v1")
-app.include_router(authorizations.router, prefix="/api/v1")
\ No newline at end of file
+app.include_router(authorizations.router, prefix="/api/v1")
+app.include_router(afip.router, prefix="/api/v1")
+app.include_router(cae_jobs.router, prefix="/api/v1")
+app.include_router(caea.router, prefix="/api/v1")
+app.include_router(cache.router, prefix="/api/v1")
+app.include_router(database.router, prefix="/api/v1")
+app.include_router(sales.router, prefix="/api/v1")
@@ -0,0 +1,180 @@
+from contextlib import contextmanager
+import bisect
+import functools
+import logging
+import threading
+import time
+
+# Límites (segundos) de los buckets de los histogramas de latencia
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Límites de los histogramas de cantidad de consultas por petición
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Métricas mínimas con el formato de texto de Prometheus (sin depender de prometheus_client).
+# Los valores se guardan por combinación de etiquetas, en el orden de labelnames.
+class Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{labels} {_number(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, _labels(self.labelnames, key), value) for key, value in items]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        samples = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", _labels(self.labelnames, key, f'le="{_number(bound)}"'),
+                                cumulative))
+            samples.append((f"{self.name}_bucket", _labels(self.labelnames, key, 'le="+Inf"'), count))
+            samples.append((f"{self.name}_sum", _labels(self.labelnames, key), total))
+            samples.append((f"{self.name}_count", _labels(self.labelnames, key), count))
+        return samples
+
+
+# Valor que se lee al momento de exportar: collect() devuelve {valores de etiquetas: valor}
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        try:
+            values = self.collect() if self.collect else {}
+        except Exception as e:
+            logger.warning("No se pudo leer la métrica %s: %s", self.name, e)
+            return []
+        return [(self.name, _labels(self.labelnames, key), value) for key, value in values.items()]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Duración de las peticiones HTTP por ruta", ("method", "route", "status"))
+db_queries_per_request = registry.histogram(
+    "db_queries_per_request", "Consultas a la base por petición", ("route",), buckets=QUERY_COUNT_BUCKETS)
+db_query_duration_per_request = registry.histogram(
+    "db_query_duration_seconds_per_request", "Tiempo total en la base por petición", ("route",))
+# Sin el CUIT como etiqueta: una serie por contribuyente no escala; el CUIT va a los logs
+afip_call_duration = registry.histogram(
+    "afip_call_duration_seconds", "Duración de las llamadas a AFIP", ("service", "outcome"))
+afip_call_errors = registry.counter(
+    "afip_call_errors_total", "Llamadas a AFIP fallidas o rechazadas", ("service", "kind"))
+span_duration = registry.histogram(
+    "span_duration_seconds", "Duración de los tramos instrumentados (sesiones, crud, AFIP)", ("span",))
+
+
+@contextmanager
+def span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        span_duration.observe(elapsed, span=name)
+        logger.debug("span %s: %.2f ms", name, elapsed * 1000)
+
+
+def traced(name: str):
+    # Decorador para corrutinas: mide cada llamada como un tramo
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Numeric
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Numeric, Text, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from .database import Base
 from sqlalchemy.sql import func
@@ -15,6 +15,7 @@ class User(Base):
     cuit = Column(String, nullable=False)
     full_name = Column(String)
     is_active = Column(Boolean, default=True)
+    caea_enabled = Column(Boolean, default=False, nullable=False)
     created_at = Column(DateTime, server_default=func.now(), nullable=False)
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
 
@@ -25,6 +26,11 @@ class User(Base):
 
 class Client(Base):
     __tablename__ = "client"
+    __table_args__ = (
+        Index("ix_client_user_client", "user_id", "client_id"),
+        # Clave de la importación masiva (upsert por usuario y CUIT)
+        UniqueConstraint("user_id", "cuit", name="uq_client_user_cuit"),
+    )
 
     client_id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.user_id"))
@@ -41,6 +47,16 @@ class Client(Base):
 
 class Invoice(Base):
     __tablename__ = "invoice"
+    # Índices para los listados paginados por (date, invoice_id): cada filtro de
+    # igualdad va adelante y la clave de paginación al final, así la consulta recorre
+    # el índice en orden y se corta en el LIMIT
+    __table_args__ = (
+        Index("ix_invoice_date", "date", "invoice_id"),
+        Index("ix_invoice_user_date", "user_id", "date", "invoice_id"),
+        Index("ix_invoice_user_status_date", "user_id", "status", "date", "invoice_id"),
+        Index("ix_invoice_user_pos_type_date", "user_id", "point_of_sale", "invoice_type", "date", "invoice_id"),
+        Index("ix_invoice_client_date", "client_id", "date", "invoice_id"),
+    )
 
     invoice_id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.user_id"))
@@ -55,12 +71,18 @@ class Invoice(Base):
     cae = Column(String(50))
     cae_expiration_date = Column(DateTime)
     status = Column(String(50), default="draft")
+    emission_type = Column(String(10), default="CAE", nullable=False)
+    caea_reported_at = Column(DateTime)
+    caea_report_error = Column(Text)
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
 
+    items = relationship("InvoiceItem", backref="invoice", cascade="all, delete-orphan")
+
 
 class InvoiceItem(Base):
     __tablename__ = "invoice_item"
+    __table_args__ = (Index("ix_invoice_item_invoice_item", "invoice_id", "item_id"),)
 
     item_id = Column(Integer, primary_key=True, index=True)
     invoice_id = Column(Integer, ForeignKey("invoice.invoice_id"))
@@ -73,6 +95,10 @@ class InvoiceItem(Base):
 
 class Certificate(Base):
     __tablename__ = "certificate"
+    __table_args__ = (
+        Index("ix_certificate_expires_at", "expires_at"),
+        Index("ix_certificate_user_certificate", "user_id", "certificate_id"),
+    )
 
     certificate_id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
@@ -82,9 +108,12 @@ class Certificate(Base):
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
     expires_at = Column(DateTime, default=lambda: datetime.now() + timedelta(days=365))
+    # Un worker está renovando el certificado hasta esta fecha; los demás lo saltean
+    renewing_until = Column(DateTime)
 
     user = relationship("User", back_populates="certificates")
     authorizations = relationship("Authorization", back_populates="certificate", cascade="all, delete-orphan")
+    access_tickets = relationship("AccessTicket", back_populates="certificate", cascade="all, delete-orphan")
 
 
 class Authorization(Base):
@@ -97,4 +126,139 @@ class Authorization(Base):
     created_at = Column(DateTime, server_default=func.now(), nullable=False)
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
 
-    certificate = relationship("Certificate", back_populates="authorizations")
\ No newline at end of file
+    certificate = relationship("Certificate", back_populates="authorizations")
+
+class AccessTicket(Base):
+    __tablename__ = "access_ticket"
+    __table_args__ = (UniqueConstraint("certificate_id", "service", name="uq_access_ticket_certificate_service"),)
+
+    access_ticket_id = Column(Integer, primary_key=True, index=True)
+    certificate_id = Column(Integer, ForeignKey("certificate.certificate_id", ondelete="CASCADE"), nullable=False)
+    service = Column(String, nullable=False)
+    token = Column(Text, nullable=False)
+    sign = Column(Text, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    # Un worker está pidiendo el TA a WSAA hasta esta fecha; los demás esperan
+    refreshing_until = Column(DateTime)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    certificate = relationship("Certificate", back_populates="access_tickets")
+
+
+class CaeJob(Base):
+    __tablename__ = "cae_job"
+    __table_args__ = (Index("ix_cae_job_status_available_at", "status", "available_at"),)
+
+    job_id = Column(Integer, primary_key=True, index=True)
+    invoice_id = Column(Integer, ForeignKey("invoice.invoice_id", ondelete="CASCADE"), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    status = Column(String(20), default="queued", nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    result = Column(String(50))
+    last_error = Column(Text)
+    available_at = Column(DateTime, server_default=func.now(), nullable=False)
+    locked_at = Column(DateTime)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class Caea(Base):
+    __tablename__ = "caea"
+    __table_args__ = (UniqueConstraint("user_id", "period", "fortnight", name="uq_caea_user_period_fortnight"),)
+
+    caea_id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    certificate_id = Column(Integer, ForeignKey("certificate.certificate_id", ondelete="SET NULL"))
+    code = Column(String(20), nullable=False)
+    period = Column(Integer, nullable=False)
+    fortnight = Column(Integer, nullable=False)
+    valid_from = Column(DateTime, nullable=False)
+    valid_to = Column(DateTime, nullable=False)
+    report_deadline = Column(DateTime)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+
+
+class VoucherCounter(Base):
+    __tablename__ = "voucher_counter"
+    __table_args__ = (UniqueConstraint("cuit", "point_of_sale", "voucher_type", name="uq_voucher_counter_key"),)
+
+    counter_id = Column(Integer, primary_key=True, index=True)
+    cuit = Column(String(20), nullable=False)
+    point_of_sale = Column(Integer, nullable=False)
+    voucher_type = Column(Integer, nullable=False)
+    last_number = Column(Integer, nullable=False)
+    seeded_at = Column(DateTime, server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class VoucherGap(Base):
+    __tablename__ = "voucher_gap"
+    __table_args__ = (UniqueConstraint("cuit", "point_of_sale", "voucher_type", "number", name="uq_voucher_gap_number"),)
+
+    gap_id = Column(Integer, primary_key=True, index=True)
+    cuit = Column(String(20), nullable=False)
+    point_of_sale = Column(Integer, nullable=False)
+    voucher_type = Column(Integer, nullable=False)
+    number = Column(Integer, nullable=False)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+
+
+class PadronEntry(Base):
+    __tablename__ = "padron_entry"
+
+    cuit = Column(String(11), primary_key=True)
+    found = Column(Boolean, nullable=False)
+    name = Column(String(255))
+    tax_condition = Column(String(100))
+    address = Column(String(500))
+    error = Column(Text)
+    fetched_at = Column(DateTime, nullable=False, index=True)
+
+
+class WsfeParam(Base):
+    __tablename__ = "wsfe_param"
+
+    name = Column(String(100), primary_key=True)
+    payload = Column(Text, nullable=False)
+    fetched_at = Column(DateTime, nullable=False)
+
+
+# Respuesta guardada de una petición con Idempotency-Key; status_code en NULL mientras
+# la petición original está en curso
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_key"
+    __table_args__ = (Index("ix_idempotency_key_expires_at", "expires_at"),)
+
+    endpoint = Column(String(255), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    status_code = Column(Integer)
+    response_headers = Column(Text)
+    response_body = Column(Text)
+    expires_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+
+
+# Totales de ventas por usuario, mes (YYYYMM), estado, tipo, punto de venta y alícuota de
+# IVA. Se mantienen en la misma transacción que las altas, cambios y bajas de facturas
+# (ver app/services/sales.py)
+class SalesMonth(Base):
+    __tablename__ = "sales_month"
+    __table_args__ = (
+        UniqueConstraint("user_id", "period", "status", "invoice_type", "point_of_sale", "tax_rate",
+                         name="uq_sales_month_key"),
+    )
+
+    sales_month_id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    period = Column(Integer, nullable=False)
+    status = Column(String(50), nullable=False)
+    invoice_type = Column(String(10), nullable=False)
+    point_of_sale = Column(Integer, nullable=False)
+    tax_rate = Column(Numeric(5, 2), nullable=False)
+    invoice_count = Column(Integer, default=0, nullable=False)
+    net_amount = Column(Numeric(14, 2), default=0, nullable=False)
+    tax_amount = Column(Numeric(14, 2), default=0, nullable=False)
+    total_amount = Column(Numeric(14, 2), default=0, nullable=False)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
@@ -0,0 +1,70 @@
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+from datetime import datetime
+import base64
+import json
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Paginación por clave (keyset): el cursor guarda los valores de la última fila
+# devuelta y la página siguiente arranca con un WHERE (col1, col2) < (v1, v2) que
+# usa el índice, en lugar de un OFFSET que recorre todas las filas anteriores.
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"dt": value.isoformat()}
+    return value
+
+
+def _decode_value(value, column):
+    # Cada valor tiene que ser del tipo de su columna; cualquier otra cosa es un cursor inválido
+    python_type = column.type.python_type
+    if python_type is datetime:
+        if not (isinstance(value, dict) and set(value) == {"dt"} and isinstance(value["dt"], str)):
+            raise ValueError("expected a datetime")
+        return datetime.fromisoformat(value["dt"])
+    if python_type is int:
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError("expected an integer")
+        return value
+    if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+        raise ValueError("expected a scalar")
+    return value
+
+
+def encode_cursor(values: tuple) -> str:
+    raw = json.dumps([_encode_value(value) for value in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, columns: tuple) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError("wrong number of values")
+        return tuple(_decode_value(value, column) for value, column in zip(values, columns))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def paginate(stmt, columns: tuple, cursor: str = None, limit: int = DEFAULT_PAGE_SIZE, descending: bool = False):
+    # Ordena por las columnas de la clave y aplica el cursor; se pide una fila de más
+    # para saber si hay otra página sin hacer un COUNT
+    if cursor:
+        after = decode_cursor(cursor, columns)
+        key = tuple_(*columns)
+        stmt = stmt.where(key < tuple_(*after) if descending else key > tuple_(*after))
+    order = [column.desc() if descending else column.asc() for column in columns]
+    return stmt.order_by(*order).limit(limit + 1)
+
+
+def page(rows: list, columns: tuple, limit: int):
+    # Devuelve (filas de la página, cursor siguiente o None)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(tuple(getattr(last, column.key) for column in columns))
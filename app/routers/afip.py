@@ -0,0 +1,68 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_db, release_connection
+from app import crud
+from app.services.afip_gateway import gateway, AfipGatewayError
+from app.services.tickets import ticket_cache
+from app.services.jobs import job_pool
+from app.services.padron import padron_cache
+from app.services.wsfe_params import param_cache
+from app.services.keystore import keystore
+from app.services.renewals import renewal_scheduler
+
+router = APIRouter()
+
+@router.get("/afip/gateway")
+async def read_gateway_stats():
+    # Estado del pool de llamadas a AFIP (profundidad de la cola, hilos ocupados, errores)
+    return gateway.stats()
+
+@router.get("/afip/breakers")
+async def read_breaker_state():
+    # Estado de los circuit breakers por servicio y de los rate limiters por (CUIT, servicio)
+    return {"breakers": gateway.breaker_stats(), "limiters": gateway.limiter_stats()}
+
+@router.get("/afip/tickets")
+async def read_ticket_cache_stats():
+    return ticket_cache.stats()
+
+@router.get("/afip/keystore")
+async def read_keystore_stats():
+    return keystore.stats()
+
+@router.get("/afip/renewals")
+async def read_renewal_stats():
+    return renewal_scheduler.stats()
+
+@router.get("/afip/jobs")
+async def read_job_pool_stats():
+    return job_pool.stats()
+
+@router.get("/afip/padron")
+async def read_padron_cache_stats():
+    return padron_cache.stats()
+
+@router.get("/afip/params")
+async def read_param_cache_stats():
+    return param_cache.stats()
+
+@router.get("/afip/params/sales-points/{user_id}")
+async def read_sales_points(user_id: int, db: AsyncSession = Depends(get_db)):
+    certificate = await crud.get_latest_certificate(db, user_id)
+    if not certificate:
+        raise HTTPException(status_code=404, detail="No certificate found for this user")
+    await release_connection(db)
+    try:
+        sales_points = await param_cache.sales_points(certificate)
+    except AfipGatewayError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Error al consultar AFIP: {e}")
+    return list(sales_points.values())
+
+@router.get("/afip/params/{name}")
+async def read_param_table(name: str):
+    table = param_cache.table(name)
+    if table is None:
+        raise HTTPException(status_code=404, detail="Parameter table not loaded")
+    return list(table.values())
@@ -0,0 +1,9 @@
+from fastapi import APIRouter
+from app.cache import cache
+
+router = APIRouter()
+
+@router.get("/cache/stats")
+async def get_cache_stats():
+    # Aciertos y fallos del cache de lectura de usuarios, certificados y clientes
+    return cache.stats()
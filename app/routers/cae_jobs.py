@@ -0,0 +1,13 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_db
+from app import crud, schemas
+
+router = APIRouter()
+
+@router.get("/cae-jobs/{job_id}", response_model=schemas.CaeJob)
+async def read_cae_job(job_id: int, db: AsyncSession = Depends(get_db)):
+    db_job = await crud.get_cae_job(db, job_id)
+    if not db_job:
+        raise HTTPException(status_code=404, detail="CAE job not found")
+    return schemas.CaeJob.model_validate(db_job)
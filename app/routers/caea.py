@@ -0,0 +1,30 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List
+from app.database import get_db, get_read_db
+from app import schemas
+from app.services import caea
+from app.services.cae import CaeError
+from app.services.afip_gateway import AfipGatewayError
+
+router = APIRouter()
+
+@router.post("/caea/", response_model=schemas.Caea)
+async def request_caea(request: schemas.CaeaRequest, db: AsyncSession = Depends(get_db)):
+    if request.fortnight not in (1, 2):
+        raise HTTPException(status_code=400, detail="Fortnight must be 1 or 2")
+    try:
+        db_caea = await caea.ensure_caea(db, request.user_id, request.period, request.fortnight)
+    except CaeError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except AfipGatewayError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Error al solicitar CAEA en AFIP: {e}")
+    return schemas.Caea.model_validate(db_caea)
+
+@router.get("/caea/pending/{user_id}", response_model=List[schemas.CaeaPendingInvoice])
+async def get_pending_caea_reports(user_id: int, db: AsyncSession = Depends(get_read_db)):
+    # Comprobantes emitidos con CAEA que AFIP todavía no aceptó
+    invoices = await caea.get_pending_reports(db, user_id)
+    return [schemas.CaeaPendingInvoice.model_validate(invoice) for invoice in invoices]
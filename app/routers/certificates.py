@@ -3,10 +3,11 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import selectinload
 from typing import List
-from app.database import get_db
-from app.models import Certificate as CertificateModel, User as UserModel
-from app.schemas import Certificate as CertificateSchema
-from afip import Afip
+from app.database import get_db, get_read_db, release_connection
+from app.models import Certificate as CertificateModel
+from app.schemas import Certificate as CertificateSchema, CertificateCreate
+from app import crud
+from app.services.afip_gateway import gateway, AfipGatewayError
 from pydantic import BaseModel
 
 router = APIRouter()
@@ -19,51 +20,36 @@ async def create_certificate(request: CertificateRequest, db: AsyncSession = Dep
     user_id = request.user_id
 
     # Verificar si el usuario existe
-    stmt = (
-        select(UserModel)
-        .where(UserModel.user_id == user_id)
-        .options(selectinload(UserModel.certificates))  # Pre-cargar relación 'certificates'
-    )
-    result = await db.execute(stmt)
-    db_user = result.scalar_one_or_none()
+    db_user = await crud.get_user(db, user_id)
 
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
 
     # Verificar si ya existe un certificado para el usuario
-    if db_user.certificates:
-        return CertificateSchema.model_validate(db_user.certificates[0])
+    existing_certificate = await crud.get_latest_certificate(db, user_id)
+    if existing_certificate:
+        return CertificateSchema.model_validate(existing_certificate)
 
-    # Crear el certificado
-    afip = Afip({"CUIT": db_user.cuit})
+    # Crear el certificado (sin retener la conexión durante la llamada a AFIP)
+    await release_connection(db)
     try:
-        response = afip.createCert(db_user.username, db_user.password_hash, "afipsdk")
+        response = await gateway.create_cert(db_user.cuit, db_user.username, db_user.password_hash, "afipsdk")
         cert = response.get("cert")
         key = response.get("key")
+    except AfipGatewayError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al crear certificado en AFIP: {e}")
 
-    db_certificate = CertificateModel(
-        user_id=user_id,
-        cert_alias="afipsdk",
-        certificate=cert,
-        private_key=key,
+    db_certificate = await crud.create_certificate(
+        db, CertificateCreate(cert_alias="afipsdk", certificate=cert, private_key=key), user_id
     )
-    db.add(db_certificate)
-    await db.commit()
-    await db.refresh(db_certificate)
 
     return CertificateSchema.model_validate(db_certificate)
 
 @router.get("/certificates/{certificate_id}", response_model=CertificateSchema)
 async def read_certificate(certificate_id: int, db: AsyncSession = Depends(get_db)):
-    stmt = (
-        select(CertificateModel)
-        .where(CertificateModel.certificate_id == certificate_id)
-        .options(selectinload(CertificateModel.user))  # Pre-cargar relación 'user'
-    )
-    result = await db.execute(stmt)
-    db_certificate = result.scalar_one_or_none()
+    db_certificate = await crud.get_certificate(db, certificate_id)
 
     if not db_certificate:
         raise HTTPException(status_code=404, detail="Certificate not found")
@@ -71,7 +57,7 @@ async def read_certificate(certificate_id: int, db: AsyncSession = Depends(get_d
     return CertificateSchema.model_validate(db_certificate)
 
 @router.get("/certificates/by_user/{user_id}", response_model=List[CertificateSchema])
-async def get_certificates_by_user(user_id: int, db: AsyncSession = Depends(get_db)):
+async def get_certificates_by_user(user_id: int, db: AsyncSession = Depends(get_read_db)):
     stmt = (
         select(CertificateModel)
         .where(CertificateModel.user_id == user_id)
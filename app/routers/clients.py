@@ -1,7 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.database import get_db
-from app import crud, schemas
+from typing import Optional
+from app.database import get_db, get_read_db
+from app import crud, schemas, models, serialization
+from app.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from app.services import client_import
 
 router = APIRouter()
 
@@ -10,9 +13,30 @@ async def create_client(client: schemas.ClientCreate, db: AsyncSession = Depends
     db_client = await crud.create_client(db, client)
     return schemas.Client.model_validate(db_client)
 
+@router.post("/clients/import", response_model=schemas.ClientImportResult)
+async def import_clients(user_id: int, request: Request, format: str = "csv", enrich: bool = True,
+                         db: AsyncSession = Depends(get_db)):
+    # El archivo se envía como cuerpo de la petición (text/csv o application/x-ndjson)
+    # y se procesa a medida que llega, sin cargarlo entero en memoria
+    if not await crud.get_user(db, user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+    try:
+        summary = await client_import.import_clients(db, user_id, request.stream(), format, enrich=enrich)
+    except client_import.ClientImportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return schemas.ClientImportResult(**summary)
+
+@router.get("/clients/", response_model=schemas.ClientPage)
+async def list_clients(user_id: Optional[int] = None, is_active: Optional[bool] = None, cursor: Optional[str] = None,
+                       limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                       db: AsyncSession = Depends(get_read_db)):
+    rows, next_cursor = await crud.list_clients(db, user_id=user_id, is_active=is_active, cursor=cursor, limit=limit,
+                                                fields=serialization.columns(models.Client, schemas.Client))
+    return serialization.page_response(schemas.Client, rows, next_cursor)
+
 @router.get("/clients/{client_id}", response_model=schemas.Client)
 async def read_client(client_id: int, db: AsyncSession = Depends(get_db)):
     db_client = await crud.get_client(db, client_id)
     if not db_client:
         raise HTTPException(status_code=404, detail="Client not found")
-    return schemas.Client.model_validate(db_client)
\ No newline at end of file
+    return serialization.item_response(schemas.Client, db_client)
\ No newline at end of file
@@ -0,0 +1,14 @@
+from fastapi import APIRouter
+from app.database import pool_metrics, replica
+
+router = APIRouter()
+
+@router.get("/db/pool")
+async def read_pool_stats():
+    # Estado del pool de conexiones y esperas por conexión agregadas por ruta
+    return pool_metrics.stats()
+
+@router.get("/db/replica")
+async def read_replica_stats():
+    # Atraso de la réplica de lectura y cuántas lecturas fueron a cada base
+    return replica.stats()
@@ -1,18 +1,28 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.database import get_db
-from app import crud, schemas
+from typing import Optional
+from app.database import get_db, get_read_db
+from app import crud, schemas, models, serialization
+from app.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 
 router = APIRouter()
 
 @router.post("/invoice-items/", response_model=schemas.InvoiceItem)
 async def create_invoice_item(invoice_item: schemas.InvoiceItemCreate, db: AsyncSession = Depends(get_db)):
     db_invoice_item = await crud.create_invoice_item(db, invoice_item)
-    return schemas.InvoiceItem.model_validate(db_invoice_item)
+    return serialization.item_response(schemas.InvoiceItem, db_invoice_item)
+
+@router.get("/invoice-items/", response_model=schemas.InvoiceItemPage)
+async def list_invoice_items(invoice_id: int, cursor: Optional[str] = None,
+                             limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                             db: AsyncSession = Depends(get_read_db)):
+    rows, next_cursor = await crud.list_invoice_items(
+        db, invoice_id, cursor=cursor, limit=limit, fields=serialization.columns(models.InvoiceItem, schemas.InvoiceItem))
+    return serialization.page_response(schemas.InvoiceItem, rows, next_cursor)
 
 @router.get("/invoice-items/{item_id}", response_model=schemas.InvoiceItem)
-async def read_invoice_item(item_id: int, db: AsyncSession = Depends(get_db)):
+async def read_invoice_item(item_id: int, db: AsyncSession = Depends(get_read_db)):
     db_invoice_item = await crud.get_invoice_item(db, item_id)
     if not db_invoice_item:
         raise HTTPException(status_code=404, detail="Invoice item not found")
-    return schemas.InvoiceItem.model_validate(db_invoice_item)
\ No newline at end of file
+    return serialization.item_response(schemas.InvoiceItem, db_invoice_item)
\ No newline at end of file
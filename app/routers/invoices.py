@@ -1,18 +1,105 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response, Query, Request, Header
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.database import get_db
-from app import crud, schemas
+from typing import Optional
+from datetime import datetime
+from app.database import get_db, get_read_db, replica, last_write
+from app import crud, schemas, models, serialization
+from app.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from app.services import cae, exports
+from app.services.idempotency import idempotency_store, fingerprint
+from app.services.jobs import job_pool
 
 router = APIRouter()
 
-@router.post("/invoices/", response_model=schemas.Invoice)
-async def create_invoice(invoice: schemas.InvoiceCreate, db: AsyncSession = Depends(get_db)):
-    db_invoice = await crud.create_invoice(db, invoice)
-    return schemas.Invoice.model_validate(db_invoice)
+# Las altas y los pedidos de CAE aceptan el header Idempotency-Key: un reintento con la
+# misma clave devuelve la respuesta original sin crear otra factura ni llamar otra vez a AFIP
+def _endpoint(request: Request) -> str:
+    return f"{request.method} {request.url.path}"
+
+def _json(model, status_code: int = 200, headers: dict = None) -> Response:
+    return Response(model.model_dump_json(), status_code=status_code, headers=headers, media_type="application/json")
+
+@router.post("/invoices/", response_model=schemas.InvoiceWithItems)
+async def create_invoice(invoice: schemas.InvoiceCreate, request: Request, submit: bool = False,
+                         idempotency_key: Optional[str] = Header(None), db: AsyncSession = Depends(get_db)):
+    async def handle():
+        if not submit:
+            return serialization.item_response(schemas.InvoiceWithItems, await crud.create_invoice(db, invoice))
+        # La factura y el job de CAE se guardan juntos y se responde sin esperar a AFIP
+        db_invoice, db_job = await crud.create_and_enqueue_invoice(db, invoice)
+        if db_job is not None:
+            job_pool.notify()
+            return serialization.item_response(schemas.InvoiceWithItems, db_invoice, status_code=202,
+                                               headers={"Location": f"/api/v1/cae-jobs/{db_job.job_id}"})
+        return serialization.item_response(schemas.InvoiceWithItems, db_invoice)
+    return await idempotency_store.run(idempotency_key, _endpoint(request), fingerprint(invoice, submit), handle)
+
+@router.post("/invoices/{invoice_id}/submit", response_model=schemas.CaeJob, status_code=202)
+async def submit_invoice(invoice_id: int, request: Request, idempotency_key: Optional[str] = Header(None),
+                         db: AsyncSession = Depends(get_db)):
+    async def handle():
+        db_invoice = await crud.get_invoice(db, invoice_id)
+        if not db_invoice:
+            raise HTTPException(status_code=404, detail="Invoice not found")
+        if db_invoice.status != "draft":
+            raise HTTPException(status_code=409, detail=f"Invoice status is '{db_invoice.status}'")
+        db_job = await crud.enqueue_cae_job(db, db_invoice)
+        job_pool.notify()
+        return _json(schemas.CaeJob.model_validate(db_job), status_code=202)
+    return await idempotency_store.run(idempotency_key, _endpoint(request), fingerprint(invoice_id), handle)
+
+@router.post("/invoices/cae", response_model=schemas.CaeBatchResult)
+async def request_caes(cae_request: schemas.CaeRequest, request: Request, idempotency_key: Optional[str] = Header(None),
+                       db: AsyncSession = Depends(get_db)):
+    # Solicita el CAE de varias facturas; los rechazos se informan por comprobante
+    async def handle():
+        results = await cae.issue_invoices(db, cae_request.invoice_ids)
+        return _json(schemas.CaeBatchResult(
+            authorized=sum(1 for r in results if r["status"] == "authorized"),
+            rejected=sum(1 for r in results if r["status"] == "rejected"),
+            results=[schemas.CaeResult(**r) for r in results],
+        ))
+    return await idempotency_store.run(idempotency_key, _endpoint(request), fingerprint(cae_request), handle)
+
+@router.get("/invoices/", response_model=schemas.InvoicePage)
+async def list_invoices(user_id: Optional[int] = None, client_id: Optional[int] = None,
+                        status: Optional[str] = None, invoice_type: Optional[str] = None,
+                        point_of_sale: Optional[int] = None, date_from: Optional[datetime] = None,
+                        date_to: Optional[datetime] = None, cursor: Optional[str] = None,
+                        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                        db: AsyncSession = Depends(get_read_db)):
+    rows, next_cursor = await crud.list_invoices(
+        db, user_id=user_id, client_id=client_id, status=status, invoice_type=invoice_type,
+        point_of_sale=point_of_sale, date_from=date_from, date_to=date_to, cursor=cursor, limit=limit,
+        fields=serialization.columns(models.Invoice, schemas.Invoice),
+    )
+    return serialization.page_response(schemas.Invoice, rows, next_cursor)
+
+@router.get("/invoices/export")
+async def export_invoices(request: Request, cuit: str, period: int, format: str = "csv", status: Optional[str] = None,
+                          gzip: bool = False):
+    # Exportación en streaming: las filas se envían a medida que llegan del cursor.
+    # Lee de la réplica si está al día, así los reportes no compiten con la facturación.
+    session_factory = await replica.session_factory(last_write(request.scope))
+    try:
+        await exports.validate_export(cuit, period, format, status=status, session_factory=session_factory)
+        body = exports.stream_export(cuit, period, format, status=status, compress=gzip,
+                                     session_factory=session_factory)
+    except exports.ExportDataError as e:
+        raise HTTPException(status_code=422, detail={"message": str(e), "invoices": e.errors})
+    except exports.ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    media_type, extension = exports.FORMATS[format]
+    filename = f"ventas_{cuit}_{period}.{extension}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}{".gz" if gzip else ""}"'}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(body, media_type=media_type, headers=headers)
 
 @router.get("/invoices/{invoice_id}", response_model=schemas.Invoice)
-async def read_invoice(invoice_id: int, db: AsyncSession = Depends(get_db)):
+async def read_invoice(invoice_id: int, db: AsyncSession = Depends(get_read_db)):
     db_invoice = await crud.get_invoice(db, invoice_id)
     if not db_invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
-    return schemas.Invoice.model_validate(db_invoice)
\ No newline at end of file
+    return serialization.item_response(schemas.Invoice, db_invoice)
\ No newline at end of file
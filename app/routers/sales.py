@@ -0,0 +1,24 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from app.database import get_read_db
+from app import schemas, serialization
+from app.services import sales
+
+router = APIRouter()
+
+# Los resúmenes leen solo la tabla de totales, nunca las facturas. Por defecto cuentan
+# los comprobantes autorizados, que son los que van a la declaración de IVA.
+
+@router.get("/sales/monthly", response_model=List[schemas.SalesMonthTotal])
+async def read_monthly_sales(user_id: int, period_from: Optional[int] = None, period_to: Optional[int] = None,
+                             status: str = "authorized", db: AsyncSession = Depends(get_read_db)):
+    rows = await sales.monthly_summary(db, user_id, period_from, period_to, status)
+    return serialization.FastJSONResponse(rows)
+
+@router.get("/sales/monthly/{period}", response_model=List[schemas.SalesBreakdownLine])
+async def read_sales_breakdown(period: int, user_id: int, status: str = "authorized",
+                               db: AsyncSession = Depends(get_read_db)):
+    # Por tipo de comprobante, punto de venta y alícuota de IVA
+    rows = await sales.breakdown(db, user_id, period, status)
+    return serialization.FastJSONResponse(rows)
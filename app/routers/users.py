@@ -2,8 +2,8 @@ import asyncio
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
 from app.database import get_db
+from app import crud
 from app.models import User as UserModel
 from app.schemas import UserCreate, User as UserSchema
 
@@ -24,30 +24,14 @@ async def create_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
             raise HTTPException(status_code=400, detail="Username already registered")
 
     # Crear un nuevo usuario
-    db_user = UserModel(
-        username=user.username,
-        password_hash=user.password_hash,
-        email=user.email,
-        cuit=user.cuit,
-        full_name=user.full_name,
-        is_active=True,
-    )
-    db.add(db_user)
-    await db.commit()
-    await db.refresh(db_user)
+    db_user = await crud.create_user(db, user)
 
     return UserSchema.model_validate(db_user)
 
 @router.get("/users/{user_id}", response_model=UserSchema)
 async def get_user(user_id: int, db: AsyncSession = Depends(get_db)):
-    # Consulta para buscar al usuario por su ID
-    stmt = (
-        select(UserModel)
-        .options(selectinload(UserModel.certificates))  # Pre-cargar relación 'certificates'
-        .where(UserModel.user_id == user_id)
-    )
-    result = await db.execute(stmt)
-    user = result.scalar_one_or_none()
+    # Buscar al usuario por su ID (pasa por el cache de lectura)
+    user = await crud.get_user(db, user_id)
     
     # Si no existe el usuario, lanza un 404
     if user is None:
@@ -1,6 +1,7 @@
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, model_validator, field_validator
 from typing import Optional, List
 from datetime import datetime
+from decimal import Decimal
 
 # User Schemas
 class UserBase(BaseModel):
@@ -8,6 +9,7 @@ class UserBase(BaseModel):
     email: str
     cuit: str
     full_name: Optional[str] = None
+    caea_enabled: bool = False
 
 class UserCreate(UserBase):
     password_hash: str
@@ -19,6 +21,7 @@ class UserUpdate(BaseModel):
     cuit: Optional[str] = None
     full_name: Optional[str] = None
     password_hash: Optional[str] = None
+    caea_enabled: Optional[bool] = None
 
 class User(UserBase):
     user_id: int
@@ -38,7 +41,7 @@ class ClientBase(BaseModel):
     is_active: bool = True
 
 class ClientCreate(ClientBase):
-    pass
+    user_id: int
 
 # ClientUpdate Schema
 class ClientUpdate(BaseModel):
@@ -57,6 +60,47 @@ class Client(ClientBase):
 
     model_config = ConfigDict(from_attributes=True)
 
+# Fila de la importación masiva; sin nombre se completa con el padrón de AFIP
+class ClientImportRow(BaseModel):
+    name: Optional[str] = None
+    cuit: Optional[str] = None
+    tax_condition: Optional[str] = None
+    email: Optional[str] = None
+    phone: Optional[str] = None
+    address: Optional[str] = None
+    is_active: bool = True
+
+    @field_validator("cuit")
+    @classmethod
+    def check_cuit(cls, value):
+        if value is None:
+            return None
+        digits = "".join(ch for ch in str(value) if ch.isdigit())
+        if len(digits) != 11:
+            raise ValueError("CUIT must have 11 digits")
+        return digits
+
+    @model_validator(mode="after")
+    def check_identity(self):
+        if not self.name and not self.cuit:
+            raise ValueError("name or cuit is required")
+        return self
+
+class ClientImportError(BaseModel):
+    line: int
+    error: str
+
+class ClientImportResult(BaseModel):
+    received: int
+    imported: int
+    enriched: int
+    failed: int
+    errors: List[ClientImportError]
+
+class ClientPage(BaseModel):
+    items: List[Client]
+    next_cursor: Optional[str] = None
+
 # Invoice Schemas
 class InvoiceBase(BaseModel):
     invoice_number: Optional[str] = None
@@ -70,8 +114,33 @@ class InvoiceBase(BaseModel):
     cae_expiration_date: Optional[datetime] = None
     status: str = "draft"
 
+# Ítem enviado junto con la factura; los importes se calculan en el servidor
+class InvoiceItemInline(BaseModel):
+    description: str
+    quantity: float
+    unit_price: float
+    tax_rate: Optional[float] = None
+
 class InvoiceCreate(InvoiceBase):
+    user_id: int
     client_id: int
+    total_amount: Optional[float] = None
+    items: List[InvoiceItemInline] = []
+
+    @field_validator("invoice_type")
+    @classmethod
+    def check_invoice_type(cls, value):
+        # Validación local contra la tabla FEParamGetTiposCbte cacheada, sin llamar a AFIP
+        from app.services.wsfe_params import param_cache
+        if not param_cache.is_valid_voucher_type(value):
+            raise ValueError(f"Unknown invoice type '{value}'")
+        return value
+
+    @model_validator(mode="after")
+    def check_amounts(self):
+        if not self.items and self.total_amount is None:
+            raise ValueError("total_amount is required when the invoice has no items")
+        return self
 
 # InvoiceUpdate Schema
 class InvoiceUpdate(BaseModel):
@@ -91,7 +160,69 @@ class Invoice(InvoiceBase):
     invoice_id: int
     user_id: int
     client_id: int
+    emission_type: str = "CAE"
+    caea_reported_at: Optional[datetime] = None
+    created_at: datetime
+
+    model_config = ConfigDict(from_attributes=True)
+
+class InvoicePage(BaseModel):
+    items: List[Invoice]
+    next_cursor: Optional[str] = None
+
+class CaeRequest(BaseModel):
+    invoice_ids: List[int]
+
+class CaeResult(BaseModel):
+    invoice_id: int
+    status: str
+    cae: Optional[str] = None
+    cae_expiration_date: Optional[datetime] = None
+    invoice_number: Optional[str] = None
+    errors: List[str] = []
+
+class CaeBatchResult(BaseModel):
+    authorized: int
+    rejected: int
+    results: List[CaeResult]
+
+class CaeJob(BaseModel):
+    job_id: int
+    invoice_id: int
+    status: str
+    attempts: int
+    result: Optional[str] = None
+    last_error: Optional[str] = None
     created_at: datetime
+    updated_at: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+class CaeaRequest(BaseModel):
+    user_id: int
+    period: int
+    fortnight: int
+
+class Caea(BaseModel):
+    caea_id: int
+    user_id: int
+    code: str
+    period: int
+    fortnight: int
+    valid_from: datetime
+    valid_to: datetime
+    report_deadline: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+class CaeaPendingInvoice(BaseModel):
+    invoice_id: int
+    invoice_number: Optional[str] = None
+    invoice_type: str
+    point_of_sale: int
+    date: datetime
+    cae: Optional[str] = None
+    caea_report_error: Optional[str] = None
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -122,6 +253,13 @@ class InvoiceItem(InvoiceItemBase):
 
     model_config = ConfigDict(from_attributes=True)
 
+class InvoiceItemPage(BaseModel):
+    items: List[InvoiceItem]
+    next_cursor: Optional[str] = None
+
+class InvoiceWithItems(Invoice):
+    items: List[InvoiceItem] = []
+
 # Certificate Schemas
 class CertificateBase(BaseModel):
     cert_alias: str
@@ -157,4 +295,21 @@ class Authorization(AuthorizationBase):
     created_at: datetime
     updated_at: datetime
 
-    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
+
+# Totales de ventas (tabla sales_month)
+class SalesMonthTotal(BaseModel):
+    period: int
+    invoice_count: int
+    net_amount: Decimal
+    tax_amount: Decimal
+    total_amount: Decimal
+
+class SalesBreakdownLine(BaseModel):
+    invoice_type: str
+    point_of_sale: int
+    tax_rate: Decimal
+    invoice_count: int
+    net_amount: Decimal
+    tax_amount: Decimal
+    total_amount: Decimal
@@ -0,0 +1,162 @@
+from fastapi.responses import Response
+from pydantic import BaseModel
+from decouple import config
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+from json.encoder import encode_basestring
+from operator import attrgetter
+from sqlalchemy.engine import Row
+import math
+import typing
+
+# Con RESPONSE_VALIDATION=true las respuestas rápidas pasan igual por el schema de
+# pydantic (útil en desarrollo para detectar diferencias entre el modelo y el schema)
+RESPONSE_VALIDATION = config("RESPONSE_VALIDATION", default=False, cast=bool)
+
+# Respuestas en un solo paso: las filas (objetos ORM o Row de un select por columnas) se
+# codifican directamente con los campos del schema, sin model_validate en el router ni
+# la segunda validación de response_model. Los Numeric salen como el número decimal
+# exacto de la base (121.50), no como float.
+
+
+def _decimal(value: Decimal) -> str:
+    return str(value) if value.is_finite() else "null"
+
+
+def _decimal_string(value: Decimal) -> str:
+    return f'"{value}"' if value.is_finite() else "null"
+
+
+def _float(value: float) -> str:
+    return float.__repr__(value) if math.isfinite(value) else "null"
+
+
+def _datetime(value) -> str:
+    return f'"{value.isoformat()}"'
+
+
+# Codificador por tipo exacto: un lookup por valor en lugar de una cadena de isinstance
+_SCALARS = {
+    type(None): lambda value: "null",
+    str: encode_basestring,
+    int: int.__repr__,
+    bool: lambda value: "true" if value else "false",
+    float: _float,
+    Decimal: _decimal,
+    datetime: _datetime,
+    date: _datetime,
+}
+_SCALARS_DECIMAL_STRING = {**_SCALARS, Decimal: _decimal_string}
+
+
+def _encode(value, scalars: dict) -> str:
+    encoder = scalars.get(type(value))
+    if encoder is not None:
+        return encoder(value)
+    if isinstance(value, dict):
+        return "{" + ",".join(f"{encode_basestring(str(key))}:{_encode(item, scalars)}"
+                              for key, item in value.items()) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(_encode(item, scalars) for item in value) + "]"
+    if isinstance(value, BaseModel):
+        return _encode(value.model_dump(), scalars)
+    # Subclases (p. ej. enums de texto o enteros)
+    if isinstance(value, str):
+        return encode_basestring(value)
+    if isinstance(value, int):
+        return int.__repr__(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode(value, decimal_as_string: bool = False) -> str:
+    return _encode(value, _SCALARS_DECIMAL_STRING if decimal_as_string else _SCALARS)
+
+
+def dumps(value, decimal_as_string: bool = False) -> bytes:
+    return encode(value, decimal_as_string).encode("utf-8")
+
+
+@lru_cache(maxsize=None)
+def members(names: tuple, decimal_as_string: bool = False):
+    # Devuelve una función que codifica una tupla de valores, en el orden de names, como
+    # los miembros de un objeto JSON ('"a":1,"b":"x"', sin llaves)
+    keys = [f"{encode_basestring(name)}:" for name in names]
+    scalars = _SCALARS_DECIMAL_STRING if decimal_as_string else _SCALARS
+
+    def other(value) -> str:
+        return _encode(value, scalars)
+
+    def encode_members(values) -> str:
+        return ",".join([key + scalars.get(type(value), other)(value) for key, value in zip(keys, values)])
+    return encode_members
+
+
+@lru_cache(maxsize=None)
+def fields(schema) -> tuple:
+    return tuple(schema.model_fields)
+
+
+@lru_cache(maxsize=None)
+def columns(model, schema) -> tuple:
+    # Columnas del modelo para un select(*columnas) con exactamente los campos del schema,
+    # en el mismo orden: cada Row ya es la tupla de valores que espera members()
+    return tuple(getattr(model, name) for name in fields(schema))
+
+
+@lru_cache(maxsize=None)
+def _getter(schema):
+    return attrgetter(*fields(schema))
+
+
+def _values(schema, row) -> tuple:
+    # Row de columns(model, schema): los valores ya están en orden; objeto ORM: por atributo
+    return row if isinstance(row, Row) else _getter(schema)(row)
+
+
+@lru_cache(maxsize=None)
+def _nested(schema) -> dict:
+    # Campos List[Schema] (p. ej. los ítems de InvoiceWithItems): se codifican con su schema
+    nested = {}
+    for name, field in schema.model_fields.items():
+        args = typing.get_args(field.annotation)
+        if typing.get_origin(field.annotation) is list and args and isinstance(args[0], type) \
+                and issubclass(args[0], BaseModel):
+            nested[name] = args[0]
+    return nested
+
+
+def _object(schema, row) -> str:
+    nested = _nested(schema)
+    if not nested:
+        return "{" + members(fields(schema))(_values(schema, row)) + "}"
+    names = tuple(name for name in fields(schema) if name not in nested)
+    parts = [members(names)([getattr(row, name) for name in names])]
+    for name, item_schema in nested.items():
+        items = ",".join([_object(item_schema, item) for item in getattr(row, name)])
+        parts.append(f"{encode_basestring(name)}:[{items}]")
+    return "{" + ",".join(parts) + "}"
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        # bytes: cuerpo ya codificado por item_response / page_response
+        return content if isinstance(content, bytes) else dumps(content)
+
+
+def item_response(schema, row, status_code: int = 200, headers: dict = None) -> FastJSONResponse:
+    if RESPONSE_VALIDATION:
+        return FastJSONResponse(schema.model_validate(row).model_dump(), status_code=status_code, headers=headers)
+    return FastJSONResponse(_object(schema, row).encode("utf-8"), status_code=status_code, headers=headers)
+
+
+def page_response(schema, rows: list, next_cursor: str = None) -> FastJSONResponse:
+    if RESPONSE_VALIDATION:
+        items = [schema.model_validate(row).model_dump() for row in rows]
+        return FastJSONResponse({"items": items, "next_cursor": next_cursor})
+    encode_members = members(fields(schema))
+    items = ",".join(["{" + encode_members(_values(schema, row)) + "}" for row in rows])
+    body = '{"items":[' + items + '],"next_cursor":' + encode(next_cursor) + "}"
+    return FastJSONResponse(body.encode("utf-8"))
@@ -0,0 +1,255 @@
+from concurrent.futures import ThreadPoolExecutor
+from decouple import config
+from afip import Afip
+from app.services.resilience import CircuitBreaker, TokenBucket, is_outage, OPEN
+from app.metrics import registry, span, afip_call_duration, afip_call_errors
+import asyncio
+import logging
+import threading
+import time
+
+# Configuración del pool de llamadas a AFIP
+AFIP_MAX_WORKERS = config("AFIP_MAX_WORKERS", default=8, cast=int)
+AFIP_MAX_QUEUE = config("AFIP_MAX_QUEUE", default=200, cast=int)
+AFIP_CALL_TIMEOUT = config("AFIP_CALL_TIMEOUT", default=30.0, cast=float)
+# createCert/createWSAuth hacen polling interno (hasta 25 intentos cada 5 segundos)
+AFIP_LONG_CALL_TIMEOUT = config("AFIP_LONG_CALL_TIMEOUT", default=150.0, cast=float)
+# Máximo que una llamada espera un token del rate limiter antes de rechazarse
+AFIP_RATE_MAX_WAIT = config("AFIP_RATE_MAX_WAIT", default=5.0, cast=float)
+
+logger = logging.getLogger(__name__)
+
+
+class AfipGatewayError(Exception):
+    pass
+
+
+class AfipQueueFullError(AfipGatewayError):
+    pass
+
+
+class AfipTimeoutError(AfipGatewayError):
+    pass
+
+
+# Errores por los que conviene reintentar más tarde: se responden con 503 y Retry-After
+class AfipUnavailableError(AfipGatewayError):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AfipCircuitOpenError(AfipUnavailableError):
+    pass
+
+
+class AfipRateLimitedError(AfipUnavailableError):
+    pass
+
+
+# Cliente del SDK que usa los tickets de acceso (TA) ya obtenidos en lugar de pedirlos
+# nuevamente en cada operación
+class TicketedAfip(Afip):
+    def __init__(self, options: dict, tickets: dict):
+        super().__init__(options)
+        self.tickets = tickets
+
+    def getServiceTA(self, service: str, force: bool = False) -> dict:
+        if not force and service in self.tickets:
+            return self.tickets[service]
+        return super().getServiceTA(service, force)
+
+
+# Ejecuta las llamadas bloqueantes del SDK de AFIP en un pool de hilos acotado, para que
+# el event loop nunca espere al SDK. Si hay más de max_queue llamadas esperando un hilo
+# libre, se rechaza la llamada en lugar de acumular trabajo.
+#
+# Antes de encolar, cada llamada pasa por el circuit breaker de su servicio y por el
+# token bucket de su (CUIT, servicio): con AFIP caído se falla enseguida en lugar de
+# ocupar hilos y conexiones esperando timeouts.
+class AfipGateway:
+    def __init__(self, max_workers: int = AFIP_MAX_WORKERS, max_queue: int = AFIP_MAX_QUEUE,
+                 timeout: float = AFIP_CALL_TIMEOUT):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._timeouts = 0
+        self._rejected = 0
+        self._breakers = {}
+        self._limiters = {}
+
+    def breaker(self, service: str) -> CircuitBreaker:
+        return self._breakers.setdefault(service or "afip", CircuitBreaker())
+
+    def limiter(self, cuit, service: str) -> TokenBucket:
+        return self._limiters.setdefault((str(cuit or ""), service or "afip"), TokenBucket())
+
+    async def _admit(self, breaker: CircuitBreaker, limiter: TokenBucket, service: str, cuit):
+        if not breaker.allow():
+            with self._lock:
+                self._rejected += 1
+            raise AfipCircuitOpenError(f"AFIP no disponible para el servicio '{service}'",
+                                       breaker.retry_after() or breaker.open_seconds)
+        try:
+            while True:
+                wait = limiter.acquire()
+                if not wait:
+                    return
+                if wait > AFIP_RATE_MAX_WAIT:
+                    with self._lock:
+                        self._rejected += 1
+                    raise AfipRateLimitedError(
+                        f"Límite de llamadas a AFIP alcanzado (servicio={service}, cuit={cuit})", wait)
+                await asyncio.sleep(wait)
+        except BaseException:
+            breaker.release_probe()
+            raise
+
+    def _record(self, service: str, breaker: CircuitBreaker, limiter: TokenBucket, error: BaseException = None):
+        if error is not None and (isinstance(error, AfipTimeoutError) or is_outage(error)):
+            breaker.record_failure()
+            limiter.record_overload()
+            if breaker.state == OPEN:
+                logger.warning("Circuit breaker de '%s' abierto después de %s fallas", service, breaker.failures)
+        else:
+            # Un rechazo de negocio también prueba que AFIP está respondiendo
+            breaker.record_success()
+            limiter.record_success()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="afip")
+        return self._executor
+
+    def _run(self, fn, args, kwargs):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    async def call(self, fn, *args, timeout: float = None, service: str = None, cuit=None, **kwargs):
+        service_label = service or "afip"
+        start = time.perf_counter()
+        outcome = "ok"
+        with span(f"afip.{service_label}"):
+            try:
+                return await self._call(fn, args, kwargs, timeout, service, cuit)
+            except Exception as e:
+                outcome = _error_kind(e)
+                afip_call_errors.inc(service=service_label, kind=outcome)
+                logger.info("Llamada a AFIP fallida (servicio=%s, cuit=%s, tipo=%s): %s",
+                            service_label, cuit, outcome, e)
+                raise
+            finally:
+                afip_call_duration.observe(time.perf_counter() - start, service=service_label, outcome=outcome)
+
+    async def _call(self, fn, args, kwargs, timeout, service, cuit):
+        breaker = self.breaker(service)
+        limiter = self.limiter(cuit, service)
+        await self._admit(breaker, limiter, service, cuit)
+
+        with self._lock:
+            if self._queued >= self.max_queue:
+                self._rejected += 1
+                breaker.release_probe()
+                raise AfipQueueFullError("Demasiadas llamadas a AFIP en espera")
+            self._queued += 1
+
+        future = self._get_executor().submit(self._run, fn, args, kwargs)
+        timeout = timeout if timeout is not None else self.timeout
+        try:
+            result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+        except asyncio.TimeoutError:
+            # Si la llamada todavía no empezó se descarta; si ya está corriendo, el hilo
+            # no se puede interrumpir y sigue ocupado hasta que el SDK retorne
+            with self._lock:
+                if future.cancel():
+                    self._queued -= 1
+                self._timeouts += 1
+            logger.warning("Timeout de %ss en llamada a AFIP (servicio=%s, cuit=%s)", timeout, service, cuit)
+            error = AfipTimeoutError(f"AFIP no respondió en {timeout} segundos")
+            self._record(service, breaker, limiter, error)
+            raise error
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            with self._lock:
+                self._failed += 1
+            self._record(service, breaker, limiter, e)
+            raise
+        with self._lock:
+            self._completed += 1
+        self._record(service, breaker, limiter)
+        return result
+
+    def client(self, cuit, tickets: dict = None, **options) -> Afip:
+        if tickets:
+            return TicketedAfip({"CUIT": cuit, **options}, tickets)
+        return Afip({"CUIT": cuit, **options})
+
+    async def create_cert(self, cuit, username: str, password: str, alias: str) -> dict:
+        afip = self.client(cuit)
+        return await self.call(afip.createCert, username, password, alias,
+                               timeout=AFIP_LONG_CALL_TIMEOUT, service="certs", cuit=cuit)
+
+    async def create_ws_auth(self, cuit, username: str, password: str, alias: str, service: str,
+                             timeout: float = AFIP_LONG_CALL_TIMEOUT) -> dict:
+        afip = self.client(cuit)
+        return await self.call(afip.createWSAuth, username, password, alias, service,
+                               timeout=timeout, service=service, cuit=cuit)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queued": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "failed": self._failed,
+                "timeouts": self._timeouts,
+                "rejected": self._rejected,
+                "breakers": self.breaker_stats(),
+            }
+
+    def breaker_stats(self) -> dict:
+        return {service: breaker.stats() for service, breaker in self._breakers.items()}
+
+    def limiter_stats(self) -> dict:
+        return {f"{cuit}:{service}": limiter.stats() for (cuit, service), limiter in self._limiters.items()}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def _error_kind(error: Exception) -> str:
+    if isinstance(error, AfipCircuitOpenError):
+        return "circuit_open"
+    if isinstance(error, AfipRateLimitedError):
+        return "rate_limited"
+    if isinstance(error, AfipQueueFullError):
+        return "queue_full"
+    if isinstance(error, AfipTimeoutError):
+        return "timeout"
+    return "outage" if is_outage(error) else "error"
+
+
+gateway = AfipGateway()
+
+registry.gauge("afip_gateway_calls", "Llamadas a AFIP en espera y en curso", ("state",),
+               collect=lambda: {("queued", ): gateway._queued, ("running", ): gateway._running})
+registry.gauge("afip_gateway_max_workers", "Hilos disponibles para llamar a AFIP",
+               collect=lambda: {(): gateway.max_workers})
@@ -0,0 +1,127 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from decouple import config
+from app import crud
+from app.database import async_session, release_connection
+from app.models import Authorization
+from app.services.afip_gateway import gateway, AFIP_LONG_CALL_TIMEOUT, AfipUnavailableError
+import asyncio
+import logging
+import random
+
+AFIP_AUTH_MAX_ATTEMPTS = config("AFIP_AUTH_MAX_ATTEMPTS", default=4, cast=int)
+# Backoff exponencial con jitter entre intentos: espera al azar entre 0 y base * 2^intento
+AFIP_AUTH_BACKOFF_BASE = config("AFIP_AUTH_BACKOFF_BASE", default=1.0, cast=float)
+AFIP_AUTH_BACKOFF_MAX = config("AFIP_AUTH_BACKOFF_MAX", default=15.0, cast=float)
+# Tiempo máximo total de una autorización (simple o masiva), reintentos incluidos
+AFIP_AUTH_DEADLINE = config("AFIP_AUTH_DEADLINE", default=180.0, cast=float)
+
+logger = logging.getLogger(__name__)
+
+
+class AuthorizationError(Exception):
+    pass
+
+
+def backoff(attempt: int) -> float:
+    return random.uniform(0, min(AFIP_AUTH_BACKOFF_MAX, AFIP_AUTH_BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+async def existing(db: AsyncSession, certificate_id: int, services=None) -> dict:
+    stmt = select(Authorization).where(Authorization.certificate_id == certificate_id)
+    if services is not None:
+        stmt = stmt.where(Authorization.service.in_(services))
+    return {auth.service: auth for auth in (await db.execute(stmt)).scalars().all()}
+
+
+async def request_ws_auth(certificate, service: str, deadline: float) -> str:
+    # Pide a AFIP la autorización del servicio; devuelve "created" o "exists"
+    loop = asyncio.get_running_loop()
+    user = certificate.user
+    last_error = None
+    for attempt in range(1, AFIP_AUTH_MAX_ATTEMPTS + 1):
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            response = await gateway.create_ws_auth(user.cuit, user.username, user.password_hash,
+                                                    certificate.cert_alias, service,
+                                                    timeout=min(AFIP_LONG_CALL_TIMEOUT, remaining))
+            status = (response.get("status") or "").strip().lower()
+            if status in ("created", "exists"):
+                return status
+            last_error = f"Respuesta inesperada de AFIP: {response}"
+        except AfipUnavailableError:
+            # Con el circuito abierto no tiene sentido seguir reintentando
+            raise
+        except Exception as e:
+            last_error = str(e)
+        logger.warning("Intento %s de autorizar '%s' falló: %s", attempt, service, last_error)
+
+        delay = backoff(attempt)
+        if attempt == AFIP_AUTH_MAX_ATTEMPTS or loop.time() + delay >= deadline:
+            break
+        await asyncio.sleep(delay)
+    raise AuthorizationError(last_error or "Se agotó el tiempo para autorizar el servicio")
+
+
+async def authorize(db: AsyncSession, certificate, service: str, deadline: float = None) -> Authorization:
+    found = (await existing(db, certificate.certificate_id, [service])).get(service)
+    if found:
+        logger.info("La autorización para el servicio '%s' ya existe en la base de datos.", service)
+        return found
+    if deadline is None:
+        deadline = asyncio.get_running_loop().time() + AFIP_AUTH_DEADLINE
+    # Los reintentos pueden llevar minutos: no se retiene la conexión mientras tanto
+    await release_connection(db)
+    status = await request_ws_auth(certificate, service, deadline)
+    return await crud.create_authorization(db, certificate.certificate_id, service, status)
+
+
+async def authorize_many(certificate, services: list, deadline_seconds: float = AFIP_AUTH_DEADLINE):
+    # Autoriza los servicios en paralelo y devuelve cada resultado apenas termina.
+    # Usa su propia sesión: se consume desde el cuerpo de una respuesta en streaming.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + deadline_seconds
+    services = list(dict.fromkeys(services))
+
+    async with async_session() as db:
+        found = await existing(db, certificate.certificate_id, services)
+    for service in services:
+        if service in found:
+            yield {"service": service, "status": "skipped", "authorization_id": found[service].authorization_id,
+                   "error": None}
+
+    async def run(service: str):
+        try:
+            return service, await request_ws_auth(certificate, service, deadline), None
+        except AuthorizationError as e:
+            return service, "failed", str(e)
+        except AfipUnavailableError as e:
+            return service, "unavailable", f"{e} (reintentar en {e.retry_after:.0f} s)"
+
+    pending = {asyncio.create_task(run(service)): service for service in services if service not in found}
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=max(deadline - loop.time(), 0),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                del pending[task]
+                service, status, error = task.result()
+                authorization_id = None
+                if status in ("created", "exists"):
+                    async with async_session() as db:
+                        db_auth = await crud.create_authorization(db, certificate.certificate_id, service, status)
+                    authorization_id = db_auth.authorization_id
+                yield {"service": service, "status": status, "authorization_id": authorization_id, "error": error}
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    # Los que no terminaron antes del plazo total
+    for service in pending.values():
+        yield {"service": service, "status": "timeout", "authorization_id": None,
+               "error": "Se agotó el tiempo total de la autorización"}
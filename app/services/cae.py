@@ -0,0 +1,420 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import update, func, and_
+from afip.web_service import WebService
+from decouple import config
+from decimal import Decimal, ROUND_HALF_UP
+from datetime import datetime, timedelta
+from app import crud
+from app.database import release_connection
+from app.models import Invoice, InvoiceItem, Client
+from app.services.afip_gateway import gateway, AfipUnavailableError, AfipQueueFullError, AfipTimeoutError
+from app.services.tickets import ticket_cache
+from app.services import numbering, sales
+import asyncio
+import logging
+
+# Máximo de comprobantes por FECAESolicitar (FECompTotXRequest informa 250 en producción)
+AFIP_CAE_BATCH_SIZE = config("AFIP_CAE_BATCH_SIZE", default=250, cast=int)
+# Una factura en "issuing" sin novedades por más de este tiempo (el proceso murió) se puede volver a tomar
+CAE_ISSUE_LOCK_TIMEOUT = config("CAE_ISSUE_LOCK_TIMEOUT", default=600, cast=int)
+# Segundos que espera un job cuya factura está emitiendo otro pedido
+CAE_ISSUE_BUSY_RETRY = 30
+
+logger = logging.getLogger(__name__)
+
+# Códigos de comprobante de AFIP para las letras que usan los clientes
+VOUCHER_TYPES = {"A": 1, "B": 6, "C": 11, "M": 51}
+# Comprobantes C: el emisor no discrimina IVA
+NO_VAT_VOUCHER_TYPES = {11, 12, 13, 15}
+# Alícuotas de IVA (porcentaje -> Id de FEParamGetTiposIva)
+VAT_RATE_IDS = {
+    Decimal("0"): 3,
+    Decimal("10.5"): 4,
+    Decimal("21"): 5,
+    Decimal("27"): 6,
+    Decimal("5"): 8,
+    Decimal("2.5"): 9,
+}
+# Rechazo por número no correlativo: el comprobante en sí es válido y se puede reintentar
+SEQUENCE_ERROR_CODES = {"10016"}
+DOC_TYPE_CUIT = 80
+DOC_TYPE_FINAL_CONSUMER = 99
+CONCEPT_PRODUCTS = 1
+
+CENT = Decimal("0.01")
+
+
+class CaeError(Exception):
+    pass
+
+
+def voucher_type_code(invoice_type: str) -> int:
+    value = (invoice_type or "").strip().upper()
+    if value in VOUCHER_TYPES:
+        return VOUCHER_TYPES[value]
+    if value.isdigit():
+        return int(value)
+    raise CaeError(f"Tipo de comprobante desconocido: '{invoice_type}'")
+
+
+def vat_rate_id(rate) -> int:
+    rate = Decimal(str(rate)).normalize()
+    for known, rate_id in VAT_RATE_IDS.items():
+        if known == rate:
+            return rate_id
+    raise CaeError(f"Alícuota de IVA no admitida: {rate}%")
+
+
+def _amount(value) -> float:
+    return float(Decimal(str(value or 0)).quantize(CENT, rounding=ROUND_HALF_UP))
+
+
+def build_voucher_detail(invoice: Invoice, client_cuit: str, vat_lines: list, voucher_type: int, number: int) -> dict:
+    total = Decimal(str(invoice.total_amount))
+    tax = Decimal(str(invoice.tax_amount or 0))
+    net = Decimal(str(invoice.net_amount)) if invoice.net_amount is not None else total - tax
+
+    doc_number = "".join(ch for ch in (client_cuit or "") if ch.isdigit())
+    detail = {
+        "Concepto": CONCEPT_PRODUCTS,
+        "DocTipo": DOC_TYPE_CUIT if doc_number else DOC_TYPE_FINAL_CONSUMER,
+        "DocNro": int(doc_number) if doc_number else 0,
+        "CbteDesde": number,
+        "CbteHasta": number,
+        "CbteFch": invoice.date.strftime("%Y%m%d"),
+        "ImpTotal": _amount(total),
+        "ImpTotConc": 0,
+        "ImpNeto": _amount(net),
+        "ImpOpEx": 0,
+        "ImpIVA": _amount(tax),
+        "ImpTrib": 0,
+        "MonId": "PES",
+        "MonCotiz": 1,
+    }
+
+    if voucher_type in NO_VAT_VOUCHER_TYPES:
+        detail["ImpNeto"] = _amount(total)
+        detail["ImpIVA"] = 0
+        return detail
+
+    if not vat_lines:
+        # Sin ítems: se deduce la alícuota de los totales del comprobante
+        rate = (tax * 100 / net).quantize(Decimal("0.1"), rounding=ROUND_HALF_UP) if net else Decimal("0")
+        vat_lines = [(rate, net, tax)]
+    detail["Iva"] = {"AlicIva": [
+        {"Id": vat_rate_id(rate or 0), "BaseImp": _amount(base), "Importe": _amount(amount)}
+        for rate, base, amount in vat_lines
+    ]}
+    return detail
+
+
+def _request_caes(afip, point_of_sale: int, voucher_type: int, details: list) -> dict:
+    # Se llama al WebService base para obtener la respuesta completa: ElectronicBilling
+    # solo conserva el primer comprobante y lanza una excepción ante cualquier rechazo
+    wsfe = afip.ElectronicBilling
+    params = {
+        "FeCAEReq": {
+            "FeCabReq": {"CantReg": len(details), "PtoVta": point_of_sale, "CbteTipo": voucher_type},
+            "FeDetReq": {"FECAEDetRequest": details},
+        }
+    }
+    params.update(wsfe.getWSInitialRequest("FECAESolicitar"))
+    return WebService.executeRequest(wsfe, "FECAESolicitar", params)["FECAESolicitarResult"]
+
+
+def as_list(value) -> list:
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def messages(container, key: str) -> list:
+    if not container:
+        return []
+    return [f"({item.get('Code')}) {item.get('Msg')}" for item in as_list(container.get(key))]
+
+
+def _result(invoice_id: int, status: str, errors=None, **fields) -> dict:
+    return {"invoice_id": invoice_id, "status": status, "cae": None, "cae_expiration_date": None,
+            "invoice_number": None, "errors": errors or [], **fields}
+
+
+def _voucher_info(afip, number: int, point_of_sale: int, voucher_type: int) -> dict:
+    return afip.ElectronicBilling.getVoucherInfo(number, point_of_sale, voucher_type)["ResultGet"]
+
+
+def _failed(invoices: list, error: Exception) -> list:
+    retry_after = error.retry_after if isinstance(error, AfipUnavailableError) else None
+    return [_result(invoice.invoice_id, "error", [str(error)], retry_after=retry_after) for invoice in invoices]
+
+
+async def _recover_chunk(afip, key: tuple, details: list, numbered: list, error: Exception) -> list:
+    # FECAESolicitar falló sin respuesta: se averigua qué números llegó a autorizar AFIP
+    cuit, point_of_sale, voucher_type = key
+    numbers = [detail["CbteDesde"] for detail in details]
+    if isinstance(error, (AfipUnavailableError, AfipQueueFullError)):
+        # El pedido no llegó a salir: los números vuelven a estar libres
+        await numbering.allocator.release(key, numbers)
+        return _failed(numbered, error)
+    try:
+        afip_last = await gateway.call(numbering.last_authorized, afip, point_of_sale, voucher_type,
+                                       service="wsfe", cuit=cuit)
+    except Exception as e:
+        # Sin saber qué autorizó AFIP, los números no se reutilizan
+        logger.error("No se pudo consultar el último comprobante después de un error (%s): %s", key, e)
+        return _failed(numbered, error)
+
+    results = []
+    unused = []
+    for detail, invoice in zip(details, numbered):
+        number = detail["CbteDesde"]
+        if number > afip_last:
+            unused.append(number)
+            results.append(_result(invoice.invoice_id, "error", [str(error)]))
+            continue
+        try:
+            info = await gateway.call(_voucher_info, afip, number, point_of_sale, voucher_type,
+                                      service="wsfe", cuit=cuit)
+        except Exception as e:
+            info = {}
+            logger.error("No se pudo consultar el comprobante %s (%s): %s", number, key, e)
+        if info.get("CodAutorizacion") and _amount(info.get("ImpTotal")) == detail["ImpTotal"]:
+            results.append(_result(
+                invoice.invoice_id, "authorized",
+                cae=str(info["CodAutorizacion"]),
+                cae_expiration_date=datetime.strptime(str(info["FchVto"]), "%Y%m%d"),
+                invoice_number=str(number),
+            ))
+        else:
+            logger.error("Comprobante %s (%s) sin confirmar después de un error; la factura %s queda pendiente",
+                         number, key, invoice.invoice_id)
+            results.append(_result(invoice.invoice_id, "error", [str(error)]))
+    # Si AFIP no respondió a tiempo, la llamada puede seguir en curso: sus números no se liberan
+    if unused and not isinstance(error, AfipTimeoutError):
+        await numbering.allocator.reconcile(key, afip_last, unused)
+    return results
+
+
+async def _issue_group(certificate, point_of_sale: int, voucher_type: int, entries: list) -> list:
+    cuit = certificate.user.cuit
+    afip = await ticket_cache.client_for(certificate, "wsfe")
+    key = (cuit, point_of_sale, voucher_type)
+    seed = numbering.afip_seed(certificate.user_id, point_of_sale, voucher_type)
+    results = []
+
+    for start in range(0, len(entries), AFIP_CAE_BATCH_SIZE):
+        chunk = entries[start:start + AFIP_CAE_BATCH_SIZE]
+        remaining = [invoice for invoice, _, _ in entries[start + AFIP_CAE_BATCH_SIZE:]]
+        details = []
+        numbered = []
+        for invoice, client_cuit, vat_lines in chunk:
+            try:
+                details.append(build_voucher_detail(invoice, client_cuit, vat_lines, voucher_type, 0))
+                numbered.append(invoice)
+            except CaeError as e:
+                results.append(_result(invoice.invoice_id, "rejected", [str(e)]))
+        if not details:
+            continue
+
+        # El rango completo del lote se reserva de una vez
+        try:
+            numbers = await numbering.allocator.allocate(key, len(details), seed)
+        except Exception as e:
+            # Los CAE de los lotes anteriores ya están en results y se guardan igual
+            logger.error("Error al numerar (%s, lote desde %s): %s", key, start, e)
+            results.extend(_failed(numbered + remaining, e))
+            break
+        for detail, number in zip(details, numbers):
+            detail["CbteDesde"] = detail["CbteHasta"] = number
+
+        try:
+            response = await gateway.call(_request_caes, afip, point_of_sale, voucher_type, details,
+                                          service="wsfe", cuit=cuit)
+        except Exception as e:
+            # Los CAE de los lotes anteriores ya están en results y se guardan igual; los
+            # lotes que siguen no se envían y quedan para reintentar
+            logger.error("Error al solicitar CAE (%s, lote desde %s): %s", key, start, e)
+            results.extend(await _recover_chunk(afip, key, details, numbered, e))
+            results.extend(_failed(remaining, e))
+            break
+        voucher_responses = as_list((response.get("FeDetResp") or {}).get("FECAEDetResponse"))
+        if not voucher_responses:
+            await numbering.allocator.release(key, numbers)
+            error = CaeError("; ".join(messages(response.get("Errors"), "Err")) or "Respuesta de AFIP sin comprobantes")
+            results.extend(_failed(numbered + remaining, error))
+            break
+
+        by_number = {int(item["CbteDesde"]): item for item in voucher_responses}
+        broken_sequence = False
+        unused = []
+        for detail, invoice in zip(details, numbered):
+            item = by_number.get(detail["CbteDesde"], {})
+            observations = messages(item.get("Observaciones"), "Obs")
+            codes = {str(obs.get("Code")) for obs in as_list((item.get("Observaciones") or {}).get("Obs"))}
+            if item.get("Resultado") != "A" and (broken_sequence or codes & SEQUENCE_ERROR_CODES):
+                # AFIP rechaza los números que siguen a uno rechazado: se pueden reintentar
+                errors = (["Numeración interrumpida por un comprobante rechazado"] if broken_sequence else []) + observations
+                broken_sequence = True
+                unused.append(detail["CbteDesde"])
+                results.append(_result(invoice.invoice_id, "error", errors))
+            elif item.get("Resultado") == "A" and item.get("CAE"):
+                results.append(_result(
+                    invoice.invoice_id, "authorized", observations,
+                    cae=str(item["CAE"]),
+                    cae_expiration_date=datetime.strptime(str(item["CAEFchVto"]), "%Y%m%d"),
+                    invoice_number=str(detail["CbteDesde"]),
+                ))
+            else:
+                broken_sequence = True
+                unused.append(detail["CbteDesde"])
+                errors = observations + messages(response.get("Errors"), "Err")
+                results.append(_result(invoice.invoice_id, "rejected", errors or ["Comprobante rechazado por AFIP"]))
+
+        if unused:
+            # Los números propios no autorizados quedan como huecos a reutilizar; de paso se
+            # alinea el contador con AFIP por si se emitió por fuera del servicio
+            try:
+                afip_last = await gateway.call(numbering.last_authorized, afip, point_of_sale, voucher_type,
+                                               service="wsfe", cuit=cuit)
+                await numbering.allocator.reconcile(key, afip_last, unused)
+            except Exception as e:
+                # Los CAE obtenidos no se pueden perder: los números quedan sin reutilizar
+                logger.error("No se pudo alinear la numeración con AFIP (%s): %s", key, e)
+    return results
+
+
+async def load_vat_lines(db: AsyncSession, invoice_ids) -> dict:
+    # Base imponible e IVA por alícuota de cada factura, calculados a partir de sus ítems
+    stmt = (
+        select(InvoiceItem.invoice_id, InvoiceItem.tax_rate,
+               func.sum(InvoiceItem.total_price), func.sum(InvoiceItem.tax_amount))
+        .where(InvoiceItem.invoice_id.in_(invoice_ids))
+        .group_by(InvoiceItem.invoice_id, InvoiceItem.tax_rate)
+    )
+    vat_lines = {}
+    for invoice_id, rate, base, amount in (await db.execute(stmt)).all():
+        vat_lines.setdefault(invoice_id, []).append((rate, base, amount or 0))
+    return vat_lines
+
+
+async def claim_invoices(db: AsyncSession, invoice_ids: list) -> dict:
+    # Pasa las facturas a "issuing" con un UPDATE condicional antes de llamar a AFIP, así
+    # otro pedido o un job de la misma factura no la puede emitir a la vez. Devuelve
+    # {invoice_id: estado anterior} de las que se tomaron; la reserva se confirma enseguida.
+    now = datetime.utcnow()
+    conditions = {
+        "draft": Invoice.status == "draft",
+        "pending": Invoice.status == "pending",
+        "issuing": and_(Invoice.status == "issuing", Invoice.updated_at < now - timedelta(seconds=CAE_ISSUE_LOCK_TIMEOUT)),
+    }
+    claimed = {}
+    for previous, condition in conditions.items():
+        stmt = (
+            update(Invoice)
+            .where(Invoice.invoice_id.in_(invoice_ids), condition)
+            .values(status="issuing", updated_at=now)
+            .returning(Invoice.invoice_id)
+            .execution_options(synchronize_session=False)
+        )
+        claimed.update({invoice_id: previous for invoice_id in (await db.execute(stmt)).scalars().all()})
+    if claimed:
+        await sales.record_status(db, {invoice_id: "issuing" for invoice_id in claimed}, previous=claimed)
+    await db.commit()
+    return claimed
+
+
+def _restore_status(previous: str) -> str:
+    # Una reserva vencida que se vuelve a tomar venía de un pedido de CAE
+    return "pending" if previous == "issuing" else previous
+
+
+async def issue_invoices(db: AsyncSession, invoice_ids: list) -> list:
+    claimed = await claim_invoices(db, invoice_ids)
+    try:
+        results = await _issue_claimed(db, invoice_ids, claimed)
+    except Exception:
+        # Las facturas tomadas vuelven a su estado para que se puedan reintentar
+        await db.rollback()
+        await save_results(db, [], {invoice_id: _restore_status(previous) for invoice_id, previous in claimed.items()})
+        raise
+    await save_results(db, results, {invoice_id: _restore_status(previous) for invoice_id, previous in claimed.items()})
+    return results
+
+
+async def _issue_claimed(db: AsyncSession, invoice_ids: list, claimed: dict) -> list:
+    stmt = (
+        select(Invoice, Client.cuit)
+        .outerjoin(Client, Invoice.client_id == Client.client_id)
+        .where(Invoice.invoice_id.in_(invoice_ids))
+        .order_by(Invoice.date, Invoice.invoice_id)
+    )
+    rows = (await db.execute(stmt)).all()
+    found = {invoice.invoice_id for invoice, _ in rows}
+    results = [_result(invoice_id, "error", ["Invoice not found"]) for invoice_id in invoice_ids if invoice_id not in found]
+
+    vat_lines = await load_vat_lines(db, [invoice_id for invoice_id in found if invoice_id in claimed])
+
+    # Agrupar por emisor, punto de venta y tipo: cada grupo viaja en un solo FECAESolicitar
+    groups = {}
+    for invoice, client_cuit in rows:
+        if invoice.invoice_id not in claimed:
+            if invoice.status == "issuing":
+                # Otro pedido o job la está emitiendo: se reintenta cuando termine
+                results.append(_result(invoice.invoice_id, "error", ["Invoice is being issued by another request"],
+                                       retry_after=CAE_ISSUE_BUSY_RETRY))
+            else:
+                results.append(_result(invoice.invoice_id, "skipped", [f"Invoice status is '{invoice.status}'"]))
+            continue
+        try:
+            voucher_type = voucher_type_code(invoice.invoice_type)
+        except CaeError as e:
+            results.append(_result(invoice.invoice_id, "rejected", [str(e)]))
+            continue
+        key = (invoice.user_id, invoice.point_of_sale, voucher_type)
+        groups.setdefault(key, []).append((invoice, client_cuit, vat_lines.get(invoice.invoice_id, [])))
+
+    certificates = {}
+    for user_id in {key[0] for key in groups}:
+        certificates[user_id] = await crud.get_latest_certificate(db, user_id)
+    # Las llamadas a AFIP se hacen sin ninguna conexión tomada
+    await release_connection(db)
+
+    async def run(key, entries):
+        user_id, point_of_sale, voucher_type = key
+        certificate = certificates[user_id]
+        if not certificate:
+            return [_result(invoice.invoice_id, "error", ["No certificate found for this user"]) for invoice, _, _ in entries]
+        try:
+            return await _issue_group(certificate, point_of_sale, voucher_type, entries)
+        except Exception as e:
+            # Falla antes del primer envío (ticket, numeración): un grupo que falla no interrumpe a los demás
+            logger.error("Error al solicitar CAE (usuario=%s, pto_vta=%s, tipo=%s): %s", user_id, point_of_sale, voucher_type, e)
+            return _failed([invoice for invoice, _, _ in entries], e)
+
+    for group_results in await asyncio.gather(*[run(key, entries) for key, entries in groups.items()]):
+        results.extend(group_results)
+    return results
+
+
+async def save_results(db: AsyncSession, results: list, restore: dict = None):
+    # restore: {invoice_id: estado} de las facturas tomadas con claim_invoices que no
+    # quedaron autorizadas ni rechazadas y vuelven a su estado anterior
+    authorized = [
+        {"invoice_id": r["invoice_id"], "cae": r["cae"], "cae_expiration_date": r["cae_expiration_date"],
+         "invoice_number": r["invoice_number"], "status": "authorized"}
+        for r in results if r["status"] == "authorized"
+    ]
+    rejected = [{"invoice_id": r["invoice_id"], "status": "rejected"} for r in results if r["status"] == "rejected"]
+    done = {r["invoice_id"] for r in authorized + rejected}
+    restored = [{"invoice_id": invoice_id, "status": status}
+                for invoice_id, status in (restore or {}).items() if invoice_id not in done]
+    await sales.record_status(db, {r["invoice_id"]: r["status"] for r in authorized + rejected + restored})
+    # UPDATE por lotes (executemany) en lugar de una sentencia por factura
+    if authorized:
+        await db.execute(update(Invoice), authorized)
+    if rejected:
+        await db.execute(update(Invoice), rejected)
+    if restored:
+        await db.execute(update(Invoice), restored)
+    await db.commit()
@@ -0,0 +1,305 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import update
+from afip.web_service import WebService
+from decouple import config
+from datetime import datetime, timedelta
+from app import crud
+from app.database import async_session, release_connection
+from app.models import Caea, Invoice, Client, User
+from app.services.afip_gateway import gateway
+from app.services.resilience import BUSINESS_ERROR
+from app.services.tickets import ticket_cache
+from app.services import cae, numbering
+import asyncio
+import logging
+
+# Cada cuántos segundos se informan los comprobantes emitidos con CAEA
+CAEA_REPORT_INTERVAL = config("CAEA_REPORT_INTERVAL", default=300, cast=int)
+# AFIP permite solicitar el CAEA desde 5 días antes del inicio de la quincena
+CAEA_PREFETCH_DAYS = config("CAEA_PREFETCH_DAYS", default=5, cast=int)
+# Errores de FECAEASolicitar que indican que el CAEA de la quincena ya existe
+CAEA_ALREADY_REQUESTED_CODES = {"15008"}
+
+logger = logging.getLogger(__name__)
+
+
+def period_for(date: datetime):
+    return date.year * 100 + date.month, 1 if date.day <= 15 else 2
+
+
+def next_period(period: int, fortnight: int):
+    if fortnight == 1:
+        return period, 2
+    year, month = divmod(period, 100)
+    return (year + 1) * 100 + 1 if month == 12 else period + 1, 1
+
+
+def fortnight_start(period: int, fortnight: int) -> datetime:
+    year, month = divmod(period, 100)
+    return datetime(year, month, 1 if fortnight == 1 else 16)
+
+
+def _parse_date(value):
+    return datetime.strptime(str(value), "%Y%m%d") if value else None
+
+
+def _already_requested(error: Exception) -> bool:
+    # Rechazo de FECAEASolicitar porque el CAEA de la quincena ya fue otorgado
+    message = str(error).strip()
+    match = BUSINESS_ERROR.match(message)
+    return bool(match) and (match.group(0)[1:-2] in CAEA_ALREADY_REQUESTED_CODES or "otorgado" in message.lower())
+
+
+def _request_caea(afip, period: int, fortnight: int) -> dict:
+    wsfe = afip.ElectronicBilling
+    try:
+        return wsfe.createCAEA(period, fortnight)
+    except Exception as e:
+        # Si ya fue solicitado para la quincena, AFIP solo permite consultarlo; cualquier
+        # otro error (caída, timeout) se propaga
+        if not _already_requested(e):
+            raise
+        return wsfe.getCAEA(period, fortnight)
+
+
+def _report(afip, point_of_sale: int, voucher_type: int, details: list) -> dict:
+    wsfe = afip.ElectronicBilling
+    params = {
+        "FeCAEARegInfReq": {
+            "FeCabReq": {"CantReg": len(details), "PtoVta": point_of_sale, "CbteTipo": voucher_type},
+            "FeDetReq": {"FECAEADetRequest": details},
+        }
+    }
+    params.update(wsfe.getWSInitialRequest("FECAEARegInformativo"))
+    return WebService.executeRequest(wsfe, "FECAEARegInformativo", params)["FECAEARegInformativoResult"]
+
+
+async def ensure_caea(db: AsyncSession, user_id: int, period: int, fortnight: int):
+    stmt = select(Caea).where(Caea.user_id == user_id, Caea.period == period, Caea.fortnight == fortnight)
+    db_caea = (await db.execute(stmt)).scalar_one_or_none()
+    if db_caea:
+        return db_caea
+
+    certificate = await crud.get_latest_certificate(db, user_id)
+    if not certificate:
+        raise cae.CaeError("No certificate found for this user")
+    await release_connection(db)
+    afip = await ticket_cache.client_for(certificate, "wsfe")
+    result = await gateway.call(_request_caea, afip, period, fortnight, service="wsfe", cuit=certificate.user.cuit)
+
+    db_caea = Caea(
+        user_id=user_id,
+        certificate_id=certificate.certificate_id,
+        code=str(result["CAEA"]),
+        period=period,
+        fortnight=fortnight,
+        valid_from=_parse_date(result["FchVigDesde"]),
+        valid_to=_parse_date(result["FchVigHasta"]),
+        report_deadline=_parse_date(result.get("FchTopeInf")),
+    )
+    db.add(db_caea)
+    await db.commit()
+    await db.refresh(db_caea)
+    return db_caea
+
+
+async def stamp(db: AsyncSession, db_invoice: Invoice) -> bool:
+    # Asigna localmente el CAEA vigente, sin llamar a AFIP; el comprobante se informa después
+    if db_invoice.invoice_number and not str(db_invoice.invoice_number).isdigit():
+        return False
+    try:
+        voucher_type = cae.voucher_type_code(db_invoice.invoice_type)
+    except cae.CaeError:
+        return False
+    period, fortnight = period_for(db_invoice.date)
+    stmt = (
+        select(Caea, User.cuit)
+        .join(User, User.user_id == Caea.user_id)
+        .where(
+            User.user_id == db_invoice.user_id,
+            User.caea_enabled.is_(True),
+            Caea.period == period,
+            Caea.fortnight == fortnight,
+        )
+    )
+    row = (await db.execute(stmt)).one_or_none()
+    if not row or not (row.Caea.valid_from <= db_invoice.date < row.Caea.valid_to + timedelta(days=1)):
+        return False
+    db_caea = row.Caea
+    if not db_invoice.invoice_number:
+        key = (row.cuit, db_invoice.point_of_sale, voucher_type)
+        seed = numbering.afip_seed(db_invoice.user_id, db_invoice.point_of_sale, voucher_type)
+        db_invoice.invoice_number = str((await numbering.allocator.allocate(key, 1, seed))[0])
+    db_invoice.cae = db_caea.code
+    db_invoice.cae_expiration_date = db_caea.valid_to
+    db_invoice.emission_type = "CAEA"
+    db_invoice.status = "authorized"
+    return True
+
+
+async def get_pending_reports(db: AsyncSession, user_id: int):
+    stmt = (
+        select(Invoice)
+        .where(
+            Invoice.user_id == user_id,
+            Invoice.emission_type == "CAEA",
+            Invoice.status == "authorized",
+            Invoice.caea_reported_at.is_(None),
+        )
+        .order_by(Invoice.point_of_sale, Invoice.invoice_type, Invoice.invoice_id)
+    )
+    return (await db.execute(stmt)).scalars().all()
+
+
+# Tareas de fondo del modo CAEA: pide por adelantado el CAEA de la próxima quincena
+# para los usuarios que lo usan e informa a AFIP (FECAEARegInformativo) los
+# comprobantes emitidos con CAEA que todavía no fueron aceptados.
+class CaeaScheduler:
+    def __init__(self, interval: int = CAEA_REPORT_INTERVAL, session_factory=async_session):
+        self.interval = interval
+        self.session_factory = session_factory
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.prefetch()
+                await self.report()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error en la tarea de CAEA: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def prefetch(self):
+        now = datetime.utcnow()
+        wanted = [period_for(now)]
+        upcoming = next_period(*wanted[0])
+        if fortnight_start(*upcoming) - now <= timedelta(days=CAEA_PREFETCH_DAYS):
+            wanted.append(upcoming)
+
+        async with self.session_factory() as db:
+            user_ids = (await db.execute(select(User.user_id).where(User.caea_enabled.is_(True)))).scalars().all()
+            for user_id in user_ids:
+                for period, fortnight in wanted:
+                    try:
+                        await ensure_caea(db, user_id, period, fortnight)
+                    except Exception as e:
+                        await db.rollback()
+                        logger.error("No se pudo obtener el CAEA %s/%s del usuario %s: %s", period, fortnight, user_id, e)
+
+    async def report(self):
+        # Se leen las facturas y se cierra la sesión antes de llamar a AFIP; cada lote se
+        # guarda en su propia transacción
+        async with self.session_factory() as db:
+            stmt = (
+                select(Invoice, Client.cuit)
+                .outerjoin(Client, Invoice.client_id == Client.client_id)
+                .where(
+                    Invoice.emission_type == "CAEA",
+                    Invoice.status == "authorized",
+                    Invoice.caea_reported_at.is_(None),
+                )
+                .order_by(Invoice.user_id, Invoice.point_of_sale, Invoice.invoice_type, Invoice.invoice_id)
+            )
+            rows = (await db.execute(stmt)).all()
+            if not rows:
+                return
+            vat_lines = await cae.load_vat_lines(db, [invoice.invoice_id for invoice, _ in rows])
+            certificates = {}
+            for user_id in {invoice.user_id for invoice, _ in rows}:
+                certificates[user_id] = await crud.get_latest_certificate(db, user_id)
+
+        # Agrupar por código de comprobante: "A" y "1" son el mismo tipo para AFIP
+        groups = {}
+        invalid = []
+        for invoice, client_cuit in rows:
+            try:
+                voucher_type = cae.voucher_type_code(invoice.invoice_type)
+            except cae.CaeError as e:
+                invalid.append({"invoice_id": invoice.invoice_id, "caea_report_error": str(e)})
+                continue
+            groups.setdefault((invoice.user_id, invoice.point_of_sale, voucher_type), []).append((invoice, client_cuit))
+        await self._save(invalid)
+
+        for (user_id, point_of_sale, voucher_type), entries in groups.items():
+            certificate = certificates[user_id]
+            if not certificate:
+                continue
+            try:
+                await self._report_group(certificate, point_of_sale, voucher_type, entries, vat_lines)
+            except Exception as e:
+                logger.error("Error al informar CAEA (usuario=%s, pto_vta=%s, tipo=%s): %s", user_id, point_of_sale, voucher_type, e)
+
+    async def _save(self, updates: list):
+        if not updates:
+            return
+        async with self.session_factory() as db:
+            await db.execute(update(Invoice), updates)
+            await db.commit()
+
+    async def _report_group(self, certificate, point_of_sale: int, voucher_type: int, entries: list, vat_lines: dict):
+        afip = await ticket_cache.client_for(certificate, "wsfe")
+        # El número se lee una sola vez: uno editado a mano (vacío o no numérico) se marca
+        # con error y no frena al resto del grupo
+        numbered = []
+        invalid = []
+        for invoice, client_cuit in entries:
+            number = str(invoice.invoice_number or "").strip()
+            if not number.isdigit():
+                invalid.append({"invoice_id": invoice.invoice_id,
+                                "caea_report_error": f"Número de comprobante inválido: {invoice.invoice_number!r}"})
+                continue
+            numbered.append((int(number), invoice, client_cuit))
+        await self._save(invalid)
+        numbered.sort(key=lambda entry: entry[0])
+        for start in range(0, len(numbered), cae.AFIP_CAE_BATCH_SIZE):
+            updates = []
+            details = []
+            reported = []
+            for number, invoice, client_cuit in numbered[start:start + cae.AFIP_CAE_BATCH_SIZE]:
+                try:
+                    detail = cae.build_voucher_detail(invoice, client_cuit, vat_lines.get(invoice.invoice_id, []),
+                                                      voucher_type, number)
+                except cae.CaeError as e:
+                    # Un comprobante con datos inválidos no frena al resto del grupo
+                    updates.append({"invoice_id": invoice.invoice_id, "caea_report_error": str(e)})
+                    continue
+                detail["CAEA"] = invoice.cae
+                details.append(detail)
+                reported.append(invoice)
+            if not details:
+                await self._save(updates)
+                continue
+
+            try:
+                response = await gateway.call(_report, afip, point_of_sale, voucher_type, details,
+                                              service="wsfe", cuit=certificate.user.cuit)
+            finally:
+                # Los lotes anteriores ya quedaron guardados; de este, al menos los errores propios
+                await self._save(updates)
+            by_number = {int(item["CbteDesde"]): item
+                         for item in cae.as_list((response.get("FeDetResp") or {}).get("FECAEADetResponse"))}
+            now = datetime.utcnow()
+            updates = []
+            for detail, invoice in zip(details, reported):
+                item = by_number.get(detail["CbteDesde"], {})
+                if item.get("Resultado") == "A":
+                    updates.append({"invoice_id": invoice.invoice_id, "caea_reported_at": now, "caea_report_error": None})
+                else:
+                    errors = cae.messages(item.get("Observaciones"), "Obs") + cae.messages(response.get("Errors"), "Err")
+                    updates.append({"invoice_id": invoice.invoice_id,
+                                    "caea_report_error": "; ".join(errors) or "Comprobante no aceptado por AFIP"})
+            await self._save(updates)
+
+caea_scheduler = CaeaScheduler()
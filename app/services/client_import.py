@@ -0,0 +1,218 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import insert, update, func
+from sqlalchemy.dialects import postgresql, sqlite
+from pydantic import ValidationError
+from decouple import config
+from app import crud, schemas
+from app.models import Client
+from app.database import release_connection
+from app.cache import cache
+from app.services.padron import padron_cache
+import codecs
+import csv
+import io
+import json
+import logging
+import tempfile
+
+# Filas por INSERT ... ON CONFLICT
+CLIENT_IMPORT_CHUNK_SIZE = config("CLIENT_IMPORT_CHUNK_SIZE", default=500, cast=int)
+# Errores de validación que se devuelven en la respuesta
+CLIENT_IMPORT_MAX_ERRORS = config("CLIENT_IMPORT_MAX_ERRORS", default=100, cast=int)
+# Bytes del archivo CSV que se guardan en memoria antes de pasar a un archivo temporal
+CLIENT_IMPORT_SPOOL_SIZE = config("CLIENT_IMPORT_SPOOL_SIZE", default=8 * 1024 * 1024, cast=int)
+
+FORMATS = ("csv", "ndjson")
+COLUMNS = ("name", "cuit", "tax_condition", "email", "phone", "address", "is_active")
+
+logger = logging.getLogger(__name__)
+
+
+class ClientImportError(Exception):
+    pass
+
+
+async def _lines(chunks):
+    # Separa en líneas el cuerpo de la petición a medida que llega
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def _spool(chunks):
+    # El cuerpo se copia a un archivo temporal (en memoria hasta CLIENT_IMPORT_SPOOL_SIZE)
+    # para que un único csv.reader lo lea de corrido: así resuelve él mismo los campos entre
+    # comillas que ocupan varias líneas
+    spool = tempfile.SpooledTemporaryFile(max_size=CLIENT_IMPORT_SPOOL_SIZE)
+    try:
+        async for chunk in chunks:
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return io.TextIOWrapper(spool, encoding="utf-8-sig", errors="replace", newline="")
+
+
+async def _csv_rows(chunks):
+    # Devuelve (número de la primera línea, valores) por registro, o (línea, error) si el
+    # registro está mal formado (comillas sin cerrar, texto después de unas comillas de cierre)
+    with await _spool(chunks) as source:
+        reader = csv.reader(source, strict=True)
+        while True:
+            start = reader.line_num + 1
+            try:
+                values = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                yield start, f"CSV inválido en la línea {reader.line_num}: {e}"
+                continue
+            # Líneas en blanco: [] o un único campo vacío
+            if len(values) > 1 or (values and values[0].strip()):
+                yield start, values
+
+
+async def _records(chunks, import_format: str):
+    # Devuelve (número de línea, dict) o (número de línea, error de formato)
+    if import_format == "ndjson":
+        number = 0
+        async for line in _lines(chunks):
+            number += 1
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield number, f"JSON inválido: {e}"
+                continue
+            yield (number, record) if isinstance(record, dict) else (number, "Se esperaba un objeto JSON")
+        return
+
+    header = None
+    async for number, values in _csv_rows(chunks):
+        if isinstance(values, str):
+            yield number, values
+            continue
+        if header is None:
+            header = [value.strip().lower() for value in values]
+            if "name" not in header and "cuit" not in header:
+                raise ClientImportError("El CSV debe tener una columna 'name' o 'cuit'")
+            continue
+        if len(values) != len(header):
+            yield number, f"Se esperaban {len(header)} columnas y hay {len(values)}"
+            continue
+        yield number, {key: value.strip() or None for key, value in zip(header, values) if key in COLUMNS}
+
+
+def _upsert(dialect: str, rows: list):
+    # Los valores que no vienen en el archivo no pisan los que ya tiene el cliente
+    module = {"postgresql": postgresql, "sqlite": sqlite}.get(dialect)
+    if module is None:
+        return None
+    stmt = module.insert(Client).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[Client.user_id, Client.cuit],
+        set_={
+            column: func.coalesce(getattr(stmt.excluded, column), getattr(Client, column))
+            for column in COLUMNS if column != "cuit"
+        },
+    )
+
+
+async def _save(db: AsyncSession, rows: list):
+    with_cuit = list({row["cuit"]: row for row in rows if row["cuit"]}.values())
+    without_cuit = [row for row in rows if not row["cuit"]]
+    if with_cuit:
+        stmt = _upsert(db.bind.dialect.name, with_cuit)
+        if stmt is not None:
+            await db.execute(stmt)
+        else:
+            user_id = with_cuit[0]["user_id"]
+            existing = dict((await db.execute(
+                select(Client.cuit, Client.client_id)
+                .where(Client.user_id == user_id, Client.cuit.in_([row["cuit"] for row in with_cuit]))
+            )).all())
+            updates = [
+                {"client_id": existing[row["cuit"]], **{k: v for k, v in row.items() if v is not None}}
+                for row in with_cuit if row["cuit"] in existing
+            ]
+            if updates:
+                await db.execute(update(Client), updates)
+            without_cuit += [row for row in with_cuit if row["cuit"] not in existing]
+    if without_cuit:
+        await db.execute(insert(Client), without_cuit)
+    await db.commit()
+    # El upsert no devuelve qué filas cambió: se descartan los clientes cacheados
+    await cache.invalidate_prefix("client:")
+
+
+async def import_clients(db: AsyncSession, user_id: int, chunks, import_format: str = "csv",
+                         enrich: bool = True) -> dict:
+    if import_format not in FORMATS:
+        raise ClientImportError(f"Formato desconocido: '{import_format}'")
+    certificate = await crud.get_latest_certificate(db, user_id) if enrich else None
+    await release_connection(db)
+    summary = {"received": 0, "imported": 0, "enriched": 0, "failed": 0, "errors": []}
+
+    def fail(line: int, error: str):
+        summary["failed"] += 1
+        if len(summary["errors"]) < CLIENT_IMPORT_MAX_ERRORS:
+            summary["errors"].append({"line": line, "error": error})
+
+    async def flush(batch: list):
+        if certificate:
+            # Solo se consulta el padrón por las filas a las que les falta algún dato
+            cuits = [row.cuit for _, row in batch
+                     if row.cuit and not (row.name and row.tax_condition and row.address)]
+            entries = await padron_cache.lookup(certificate, cuits)
+        else:
+            entries = {}
+
+        rows = []
+        for line, row in batch:
+            values = row.model_dump()
+            entry = entries.get(row.cuit)
+            if entry and entry.found:
+                filled = False
+                for column in ("name", "tax_condition", "address"):
+                    if not values[column] and getattr(entry, column):
+                        values[column] = getattr(entry, column)
+                        filled = True
+                summary["enriched"] += filled
+            if not values["name"]:
+                fail(line, "Falta el nombre y no se encontró el CUIT en el padrón")
+                continue
+            rows.append({"user_id": user_id, **values})
+        if rows:
+            await _save(db, rows)
+            summary["imported"] += len(rows)
+
+    batch = []
+    async for line, record in _records(chunks, import_format):
+        summary["received"] += 1
+        if isinstance(record, str):
+            fail(line, record)
+            continue
+        try:
+            row = schemas.ClientImportRow.model_validate(record)
+        except ValidationError as e:
+            fail(line, "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()))
+            continue
+        batch.append((line, row))
+        if len(batch) >= CLIENT_IMPORT_CHUNK_SIZE:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    logger.info("Importación de clientes del usuario %s: %s recibidos, %s importados, %s con error",
+                user_id, summary["received"], summary["imported"], summary["failed"])
+    return summary
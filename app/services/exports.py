@@ -0,0 +1,296 @@
+from sqlalchemy.future import select
+from decouple import config
+from decimal import Decimal, ROUND_HALF_UP
+from datetime import datetime
+from app.database import async_session
+from app.models import Invoice, InvoiceItem, Client, User
+from app.services import cae
+from app import serialization
+import csv
+import io
+import logging
+import zlib
+
+# Filas que se piden por vez al cursor del servidor
+EXPORT_FETCH_SIZE = config("EXPORT_FETCH_SIZE", default=1000, cast=int)
+# Bytes que se acumulan antes de enviar un bloque de la respuesta
+EXPORT_CHUNK_SIZE = config("EXPORT_CHUNK_SIZE", default=64 * 1024, cast=int)
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    # Libro IVA Digital, ventas: archivo de comprobantes y archivo de alícuotas
+    "libro_iva": ("text/plain; charset=iso-8859-1", "txt"),
+    "libro_iva_alicuotas": ("text/plain; charset=iso-8859-1", "txt"),
+}
+
+INVOICE_COLUMNS = (
+    Invoice.invoice_id, Invoice.date, Invoice.invoice_type, Invoice.point_of_sale, Invoice.invoice_number,
+    Invoice.total_amount, Invoice.net_amount, Invoice.tax_amount, Invoice.cae, Invoice.cae_expiration_date,
+    Invoice.status, Invoice.emission_type,
+)
+CLIENT_COLUMNS = (Client.name.label("client_name"), Client.cuit.label("client_cuit"))
+ITEM_COLUMNS = (
+    InvoiceItem.item_id, InvoiceItem.description, InvoiceItem.quantity, InvoiceItem.unit_price,
+    InvoiceItem.total_price, InvoiceItem.tax_rate, InvoiceItem.tax_amount.label("item_tax_amount"),
+)
+CSV_HEADER = [column.key for column in INVOICE_COLUMNS + CLIENT_COLUMNS + ITEM_COLUMNS]
+# Cada fila del export es (factura..., cliente..., ítem...): el NDJSON toma los tramos por posición
+_INVOICE_WIDTH = len(INVOICE_COLUMNS) + len(CLIENT_COLUMNS)
+# Los importes salen como texto ("121.50"), igual que en el CSV
+_invoice_members = serialization.members(tuple(CSV_HEADER[:_INVOICE_WIDTH]), decimal_as_string=True)
+_item_members = serialization.members(tuple(CSV_HEADER[_INVOICE_WIDTH:]), decimal_as_string=True)
+
+logger = logging.getLogger(__name__)
+
+
+class ExportError(Exception):
+    pass
+
+
+# Comprobantes que no se pueden volcar al Libro IVA (tipo o alícuota que AFIP no admite)
+class ExportDataError(ExportError):
+    def __init__(self, errors: list):
+        super().__init__(f"{len(errors)} comprobante(s) no se pueden exportar al Libro IVA")
+        self.errors = errors
+
+
+def period_range(period: int):
+    year, month = divmod(period, 100)
+    if not 1 <= month <= 12:
+        raise ExportError(f"Período inválido: {period}")
+    start = datetime(year, month, 1)
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return start, end
+
+
+def export_query(cuit: str, period: int, status: str = None):
+    start, end = period_range(period)
+    stmt = (
+        select(*INVOICE_COLUMNS, *CLIENT_COLUMNS, *ITEM_COLUMNS)
+        .join(User, User.user_id == Invoice.user_id)
+        .outerjoin(Client, Client.client_id == Invoice.client_id)
+        .outerjoin(InvoiceItem, InvoiceItem.invoice_id == Invoice.invoice_id)
+        .where(User.cuit == cuit, Invoice.date >= start, Invoice.date < end)
+        .order_by(Invoice.date, Invoice.invoice_id, InvoiceItem.item_id)
+    )
+    if status is not None:
+        stmt = stmt.where(Invoice.status == status)
+    return stmt
+
+
+async def _invoices(stmt, session_factory=async_session):
+    # Recorre el resultado con un cursor del servidor y agrupa las filas consecutivas de
+    # cada factura: en memoria solo queda la factura en curso
+    async with session_factory() as db:
+        result = await db.stream(stmt.execution_options(yield_per=EXPORT_FETCH_SIZE))
+        current = None
+        async for row in result:
+            if current is None or current["row"].invoice_id != row.invoice_id:
+                if current is not None:
+                    yield current
+                current = {"row": row, "items": []}
+            if row.item_id is not None:
+                current["items"].append(row)
+        if current is not None:
+            yield current
+
+
+# Formato CSV/NDJSON
+
+def _ndjson(invoice) -> str:
+    items = ",".join(["{" + _item_members(item[_INVOICE_WIDTH:]) + "}" for item in invoice["items"]])
+    return "{" + _invoice_members(invoice["row"][:_INVOICE_WIDTH]) + ',"items":[' + items + "]}\n"
+
+
+class _CsvWriter:
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator="\n")
+
+    def _flush(self) -> str:
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text
+
+    def header(self) -> str:
+        self.writer.writerow(CSV_HEADER)
+        return self._flush()
+
+    def invoice(self, invoice) -> str:
+        # Una fila por ítem; las facturas sin ítems salen en una sola fila
+        for item in invoice["items"] or [invoice["row"]]:
+            self.writer.writerow([
+                getattr(item if column in ITEM_COLUMNS else invoice["row"], column.key)
+                for column in INVOICE_COLUMNS + CLIENT_COLUMNS + ITEM_COLUMNS
+            ])
+        return self._flush()
+
+
+# Formato Libro IVA Digital (RG 4597): registros de ancho fijo, ventas
+
+def _num(value, width: int) -> str:
+    return str(int(value or 0)).zfill(width)[-width:]
+
+
+def _money(value, width: int = 15) -> str:
+    cents = (abs(Decimal(str(value or 0))) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP)
+    return str(int(cents)).zfill(width)[-width:]
+
+
+def _text(value, width: int) -> str:
+    return str(value or "")[:width].ljust(width)
+
+
+def _vat_lines(invoice) -> list:
+    row = invoice["row"]
+    lines = {}
+    for item in invoice["items"]:
+        rate = Decimal(str(item.tax_rate or 0))
+        base, amount = lines.get(rate, (Decimal("0"), Decimal("0")))
+        lines[rate] = (base + Decimal(str(item.total_price or 0)), amount + Decimal(str(item.item_tax_amount or 0)))
+    if not lines and row.tax_amount:
+        # Sin ítems: se deduce la alícuota de los totales del comprobante
+        net = Decimal(str(row.net_amount or 0))
+        rate = (Decimal(str(row.tax_amount)) * 100 / net).quantize(Decimal("0.1"), rounding=ROUND_HALF_UP) if net else Decimal("0")
+        lines[rate] = (net, Decimal(str(row.tax_amount)))
+    return [(rate, base, amount) for rate, (base, amount) in lines.items()]
+
+
+def _voucher(row):
+    voucher_type = cae.voucher_type_code(row.invoice_type)
+    number = int(row.invoice_number) if row.invoice_number and str(row.invoice_number).isdigit() else 0
+    return voucher_type, number
+
+
+def _libro_iva(invoice) -> str:
+    row = invoice["row"]
+    voucher_type, number = _voucher(row)
+    doc_number = "".join(ch for ch in (row.client_cuit or "") if ch.isdigit())
+    vat_lines = [] if voucher_type in cae.NO_VAT_VOUCHER_TYPES else _vat_lines(invoice)
+    return "".join([
+        row.date.strftime("%Y%m%d"),
+        _num(voucher_type, 3),
+        _num(row.point_of_sale, 5),
+        _num(number, 20),
+        _num(number, 20),
+        _num(cae.DOC_TYPE_CUIT if doc_number else cae.DOC_TYPE_FINAL_CONSUMER, 2),
+        _num(doc_number, 20),
+        _text(row.client_name, 30),
+        _money(row.total_amount),
+        _money(0),   # conceptos no gravados
+        _money(0),   # percepción a no categorizados
+        _money(0),   # operaciones exentas
+        _money(0),   # percepciones nacionales
+        _money(0),   # percepciones de ingresos brutos
+        _money(0),   # percepciones municipales
+        _money(0),   # impuestos internos
+        "PES",
+        "0001000000",
+        _num(len(vat_lines), 1),
+        " " if vat_lines else "N",
+        _money(0),   # otros tributos
+        "00000000",
+    ]) + "\r\n"
+
+
+def _libro_iva_alicuotas(invoice) -> str:
+    row = invoice["row"]
+    voucher_type, number = _voucher(row)
+    if voucher_type in cae.NO_VAT_VOUCHER_TYPES:
+        return ""
+    return "".join(
+        _num(voucher_type, 3) + _num(row.point_of_sale, 5) + _num(number, 20)
+        + _money(base) + _num(cae.vat_rate_id(rate), 4) + _money(amount) + "\r\n"
+        for rate, base, amount in _vat_lines(invoice)
+    )
+
+
+def _libro_iva_errors(invoice) -> list:
+    row = invoice["row"]
+    try:
+        voucher_type, _ = _voucher(row)
+        if voucher_type not in cae.NO_VAT_VOUCHER_TYPES:
+            for rate, _, _ in _vat_lines(invoice):
+                cae.vat_rate_id(rate)
+    except cae.CaeError as e:
+        return [{"invoice_id": row.invoice_id, "invoice_number": row.invoice_number, "error": str(e)}]
+    return []
+
+
+def _export_statement(cuit: str, period: int, export_format: str, status: str = None):
+    if export_format not in FORMATS:
+        raise ExportError(f"Formato desconocido: '{export_format}'")
+    if export_format.startswith("libro_iva"):
+        # El libro solo lleva comprobantes autorizados
+        status = "authorized"
+    return export_query(cuit, period, status)
+
+
+async def validate_export(cuit: str, period: int, export_format: str, status: str = None,
+                          session_factory=async_session, max_errors: int = 100):
+    # Una vez enviado el 200 ya no se puede informar un error: los comprobantes del Libro
+    # IVA se revisan antes de empezar el streaming
+    stmt = _export_statement(cuit, period, export_format, status)
+    if not export_format.startswith("libro_iva"):
+        return
+    errors = []
+    async for invoice in _invoices(stmt, session_factory):
+        errors.extend(_libro_iva_errors(invoice))
+        if len(errors) >= max_errors:
+            break
+    if errors:
+        raise ExportDataError(errors)
+
+
+def stream_export(cuit: str, period: int, export_format: str, status: str = None, compress: bool = False,
+                  session_factory=async_session):
+    stmt = _export_statement(cuit, period, export_format, status)
+    libro_iva = export_format.startswith("libro_iva")
+    encoding = "iso-8859-1" if libro_iva else "utf-8"
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+
+    async def generate():
+        pending = []
+        size = 0
+
+        def emit(text: str):
+            nonlocal size
+            data = text.encode(encoding, errors="replace")
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                pending.append(data)
+                size += len(data)
+
+        def drain() -> bytes:
+            nonlocal size
+            data = b"".join(pending)
+            pending.clear()
+            size = 0
+            return data
+
+        if export_format == "csv":
+            writer = _CsvWriter()
+            emit(writer.header())
+            render = writer.invoice
+        else:
+            render = {"ndjson": _ndjson, "libro_iva": _libro_iva, "libro_iva_alicuotas": _libro_iva_alicuotas}[export_format]
+
+        async for invoice in _invoices(stmt, session_factory):
+            errors = _libro_iva_errors(invoice) if libro_iva else None
+            if errors:
+                # Cambió después de validate_export: no se puede cortar el archivo a mitad de camino
+                logger.warning("Comprobante %s omitido del Libro IVA: %s", invoice["row"].invoice_id, errors[0]["error"])
+                continue
+            emit(render(invoice))
+            if size >= EXPORT_CHUNK_SIZE:
+                yield drain()
+        if compressor:
+            pending.append(compressor.flush())
+        data = drain()
+        if data:
+            yield data
+
+    return generate()
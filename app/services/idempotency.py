@@ -0,0 +1,215 @@
+from fastapi import Response
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from decouple import config
+from datetime import datetime, timedelta
+from app import serialization
+from app.database import async_session
+from app.metrics import registry
+from app.models import IdempotencyKey
+import asyncio
+import hashlib
+import json
+import logging
+
+# Cuánto se guarda la respuesta de una petición con Idempotency-Key
+IDEMPOTENCY_TTL = config("IDEMPOTENCY_TTL", default=86400, cast=int)
+# Una clave en curso que no se completa en este tiempo (el proceso murió) se libera
+IDEMPOTENCY_LOCK_TIMEOUT = config("IDEMPOTENCY_LOCK_TIMEOUT", default=300, cast=int)
+# Cada cuántos segundos se borran las claves vencidas
+IDEMPOTENCY_PURGE_INTERVAL = config("IDEMPOTENCY_PURGE_INTERVAL", default=600, cast=int)
+MAX_KEY_LENGTH = 255
+
+# Headers de la respuesta original que se repiten al devolverla de nuevo
+_STORED_HEADERS = ("content-type", "location", "retry-after")
+
+logger = logging.getLogger(__name__)
+
+idempotent_requests = registry.counter(
+    "idempotent_requests_total", "Peticiones con Idempotency-Key por resultado", ("result",))
+
+
+class IdempotencyError(Exception):
+    status_code = 400
+
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# La petición original con la misma clave todavía no terminó (en otro proceso)
+class IdempotencyConflictError(IdempotencyError):
+    status_code = 409
+
+
+# La clave ya se usó con otro cuerpo
+class IdempotencyMismatchError(IdempotencyError):
+    status_code = 422
+
+
+def fingerprint(*parts) -> str:
+    # Hash del cuerpo de la petición (modelos de pydantic y parámetros)
+    values = [part.model_dump(mode="json") if hasattr(part, "model_dump") else part for part in parts]
+    return hashlib.sha256(serialization.dumps(values)).hexdigest()
+
+
+# Idempotency-Key para las altas de facturas y los pedidos de CAE.
+#
+# La primera petición con una clave la reserva (fila con status_code NULL), ejecuta el
+# handler y guarda su respuesta; los reintentos con la misma clave y el mismo cuerpo
+# reciben la respuesta guardada con una búsqueda por clave primaria, sin volver a tocar
+# la base ni AFIP. Los duplicados simultáneos en el mismo proceso esperan a la primera
+# petición en lugar de ir a la base; entre procesos, la clave primaria deja pasar a uno
+# solo y los demás reciben 409 hasta que termine.
+#
+# Si el handler falla (excepción o 5xx) la reserva se borra y la clave se puede reintentar.
+class IdempotencyStore:
+    def __init__(self, ttl: int = IDEMPOTENCY_TTL, lock_timeout: int = IDEMPOTENCY_LOCK_TIMEOUT,
+                 purge_interval: int = IDEMPOTENCY_PURGE_INTERVAL, session_factory=async_session):
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.purge_interval = purge_interval
+        self.session_factory = session_factory
+        self._inflight = {}
+        self._task = None
+
+    async def run(self, key: str, endpoint: str, request_hash: str, handler) -> Response:
+        # handler: corrutina sin argumentos que devuelve la Response de la petición;
+        # endpoint: método y path concretos ("POST /api/v1/invoices/"), el alcance de la clave
+        if key is None:
+            return await handler()
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise IdempotencyError(f"Idempotency-Key must have between 1 and {MAX_KEY_LENGTH} characters")
+
+        ident = (endpoint, key)
+        while True:
+            waiter = self._inflight.get(ident)
+            if waiter is not None:
+                # Misma clave en curso en este proceso: se espera su resultado
+                idempotent_requests.inc(result="coalesced")
+                stored = await asyncio.shield(waiter)
+                if stored is None:
+                    # La original falló y liberó la clave: se vuelve a intentar
+                    continue
+                return self._replay(stored, request_hash)
+
+            stored = await self._lookup(ident)
+            if stored is not None and stored.expires_at > datetime.utcnow():
+                return self._replay(stored, request_hash)
+
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[ident] = future
+            try:
+                if not await self._claim(ident, request_hash, expired=stored is not None):
+                    # Otro proceso la reservó entre la búsqueda y el alta
+                    future.set_result(None)
+                    continue
+                return await self._execute(ident, request_hash, handler, future)
+            finally:
+                if not future.done():
+                    future.set_result(None)
+                self._inflight.pop(ident, None)
+
+    async def _execute(self, ident: tuple, request_hash: str, handler, future) -> Response:
+        idempotent_requests.inc(result="executed")
+        try:
+            response = await handler()
+        except BaseException:
+            await self._release(ident)
+            raise
+        if response.status_code >= 500:
+            await self._release(ident)
+            return response
+        try:
+            future.set_result(await self._complete(ident, request_hash, response))
+        except Exception as e:
+            # La petición ya se hizo: se responde igual y la reserva vence con lock_timeout
+            logger.warning("No se pudo guardar la respuesta de la Idempotency-Key %s: %s", ident[1], e)
+        return response
+
+    def _replay(self, stored: IdempotencyKey, request_hash: str) -> Response:
+        if stored.request_hash != request_hash:
+            idempotent_requests.inc(result="mismatch")
+            raise IdempotencyMismatchError("Idempotency-Key was already used with a different request")
+        if stored.status_code is None:
+            idempotent_requests.inc(result="conflict")
+            raise IdempotencyConflictError("A request with this Idempotency-Key is still in progress", retry_after=1)
+        idempotent_requests.inc(result="replayed")
+        headers = dict(json.loads(stored.response_headers or "[]"))
+        headers["Idempotent-Replayed"] = "true"
+        return Response(stored.response_body or b"", status_code=stored.status_code, headers=headers)
+
+    async def _lookup(self, ident: tuple):
+        async with self.session_factory() as session:
+            return await session.get(IdempotencyKey, ident)
+
+    async def _claim(self, ident: tuple, request_hash: str, expired: bool = False) -> bool:
+        endpoint, key = ident
+        now = datetime.utcnow()
+        async with self.session_factory() as session:
+            if expired:
+                # Una reserva o respuesta vencida que todavía no borró purge() no bloquea la clave
+                await session.execute(delete(IdempotencyKey).where(
+                    IdempotencyKey.endpoint == endpoint, IdempotencyKey.key == key, IdempotencyKey.expires_at <= now))
+            session.add(IdempotencyKey(endpoint=endpoint, key=key, request_hash=request_hash,
+                                       expires_at=now + timedelta(seconds=self.lock_timeout)))
+            try:
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                return False
+        return True
+
+    async def _complete(self, ident: tuple, request_hash: str, response: Response) -> IdempotencyKey:
+        endpoint, key = ident
+        headers = [(name.decode("latin-1"), value.decode("latin-1")) for name, value in response.raw_headers
+                   if name.decode("latin-1") in _STORED_HEADERS]
+        values = {"status_code": response.status_code, "response_headers": json.dumps(headers),
+                  "response_body": response.body.decode("utf-8"),
+                  "expires_at": datetime.utcnow() + timedelta(seconds=self.ttl)}
+        async with self.session_factory() as session:
+            await session.execute(update(IdempotencyKey).where(
+                IdempotencyKey.endpoint == endpoint, IdempotencyKey.key == key).values(**values))
+            await session.commit()
+        return IdempotencyKey(endpoint=endpoint, key=key, request_hash=request_hash, **values)
+
+    async def _release(self, ident: tuple):
+        endpoint, key = ident
+        try:
+            async with self.session_factory() as session:
+                await session.execute(delete(IdempotencyKey).where(
+                    IdempotencyKey.endpoint == endpoint, IdempotencyKey.key == key))
+                await session.commit()
+        except Exception as e:
+            # La reserva vence sola después de lock_timeout
+            logger.warning("No se pudo liberar la Idempotency-Key %s: %s", key, e)
+
+    async def purge(self) -> int:
+        async with self.session_factory() as session:
+            result = await session.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at <= datetime.utcnow()))
+            await session.commit()
+        return result.rowcount
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                purged = await self.purge()
+                if purged:
+                    logger.info("Idempotency-Keys vencidas borradas: %s", purged)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error al borrar Idempotency-Keys vencidas: %s", e)
+            await asyncio.sleep(self.purge_interval)
+
+
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,182 @@
+from sqlalchemy.future import select
+from sqlalchemy import update, or_, and_
+from decouple import config
+from datetime import datetime, timedelta
+from app.database import async_session
+from app.models import CaeJob, Invoice, User
+from app.services import cae, sales
+import asyncio
+import logging
+
+CAE_JOB_WORKERS = config("CAE_JOB_WORKERS", default=2, cast=int)
+CAE_JOB_BATCH_SIZE = config("CAE_JOB_BATCH_SIZE", default=100, cast=int)
+# Lotes de CAE simultáneos por CUIT emisor
+CAE_JOB_PER_CUIT = config("CAE_JOB_PER_CUIT", default=1, cast=int)
+CAE_JOB_MAX_ATTEMPTS = config("CAE_JOB_MAX_ATTEMPTS", default=5, cast=int)
+CAE_JOB_POLL_INTERVAL = config("CAE_JOB_POLL_INTERVAL", default=2.0, cast=float)
+# Un job "running" sin novedades por más de este tiempo se considera abandonado
+CAE_JOB_LOCK_TIMEOUT = config("CAE_JOB_LOCK_TIMEOUT", default=600, cast=int)
+
+logger = logging.getLogger(__name__)
+
+
+# Pool de workers asyncio que vacía la tabla cae_job sin broker externo.
+#
+# Cada worker toma un lote de jobs de un mismo CUIT, pide los CAE con
+# cae.issue_invoices y registra el resultado. Los errores transitorios se
+# reintentan con backoff exponencial hasta CAE_JOB_MAX_ATTEMPTS.
+class CaeWorkerPool:
+    def __init__(self, workers: int = CAE_JOB_WORKERS, batch_size: int = CAE_JOB_BATCH_SIZE,
+                 per_cuit: int = CAE_JOB_PER_CUIT, session_factory=async_session):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.per_cuit = per_cuit
+        self.session_factory = session_factory
+        self._tasks = []
+        self._busy = {}
+        self._wakeup = asyncio.Event()
+
+    def start(self):
+        for number in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(number)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        # Despierta a los workers sin esperar al próximo sondeo
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {"workers": len(self._tasks), "busy_cuits": dict(self._busy)}
+
+    async def _worker(self, number: int):
+        while True:
+            try:
+                claimed = await self._claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Worker %s: error al tomar jobs: %s", number, e)
+                claimed = None
+
+            if not claimed:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), CAE_JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            cuit, jobs = claimed
+            try:
+                await self._process(jobs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Worker %s: error al procesar jobs del CUIT %s: %s", number, cuit, e)
+            finally:
+                self._release(cuit)
+
+    def _release(self, cuit: str):
+        self._busy[cuit] -= 1
+        if not self._busy[cuit]:
+            del self._busy[cuit]
+
+    def _claimable(self, now: datetime):
+        return or_(
+            and_(CaeJob.status == "queued", CaeJob.available_at <= now),
+            and_(CaeJob.status == "running", CaeJob.locked_at < now - timedelta(seconds=CAE_JOB_LOCK_TIMEOUT)),
+        )
+
+    async def _claim(self):
+        now = datetime.utcnow()
+        async with self.session_factory() as db:
+            stmt = (
+                select(User.cuit)
+                .join(CaeJob, CaeJob.user_id == User.user_id)
+                .where(self._claimable(now))
+                .group_by(User.cuit)
+                .limit(50)
+            )
+            candidates = (await db.execute(stmt)).scalars().all()
+            # Se reserva el CUIT antes de volver a esperar a la base
+            cuit = next((c for c in candidates if self._busy.get(c, 0) < self.per_cuit), None)
+            if cuit is None:
+                return None
+            self._busy[cuit] = self._busy.get(cuit, 0) + 1
+
+            try:
+                stmt = (
+                    select(CaeJob.job_id)
+                    .join(User, CaeJob.user_id == User.user_id)
+                    .where(User.cuit == cuit, self._claimable(now))
+                    .order_by(CaeJob.job_id)
+                    .limit(self.batch_size)
+                    .with_for_update(skip_locked=True, of=CaeJob)
+                )
+                job_ids = (await db.execute(stmt)).scalars().all()
+                claimed = []
+                if job_ids:
+                    # El WHERE repetido evita tomar jobs que otro worker reclamó en el medio
+                    stmt = (
+                        update(CaeJob)
+                        .where(CaeJob.job_id.in_(job_ids), self._claimable(now))
+                        .values(status="running", locked_at=now, attempts=CaeJob.attempts + 1)
+                        .returning(CaeJob.job_id, CaeJob.invoice_id, CaeJob.attempts)
+                        .execution_options(synchronize_session=False)
+                    )
+                    claimed = (await db.execute(stmt)).all()
+                await db.commit()
+            except BaseException:
+                self._release(cuit)
+                raise
+
+        if not claimed:
+            self._release(cuit)
+            return None
+        return cuit, claimed
+
+    async def _process(self, jobs: list):
+        invoice_ids = [job.invoice_id for job in jobs]
+        async with self.session_factory() as db:
+            try:
+                results = await cae.issue_invoices(db, invoice_ids)
+            except Exception as e:
+                await db.rollback()
+                results = [{"invoice_id": invoice_id, "status": "error", "errors": [str(e)]} for invoice_id in invoice_ids]
+
+            by_invoice = {r["invoice_id"]: r for r in results}
+            now = datetime.utcnow()
+            job_updates = []
+            reset_invoices = []
+            for job in jobs:
+                result = by_invoice.get(job.invoice_id, {"status": "error", "errors": ["Sin resultado"]})
+                errors = "; ".join(result.get("errors") or []) or None
+                if result.get("retry_after"):
+                    # Circuito abierto o rate limit: no cuenta como intento
+                    job_updates.append({"job_id": job.job_id, "status": "queued", "last_error": errors, "locked_at": None,
+                                        "attempts": job.attempts - 1,
+                                        "available_at": now + timedelta(seconds=result["retry_after"])})
+                elif result["status"] in ("authorized", "rejected", "skipped"):
+                    job_updates.append({"job_id": job.job_id, "status": "done", "result": result["status"],
+                                        "last_error": errors, "locked_at": None})
+                elif job.attempts < CAE_JOB_MAX_ATTEMPTS:
+                    job_updates.append({"job_id": job.job_id, "status": "queued", "last_error": errors, "locked_at": None,
+                                        "available_at": now + timedelta(seconds=2 ** job.attempts)})
+                else:
+                    job_updates.append({"job_id": job.job_id, "status": "failed", "last_error": errors, "locked_at": None})
+                    reset_invoices.append({"invoice_id": job.invoice_id, "status": "draft"})
+
+            await db.execute(update(CaeJob), job_updates)
+            if reset_invoices:
+                # Sin CAE después de todos los intentos: la factura vuelve a borrador
+                await sales.record_status(db, {r["invoice_id"]: "draft" for r in reset_invoices})
+                await db.execute(update(Invoice), reset_invoices)
+            await db.commit()
+
+
+job_pool = CaeWorkerPool()
@@ -0,0 +1,196 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from decouple import config
+from app.models import Certificate
+import asyncio
+import base64
+import hashlib
+import random
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.serialization import pkcs7
+except ImportError:
+    x509 = None
+
+# Máximo de certificados con la clave ya parseada en memoria (por proceso)
+KEYSTORE_MAX_ENTRIES = config("KEYSTORE_MAX_ENTRIES", default=1000, cast=int)
+# Procesos que firman los TRA; con 0 se firma en un hilo del proceso
+KEYSTORE_SIGN_WORKERS = config("KEYSTORE_SIGN_WORKERS", default=2, cast=int)
+# Vigencia del TRA (loginTicketRequest) que se firma para WSAA
+AFIP_TRA_TTL = config("AFIP_TRA_TTL", default=600, cast=int)
+
+
+class KeystoreError(Exception):
+    pass
+
+
+def _require_cryptography():
+    if x509 is None:
+        raise KeystoreError("Para firmar localmente hace falta instalar el paquete 'cryptography'")
+
+
+def fingerprint(cert_pem: str, key_pem: str) -> str:
+    # Identifica el material del certificado: si cambia, la entrada cacheada no sirve
+    return hashlib.sha256(f"{cert_pem}\0{key_pem}".encode()).hexdigest()
+
+
+def _parse(cert_pem: str, key_pem: str):
+    _require_cryptography()
+    try:
+        cert = x509.load_pem_x509_certificate(cert_pem.encode())
+        key = serialization.load_pem_private_key(key_pem.encode(), password=None)
+    except ValueError as e:
+        raise KeystoreError(f"Certificado o clave privada inválidos: {e}")
+    return cert, key
+
+
+def _not_valid_after(cert) -> datetime:
+    # UTC sin zona, como el resto de las fechas de la base
+    value = getattr(cert, "not_valid_after_utc", None)
+    if value is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return cert.not_valid_after
+
+
+def _sign(cert, key, payload: bytes) -> str:
+    # CMS (PKCS#7) con el contenido incluido, en base64: lo que espera loginCms de WSAA
+    cms = (
+        pkcs7.PKCS7SignatureBuilder()
+        .set_data(payload)
+        .add_signer(cert, key, hashes.SHA256())
+        .sign(serialization.Encoding.DER, [])
+    )
+    return base64.b64encode(cms).decode()
+
+
+def build_tra(service: str, now: datetime = None, ttl: int = AFIP_TRA_TTL) -> bytes:
+    now = (now or datetime.now(timezone.utc)).replace(microsecond=0)
+    generation = (now - timedelta(seconds=60)).isoformat()
+    expiration = (now + timedelta(seconds=ttl)).isoformat()
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<loginTicketRequest version="1.0">'
+        f"<header><uniqueId>{random.randint(1, 2 ** 31 - 1)}</uniqueId>"
+        f"<generationTime>{generation}</generationTime>"
+        f"<expirationTime>{expiration}</expirationTime></header>"
+        f"<service>{service}</service>"
+        "</loginTicketRequest>"
+    ).encode()
+
+
+# Claves parseadas dentro de cada proceso del pool: los objetos de clave no se pueden
+# enviar entre procesos, así que cada worker parsea el PEM una vez y lo reutiliza
+_worker_keys = OrderedDict()
+
+
+def _sign_in_worker(key_id: str, cert_pem: str, key_pem: str, payloads: list) -> list:
+    entry = _worker_keys.get(key_id)
+    if entry is None:
+        entry = _worker_keys[key_id] = _parse(cert_pem, key_pem)
+        while len(_worker_keys) > KEYSTORE_MAX_ENTRIES:
+            _worker_keys.popitem(last=False)
+    else:
+        _worker_keys.move_to_end(key_id)
+    cert, key = entry
+    return [_sign(cert, key, payload) for payload in payloads]
+
+
+# Material criptográfico de los certificados, parseado una sola vez.
+#
+# Certificate.certificate y private_key se guardan como PEM; parsearlos en cada firma
+# del TRA es la parte cara. Las entradas se indexan por certificate_id, se descartan al
+# cambiar o borrar el certificado (crud llama a evict) y al llegar a su vencimiento, y
+# se limitan a max_entries con descarte LRU. Las firmas se hacen en un pool de procesos,
+# así varios logins a WSAA firman a la vez sin ocupar el event loop ni competir por el GIL.
+class KeyStore:
+    def __init__(self, max_entries: int = KEYSTORE_MAX_ENTRIES, workers: int = KEYSTORE_SIGN_WORKERS):
+        self.max_entries = max_entries
+        self.workers = workers
+        self._entries = OrderedDict()
+        self._executor = None
+        self.parses = 0
+        self.hits = 0
+        self.evictions = 0
+        self.signatures = 0
+
+    def _pool(self):
+        if self.workers <= 0:
+            return None
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def entry(self, certificate: Certificate) -> dict:
+        certificate_id = certificate.certificate_id
+        key_id = fingerprint(certificate.certificate, certificate.private_key)
+        entry = self._entries.get(certificate_id)
+        if entry is not None and entry["fingerprint"] == key_id:
+            if entry["expires_at"] <= datetime.utcnow():
+                self.evict(certificate_id)
+                raise KeystoreError(f"El certificado {certificate_id} está vencido")
+            self.hits += 1
+            self._entries.move_to_end(certificate_id)
+            return entry
+
+        # En cada parseo nuevo se aprovecha para soltar las claves de certificados vencidos
+        self.purge_expired()
+        cert, key = _parse(certificate.certificate, certificate.private_key)
+        self.parses += 1
+        expires_at = _not_valid_after(cert)
+        if certificate.expires_at is not None:
+            expires_at = min(expires_at, certificate.expires_at)
+        if expires_at <= datetime.utcnow():
+            raise KeystoreError(f"El certificado {certificate_id} está vencido")
+        entry = {"fingerprint": key_id, "cert": cert, "key": key, "expires_at": expires_at}
+        self._entries[certificate_id] = entry
+        self._entries.move_to_end(certificate_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def evict(self, certificate_id: int):
+        if self._entries.pop(certificate_id, None) is not None:
+            self.evictions += 1
+
+    def purge_expired(self):
+        now = datetime.utcnow()
+        for certificate_id in [cid for cid, entry in self._entries.items() if entry["expires_at"] <= now]:
+            self.evict(certificate_id)
+
+    async def sign_tra(self, certificate: Certificate, service: str) -> str:
+        # Valida vencimiento y material en el proceso principal; la firma CMS se hace fuera
+        # del event loop (en un hilo si no hay pool de procesos)
+        entry = self.entry(certificate)
+        payload = build_tra(service)
+        loop = asyncio.get_running_loop()
+        executor = self._pool()
+        if executor is None:
+            signature = await loop.run_in_executor(None, _sign, entry["cert"], entry["key"], payload)
+        else:
+            signature = (await loop.run_in_executor(executor, _sign_in_worker, entry["fingerprint"],
+                                                    certificate.certificate, certificate.private_key, [payload]))[0]
+        self.signatures += 1
+        return signature
+
+    def stats(self) -> dict:
+        return {
+            "available": x509 is not None,
+            "entries": len(self._entries),
+            "parses": self.parses,
+            "hits": self.hits,
+            "evictions": self.evictions,
+            "signatures": self.signatures,
+            "workers": self.workers if self._executor is not None else 0,
+        }
+
+
+keystore = KeyStore()
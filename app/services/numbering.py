@@ -0,0 +1,196 @@
+from sqlalchemy.future import select
+from sqlalchemy import update, delete
+from sqlalchemy.exc import IntegrityError
+from decouple import config
+from datetime import datetime, timedelta
+from app import crud
+from app.database import async_session
+from app.models import VoucherCounter, VoucherGap, Invoice, User
+from app.services.afip_gateway import gateway
+from app.services.tickets import ticket_cache
+import asyncio
+import logging
+
+# Números que se reservan de una vez en la base y se entregan desde memoria.
+# Con más de un proceso emitiendo en el mismo punto de venta conviene dejarlo en 1,
+# porque AFIP exige que los comprobantes se autoricen en orden correlativo.
+AFIP_VOUCHER_BLOCK_SIZE = config("AFIP_VOUCHER_BLOCK_SIZE", default=1, cast=int)
+# Si nadie pidió números en este tiempo, los que siguen al último autorizado en AFIP
+# y no tienen factura se consideran abandonados (p. ej. un proceso que murió)
+AFIP_VOUCHER_ABANDONED_AFTER = config("AFIP_VOUCHER_ABANDONED_AFTER", default=900, cast=int)
+
+logger = logging.getLogger(__name__)
+
+
+def last_authorized(afip, point_of_sale: int, voucher_type: int) -> int:
+    return afip.ElectronicBilling.getLastVoucher(point_of_sale, voucher_type)
+
+
+def afip_seed(user_id: int, point_of_sale: int, voucher_type: int):
+    # Semilla del contador: último número autorizado según FECompUltimoAutorizado
+    async def seed() -> int:
+        async with async_session() as db:
+            certificate = await crud.get_latest_certificate(db, user_id)
+        if not certificate:
+            raise ValueError("No certificate found for this user")
+        afip = await ticket_cache.client_for(certificate, "wsfe")
+        return await gateway.call(last_authorized, afip, point_of_sale, voucher_type,
+                                  service="wsfe", cuit=certificate.user.cuit)
+    return seed
+
+
+def _key_filter(model, key):
+    cuit, point_of_sale, voucher_type = key
+    return (model.cuit == cuit, model.point_of_sale == point_of_sale, model.voucher_type == voucher_type)
+
+
+# Asigna números de comprobante por (CUIT, punto de venta, tipo).
+#
+# El contador vive en la tabla voucher_counter y se incrementa con un único
+# UPDATE ... RETURNING, sin bloquear la fila durante la emisión. Solo la primera
+# vez se consulta a AFIP el último número autorizado. Los números que no llegan a
+# autorizarse se guardan en voucher_gap y se reutilizan antes que los nuevos.
+class VoucherNumberAllocator:
+    def __init__(self, block_size: int = AFIP_VOUCHER_BLOCK_SIZE, session_factory=async_session):
+        self.block_size = max(block_size, 1)
+        self.session_factory = session_factory
+        self._blocks = {}
+        self._locks = {}
+        self._seed_locks = {}
+
+    async def allocate(self, key: tuple, count: int, seed) -> list:
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            numbers = await self._take_gaps(key, count)
+            block = self._blocks.get(key)
+            while len(numbers) < count:
+                if block and block[0] <= block[1]:
+                    take = min(count - len(numbers), block[1] - block[0] + 1)
+                    numbers.extend(range(block[0], block[0] + take))
+                    block[0] += take
+                    continue
+                size = max(count - len(numbers), self.block_size)
+                last = await self._increment(key, size, seed)
+                block = self._blocks[key] = [last - size + 1, last]
+            return sorted(numbers)
+
+    async def _take_gaps(self, key: tuple, count: int) -> list:
+        async with self.session_factory() as db:
+            stmt = (
+                select(VoucherGap.gap_id, VoucherGap.number)
+                .where(*_key_filter(VoucherGap, key))
+                .order_by(VoucherGap.number)
+                .limit(count)
+                .with_for_update(skip_locked=True)
+            )
+            rows = (await db.execute(stmt)).all()
+            if not rows:
+                return []
+            await db.execute(delete(VoucherGap).where(VoucherGap.gap_id.in_([row.gap_id for row in rows])))
+            await db.commit()
+            return [row.number for row in rows]
+
+    async def _increment(self, key: tuple, count: int, seed) -> int:
+        while True:
+            async with self.session_factory() as db:
+                stmt = (
+                    update(VoucherCounter)
+                    .where(*_key_filter(VoucherCounter, key))
+                    .values(last_number=VoucherCounter.last_number + count, updated_at=datetime.utcnow())
+                    .execution_options(synchronize_session=False)
+                )
+                if db.bind.dialect.update_returning:
+                    last = (await db.execute(stmt.returning(VoucherCounter.last_number))).scalar_one_or_none()
+                else:
+                    await db.execute(stmt)
+                    last = (await db.execute(
+                        select(VoucherCounter.last_number).where(*_key_filter(VoucherCounter, key))
+                    )).scalar_one_or_none()
+                if last is not None:
+                    await db.commit()
+                    return last
+
+            # Primera emisión para esta clave: se siembra el contador una sola vez
+            async with self._seed_locks.setdefault(key, asyncio.Lock()):
+                seeded = await seed()
+                cuit, point_of_sale, voucher_type = key
+                async with self.session_factory() as db:
+                    db.add(VoucherCounter(cuit=cuit, point_of_sale=point_of_sale, voucher_type=voucher_type,
+                                          last_number=seeded + count, updated_at=datetime.utcnow()))
+                    try:
+                        await db.commit()
+                        return seeded + count
+                    except IntegrityError:
+                        # Otro worker sembró primero: se vuelve a incrementar su fila
+                        await db.rollback()
+
+    async def release(self, key: tuple, numbers: list):
+        if not numbers:
+            return
+        cuit, point_of_sale, voucher_type = key
+        async with self.session_factory() as db:
+            existing = set((await db.execute(
+                select(VoucherGap.number).where(*_key_filter(VoucherGap, key), VoucherGap.number.in_(numbers))
+            )).scalars().all())
+            db.add_all([
+                VoucherGap(cuit=cuit, point_of_sale=point_of_sale, voucher_type=voucher_type, number=number)
+                for number in sorted(set(numbers) - existing)
+            ])
+            await db.commit()
+
+    async def reconcile(self, key: tuple, afip_last: int, unused=()):
+        # Alinea el contador con el último número autorizado en AFIP. Solo los números
+        # propios que no se autorizaron (unused) pasan a ser huecos: los que están entre
+        # ese último y el contador pueden estar en manos de otro worker o proceso.
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            cuit, point_of_sale, voucher_type = key
+            async with self.session_factory() as db:
+                db_counter = (await db.execute(
+                    select(VoucherCounter).where(*_key_filter(VoucherCounter, key)).with_for_update()
+                )).scalar_one_or_none()
+                # Los huecos que AFIP ya autorizó (emitidos por fuera del servicio) no se pueden reusar
+                await db.execute(delete(VoucherGap).where(*_key_filter(VoucherGap, key), VoucherGap.number <= afip_last))
+                if db_counter is None:
+                    await db.commit()
+                    return
+                if afip_last >= db_counter.last_number:
+                    db_counter.last_number = afip_last
+                    self._blocks.pop(key, None)
+                else:
+                    gaps = {number for number in unused if number > afip_last}
+                    if db_counter.updated_at and db_counter.updated_at < datetime.utcnow() - timedelta(seconds=AFIP_VOUCHER_ABANDONED_AFTER):
+                        # Nadie pidió números hace rato: los que no tienen factura quedaron abandonados
+                        gaps |= set(range(afip_last + 1, db_counter.last_number + 1)) - await self._in_use(db, key)
+                    block = self._blocks.get(key)
+                    if block:
+                        # Los números del bloque en memoria todavía no se entregaron
+                        gaps -= set(range(block[0], block[1] + 1))
+                    existing = set((await db.execute(
+                        select(VoucherGap.number).where(*_key_filter(VoucherGap, key), VoucherGap.number.in_(gaps))
+                    )).scalars().all()) if gaps else set()
+                    db.add_all([
+                        VoucherGap(cuit=cuit, point_of_sale=point_of_sale, voucher_type=voucher_type, number=number)
+                        for number in sorted(gaps - existing)
+                    ])
+                await db.commit()
+            logger.info("Numeración reconciliada para %s: último autorizado %s", key, afip_last)
+
+    async def _in_use(self, db, key: tuple) -> set:
+        # Números asignados con CAEA que AFIP todavía no cuenta como autorizados
+        from app.services.cae import voucher_type_code, CaeError
+        cuit, point_of_sale, voucher_type = key
+        stmt = (
+            select(Invoice.invoice_type, Invoice.invoice_number)
+            .join(User, User.user_id == Invoice.user_id)
+            .where(User.cuit == cuit, Invoice.point_of_sale == point_of_sale, Invoice.emission_type == "CAEA",
+                   Invoice.caea_reported_at.is_(None), Invoice.invoice_number.is_not(None))
+        )
+        numbers = set()
+        for invoice_type, invoice_number in (await db.execute(stmt)).all():
+            try:
+                if voucher_type_code(invoice_type) == voucher_type and str(invoice_number).isdigit():
+                    numbers.add(int(invoice_number))
+            except CaeError:
+                continue
+        return numbers
+
+allocator = VoucherNumberAllocator()
@@ -0,0 +1,175 @@
+from sqlalchemy.future import select
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+from decouple import config
+from datetime import datetime, timedelta
+from app.database import async_session
+from app.models import PadronEntry
+from app.services.afip_gateway import gateway
+from app.services.tickets import ticket_cache
+import asyncio
+import logging
+
+PADRON_SERVICE = "ws_sr_constancia_inscripcion"
+# Vigencia de los datos del padrón guardados (días) y de las consultas sin resultado (horas)
+PADRON_CACHE_TTL = config("PADRON_CACHE_TTL", default=30, cast=int)
+PADRON_NEGATIVE_TTL = config("PADRON_NEGATIVE_TTL", default=24, cast=int)
+# CUITs por getPersonaList_v2 (AFIP admite hasta 250)
+PADRON_BATCH_SIZE = config("PADRON_BATCH_SIZE", default=100, cast=int)
+
+# Impuestos del padrón que definen la condición frente al IVA
+TAX_IVA = 30
+TAX_IVA_EXEMPT = 32
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_cuit(value) -> str:
+    digits = "".join(ch for ch in str(value or "") if ch.isdigit())
+    return digits if len(digits) == 11 else None
+
+
+def _tax_condition(persona: dict) -> str:
+    if persona.get("datosMonotributo"):
+        return "Responsable Monotributo"
+    general = persona.get("datosRegimenGeneral") or {}
+    taxes = general.get("impuesto") or []
+    taxes = taxes if isinstance(taxes, list) else [taxes]
+    tax_ids = {int(tax.get("idImpuesto")) for tax in taxes if tax.get("idImpuesto") is not None}
+    if TAX_IVA in tax_ids:
+        return "IVA Responsable Inscripto"
+    if TAX_IVA_EXEMPT in tax_ids:
+        return "IVA Sujeto Exento"
+    return "Consumidor Final"
+
+
+def _address(general: dict) -> str:
+    address = general.get("domicilioFiscal") or {}
+    parts = [address.get("direccion"), address.get("localidad"), address.get("descripcionProvincia")]
+    return ", ".join(part for part in parts if part) or None
+
+
+def _entry(cuit: str, persona: dict, now: datetime) -> dict:
+    general = persona.get("datosGenerales") or {}
+    if not general:
+        error = persona.get("errorConstancia") or {}
+        errors = error.get("error") if isinstance(error, dict) else error
+        return {"cuit": cuit, "found": False, "name": None, "tax_condition": None, "address": None,
+                "error": str(errors) if errors else "CUIT no encontrado en el padrón", "fetched_at": now}
+    name = general.get("razonSocial") or ", ".join(
+        part for part in (general.get("apellido"), general.get("nombre")) if part
+    )
+    return {"cuit": cuit, "found": True, "name": name or None, "tax_condition": _tax_condition(persona),
+            "address": _address(general), "error": None, "fetched_at": now}
+
+
+def _persona_cuit(persona: dict) -> str:
+    general = persona.get("datosGenerales") or {}
+    error = persona.get("errorConstancia") or {}
+    return normalize_cuit(general.get("idPersona") or error.get("idPersona"))
+
+
+def _fetch(afip, cuits: list) -> list:
+    personas = afip.RegisterInscriptionProof.getTaxpayersDetails([int(cuit) for cuit in cuits])
+    if personas is None:
+        return []
+    return personas if isinstance(personas, list) else [personas]
+
+
+# Cache de consultas al padrón de AFIP (constancia de inscripción) por CUIT.
+#
+# Los datos se guardan en la tabla padron_entry con su fecha de consulta; mientras
+# estén vigentes no se vuelve a consultar a AFIP, tampoco para los CUIT inexistentes
+# (con una vigencia más corta). Los CUIT que faltan se piden en lotes de
+# PADRON_BATCH_SIZE en paralelo, y si otra petición ya está consultando un CUIT se
+# espera su resultado en lugar de repetir la consulta.
+class PadronCache:
+    def __init__(self, session_factory=async_session, ttl: int = PADRON_CACHE_TTL,
+                 negative_ttl: int = PADRON_NEGATIVE_TTL, batch_size: int = PADRON_BATCH_SIZE):
+        self.session_factory = session_factory
+        self.ttl = timedelta(days=ttl)
+        self.negative_ttl = timedelta(hours=negative_ttl)
+        self.batch_size = batch_size
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _is_fresh(self, entry: PadronEntry, now: datetime) -> bool:
+        return entry.fetched_at + (self.ttl if entry.found else self.negative_ttl) > now
+
+    async def lookup(self, certificate, cuits) -> dict:
+        # Devuelve {cuit: PadronEntry} para los CUIT válidos que se pudieron resolver
+        wanted = {cuit for cuit in map(normalize_cuit, cuits) if cuit}
+        if not wanted:
+            return {}
+        now = datetime.utcnow()
+        async with self.session_factory() as db:
+            rows = (await db.execute(select(PadronEntry).where(PadronEntry.cuit.in_(wanted)))).scalars().all()
+        entries = {entry.cuit: entry for entry in rows if self._is_fresh(entry, now)}
+        self.hits += len(entries)
+
+        missing = wanted - entries.keys()
+        waiting = {cuit: self._inflight[cuit] for cuit in missing if cuit in self._inflight}
+        to_fetch = sorted(missing - waiting.keys())
+        if to_fetch:
+            self.misses += len(to_fetch)
+            future = asyncio.get_running_loop().create_future()
+            for cuit in to_fetch:
+                self._inflight[cuit] = future
+            try:
+                batches = [to_fetch[i:i + self.batch_size] for i in range(0, len(to_fetch), self.batch_size)]
+                results = await asyncio.gather(*(self._fetch_batch(certificate, batch) for batch in batches))
+            except BaseException:
+                future.cancel()
+                raise
+            finally:
+                for cuit in to_fetch:
+                    self._inflight.pop(cuit, None)
+            fetched = {entry.cuit: entry for batch in results for entry in batch}
+            future.set_result(fetched)
+            entries.update(fetched)
+
+        for future in set(waiting.values()):
+            await asyncio.wait([future])
+            # Si la consulta de la otra petición se canceló, esos CUIT quedan sin datos
+            if not future.cancelled():
+                entries.update({cuit: entry for cuit, entry in future.result().items() if cuit in waiting})
+        return entries
+
+    async def _fetch_batch(self, certificate, cuits: list) -> list:
+        try:
+            afip = await ticket_cache.client_for(certificate, PADRON_SERVICE)
+            personas = await gateway.call(_fetch, afip, cuits, service=PADRON_SERVICE, cuit=certificate.user.cuit)
+        except Exception as e:
+            # Sin padrón se importa igual, sin completar datos; no se guarda nada
+            self.errors += 1
+            logger.error("Error al consultar el padrón (%s CUITs): %s", len(cuits), e)
+            return []
+
+        now = datetime.utcnow()
+        by_cuit = {}
+        for persona in personas:
+            cuit = _persona_cuit(persona)
+            if cuit:
+                by_cuit[cuit] = _entry(cuit, persona, now)
+        for cuit in cuits:
+            by_cuit.setdefault(cuit, _entry(cuit, {}, now))
+
+        async with self.session_factory() as db:
+            # Reemplaza las entradas vencidas de estos CUIT
+            await db.execute(delete(PadronEntry).where(PadronEntry.cuit.in_(list(by_cuit))))
+            entries = [PadronEntry(**values) for values in by_cuit.values()]
+            db.add_all(entries)
+            try:
+                await db.commit()
+            except IntegrityError:
+                # Otro proceso guardó los mismos CUIT en el medio; los datos son equivalentes
+                await db.rollback()
+        return entries
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "errors": self.errors, "inflight": len(self._inflight)}
+
+
+padron_cache = PadronCache()
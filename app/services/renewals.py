@@ -0,0 +1,182 @@
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased, selectinload
+from sqlalchemy import and_, exists, or_, update
+from decouple import config
+from datetime import datetime, timedelta
+from app import crud
+from app.database import async_session
+from app.models import Authorization, Certificate
+from app.schemas import CertificateCreate
+from app.services.afip_gateway import gateway
+from app.services import authorizations
+import asyncio
+import logging
+
+# Cada cuántos segundos se buscan certificados por vencer
+CERT_RENEWAL_INTERVAL = config("CERT_RENEWAL_INTERVAL", default=3600, cast=int)
+# Con cuántos días de anticipación se renueva un certificado
+CERT_RENEWAL_DAYS = config("CERT_RENEWAL_DAYS", default=30, cast=int)
+# Renovaciones (cada una con sus autorizaciones) en curso al mismo tiempo
+CERT_RENEWAL_CONCURRENCY = config("CERT_RENEWAL_CONCURRENCY", default=4, cast=int)
+# Segundos que un worker se reserva un certificado para renovarlo; si se cae, otro lo
+# retoma cuando vence la reserva
+CERT_RENEWAL_LEASE = config("CERT_RENEWAL_LEASE", default=900, cast=int)
+
+logger = logging.getLogger(__name__)
+
+
+def _is_latest():
+    newer = aliased(Certificate)
+    return ~exists().where(and_(newer.user_id == Certificate.user_id,
+                                newer.certificate_id > Certificate.certificate_id))
+
+
+def expiring_stmt(horizon: datetime):
+    # Último certificado de cada usuario que vence antes de horizon: usa el índice de
+    # expires_at y descarta los que ya tienen un certificado más nuevo
+    return (
+        select(Certificate)
+        .options(selectinload(Certificate.user))
+        .where(Certificate.expires_at <= horizon, _is_latest())
+        .order_by(Certificate.expires_at)
+    )
+
+
+# Renueva los certificados antes de que venzan y vuelve a autorizar sus servicios.
+#
+# Sin esto el vencimiento recién se detecta al pedir una autorización, que falla con
+# 400. La tarea revisa cada interval segundos los certificados que vencen dentro de
+# renewal_days, pide uno nuevo con Afip.createCert y autoriza en el certificado nuevo
+# los mismos servicios que tenía el anterior, con a lo sumo concurrency renovaciones
+# en paralelo. Si algo falla se reintenta en la siguiente vuelta.
+#
+# Con varios workers cada renovación se reserva en la fila del certificado
+# (renewing_until) con un UPDATE condicional: solo un worker llama a createCert.
+class CertificateRenewalScheduler:
+    def __init__(self, interval: int = CERT_RENEWAL_INTERVAL, renewal_days: int = CERT_RENEWAL_DAYS,
+                 concurrency: int = CERT_RENEWAL_CONCURRENCY, lease: int = CERT_RENEWAL_LEASE,
+                 session_factory=async_session):
+        self.interval = interval
+        self.renewal_days = renewal_days
+        self.concurrency = concurrency
+        self.lease = timedelta(seconds=lease)
+        self.session_factory = session_factory
+        self._task = None
+        self.renewing = 0
+        self.renewed = 0
+        self.failed = 0
+        self.authorized = 0
+        self.last_run = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error al renovar certificados: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        self.last_run = datetime.utcnow()
+        horizon = self.last_run + timedelta(days=self.renewal_days)
+        async with self.session_factory() as db:
+            certificates = (await db.execute(expiring_stmt(horizon))).scalars().all()
+        if not certificates:
+            return
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(certificate):
+            async with semaphore:
+                await self.renew(certificate)
+
+        await asyncio.gather(*(run(certificate) for certificate in certificates))
+
+    async def _claim(self, certificate_id: int) -> bool:
+        # Reserva el certificado si nadie lo está renovando y sigue siendo el último del usuario
+        now = datetime.utcnow()
+        async with self.session_factory() as db:
+            result = await db.execute(
+                update(Certificate)
+                .where(Certificate.certificate_id == certificate_id,
+                       or_(Certificate.renewing_until.is_(None), Certificate.renewing_until < now),
+                       _is_latest())
+                .values(renewing_until=now + self.lease)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+            return result.rowcount == 1
+
+    async def _release(self, certificate_id: int):
+        try:
+            async with self.session_factory() as db:
+                await db.execute(
+                    update(Certificate)
+                    .where(Certificate.certificate_id == certificate_id)
+                    .values(renewing_until=None)
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+        except Exception as e:
+            # La reserva vence sola
+            logger.warning("No se pudo liberar la renovación del certificado %s: %s", certificate_id, e)
+
+    async def renew(self, certificate: Certificate):
+        if not await self._claim(certificate.certificate_id):
+            return
+        self.renewing += 1
+        try:
+            user = certificate.user
+            logger.info("Renovando el certificado %s (vence %s)", certificate.certificate_id, certificate.expires_at)
+            response = await gateway.create_cert(user.cuit, user.username, user.password_hash, certificate.cert_alias)
+            if not response.get("cert") or not response.get("key"):
+                raise RuntimeError(f"Respuesta inesperada de AFIP: {response}")
+            async with self.session_factory() as db:
+                services = (await db.execute(
+                    select(Authorization.service)
+                    .where(Authorization.certificate_id == certificate.certificate_id,
+                           Authorization.status.in_(("created", "exists")))
+                )).scalars().all()
+                await crud.create_certificate(db, CertificateCreate(
+                    cert_alias=certificate.cert_alias, certificate=response.get("cert"),
+                    private_key=response.get("key")), user.user_id)
+                new_certificate = await crud.get_latest_certificate(db, user.user_id)
+            self.renewed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error("No se pudo renovar el certificado %s: %s", certificate.certificate_id, e)
+            return
+        finally:
+            self.renewing -= 1
+            await self._release(certificate.certificate_id)
+
+        if services:
+            async for result in authorizations.authorize_many(new_certificate, services):
+                if result["status"] in ("created", "exists", "skipped"):
+                    self.authorized += 1
+                else:
+                    logger.warning("No se pudo autorizar '%s' en el certificado renovado %s: %s",
+                                   result["service"], new_certificate.certificate_id, result["error"])
+
+    def stats(self) -> dict:
+        return {
+            "renewing": self.renewing,
+            "renewed": self.renewed,
+            "failed": self.failed,
+            "authorized": self.authorized,
+            "last_run": self.last_run,
+        }
+
+
+renewal_scheduler = CertificateRenewalScheduler()
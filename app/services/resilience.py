@@ -0,0 +1,143 @@
+from decouple import config
+import http.client
+import json
+import re
+import time
+
+# Circuit breaker por servicio de AFIP (wsfe, wsaa, padrón, ...)
+AFIP_BREAKER_FAILURE_THRESHOLD = config("AFIP_BREAKER_FAILURE_THRESHOLD", default=5, cast=int)
+AFIP_BREAKER_OPEN_SECONDS = config("AFIP_BREAKER_OPEN_SECONDS", default=30.0, cast=float)
+AFIP_BREAKER_HALF_OPEN_PROBES = config("AFIP_BREAKER_HALF_OPEN_PROBES", default=1, cast=int)
+# Token bucket por (CUIT, servicio): llamadas por segundo, ráfaga y piso de la tasa adaptiva
+AFIP_RATE_LIMIT = config("AFIP_RATE_LIMIT", default=5.0, cast=float)
+AFIP_RATE_BURST = config("AFIP_RATE_BURST", default=10, cast=int)
+AFIP_RATE_MIN = config("AFIP_RATE_MIN", default=0.5, cast=float)
+
+# Códigos HTTP que indican que AFIP (o el proxy del SDK) no está respondiendo
+OUTAGE_STATUSES = {502, 503, 504}
+# Textos de error de red o de una página de error del proxy; se buscan como frases
+# completas para no confundirlos con números de CUIT, comprobantes o códigos de error
+OUTAGE_PATTERN = re.compile(r"\b(timeout|timed out|bad gateway|service unavailable|gateway time-?out"
+                            r"|connection (reset|refused|aborted))\b")
+# Rechazo de negocio de WSFE, p. ej. "(10016) El número no es correlativo"
+BUSINESS_ERROR = re.compile(r"^\(\d+\) ")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def _http_status(message: str):
+    # Ante un código >= 400 el SDK lanza Exception con el cuerpo de la respuesta; si es
+    # JSON con el código de estado, ese es el dato a clasificar
+    try:
+        body = json.loads(message)
+    except ValueError:
+        return None
+    if not isinstance(body, dict):
+        return None
+    for field in ("status", "statusCode", "status_code"):
+        value = body.get(field)
+        if isinstance(value, int) or (isinstance(value, str) and value.isdigit()):
+            return int(value)
+    return None
+
+
+def is_outage(error: BaseException) -> bool:
+    # Errores de red (incluye socket.timeout y ConnectionError) o HTTP mal formado
+    if isinstance(error, (OSError, http.client.HTTPException)):
+        return True
+    message = str(error).strip()
+    if BUSINESS_ERROR.match(message):
+        return False
+    status = _http_status(message)
+    if status is not None:
+        return status in OUTAGE_STATUSES
+    return OUTAGE_PATTERN.search(message.lower()) is not None
+
+
+# Corta las llamadas a un servicio después de varias caídas seguidas. Pasado
+# open_seconds deja pasar unas pocas llamadas de prueba (half-open): si responden
+# se vuelve a cerrar, si fallan queda abierto otro período.
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = AFIP_BREAKER_FAILURE_THRESHOLD,
+                 open_seconds: float = AFIP_BREAKER_OPEN_SECONDS, half_open_probes: int = AFIP_BREAKER_HALF_OPEN_PROBES):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.trips = 0
+
+    def retry_after(self) -> float:
+        return max(self.opened_at + self.open_seconds - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        if self.state == OPEN:
+            if self.retry_after() > 0:
+                return False
+            self.state = HALF_OPEN
+            self.probes = 0
+        if self.state == HALF_OPEN:
+            if self.probes >= self.half_open_probes:
+                return False
+            self.probes += 1
+        return True
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.probes = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.trips += 1
+
+    def release_probe(self):
+        # Una llamada de prueba que no llegó a ejecutarse no cuenta como resultado
+        if self.state == HALF_OPEN and self.probes:
+            self.probes -= 1
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "trips": self.trips,
+                "retry_after": round(self.retry_after(), 1) if self.state == OPEN else 0}
+
+
+# Token bucket con tasa adaptiva (AIMD): ante una caída la tasa se reduce a la mitad
+# hasta min_rate y con cada respuesta se recupera de a un 10% de la tasa configurada.
+class TokenBucket:
+    def __init__(self, rate: float = AFIP_RATE_LIMIT, burst: int = AFIP_RATE_BURST, min_rate: float = AFIP_RATE_MIN):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min(min_rate, rate)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> float:
+        # Toma un token y devuelve 0, o devuelve cuántos segundos faltan para el próximo
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def record_success(self):
+        self.rate = min(self.base_rate, self.rate + self.base_rate * 0.1)
+
+    def record_overload(self):
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def stats(self) -> dict:
+        self._refill()
+        return {"rate": round(self.rate, 2), "tokens": round(self.tokens, 1)}
@@ -0,0 +1,266 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import delete, update, insert, func, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from decimal import Decimal, ROUND_HALF_UP
+from app.database import async_session
+from app.models import Invoice, InvoiceItem, SalesMonth
+import argparse
+import asyncio
+import logging
+
+# Totales mensuales de ventas mantenidos de forma incremental.
+#
+# Cada factura aporta una línea por alícuota de IVA de sus ítems (base = suma de
+# total_price, IVA = suma de tax_amount, total = base + IVA) o, sin ítems, una sola línea
+# con sus importes y la alícuota que resulta de IVA / neto. La cantidad de facturas se
+# cuenta solo en la primera línea (la de menor alícuota), así sumar líneas no la duplica.
+#
+# Las altas, cambios y bajas de facturas y los cambios de estado del CAE suman y restan
+# esas líneas en sales_month dentro de la misma transacción; rebuild() recalcula todo con
+# la misma función, por si los totales quedaran desfasados.
+
+KEY_COLUMNS = ("user_id", "period", "status", "invoice_type", "point_of_sale", "tax_rate")
+MEASURES = ("invoice_count", "net_amount", "tax_amount", "total_amount")
+# Campos de la factura que cambian sus líneas
+TRACKED_FIELDS = {"date", "status", "invoice_type", "point_of_sale", "net_amount", "tax_amount", "total_amount"}
+# Campos de un ítem que cambian las líneas de su factura
+ITEM_FIELDS = {"total_price", "tax_rate", "tax_amount"}
+
+CENT = Decimal("0.01")
+ZERO = Decimal("0")
+
+logger = logging.getLogger(__name__)
+
+
+def _amount(value) -> Decimal:
+    return Decimal(str(value or 0)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def invoice_lines(invoice: dict, vat_lines: list) -> dict:
+    # invoice: user_id, date, status, invoice_type, point_of_sale y los importes;
+    # vat_lines: [(alícuota, base, IVA)] de sus ítems. Devuelve {clave: [cantidad, neto, IVA, total]}
+    if invoice["user_id"] is None:
+        return {}
+    date = invoice["date"]
+    prefix = (invoice["user_id"], date.year * 100 + date.month, invoice["status"] or "draft",
+              invoice["invoice_type"] or "", invoice["point_of_sale"] or 0)
+    if vat_lines:
+        by_rate = {}
+        for rate, base, amount in vat_lines:
+            line = by_rate.setdefault(_amount(rate), [ZERO, ZERO])
+            line[0] += _amount(base)
+            line[1] += _amount(amount)
+        lines = {prefix + (rate, ): [0, net, tax, net + tax] for rate, (net, tax) in by_rate.items()}
+    else:
+        net, tax = _amount(invoice["net_amount"]), _amount(invoice["tax_amount"])
+        # Misma alícuota que informa el Libro IVA para comprobantes sin ítems
+        rate = (tax * 100 / net).quantize(Decimal("0.1"), rounding=ROUND_HALF_UP) if net else ZERO
+        lines = {prefix + (_amount(rate), ): [0, net, tax, _amount(invoice["total_amount"])]}
+    lines[min(lines)][0] = 1
+    return lines
+
+
+def _add(deltas: dict, lines: dict, sign: int = 1):
+    for key, values in lines.items():
+        total = deltas.setdefault(key, [0, ZERO, ZERO, ZERO])
+        for i, value in enumerate(values):
+            total[i] += sign * value
+
+
+async def load(db: AsyncSession, invoice_ids) -> dict:
+    # Estado actual en la base de cada factura: {invoice_id: (datos, líneas de IVA)}
+    invoice_ids = list(invoice_ids)
+    if not invoice_ids:
+        return {}
+    stmt = select(Invoice.invoice_id, Invoice.user_id, Invoice.date, Invoice.status, Invoice.invoice_type,
+                  Invoice.point_of_sale, Invoice.net_amount, Invoice.tax_amount, Invoice.total_amount,
+                  ).where(Invoice.invoice_id.in_(invoice_ids))
+    invoices = {row.invoice_id: (dict(row._mapping), []) for row in (await db.execute(stmt)).all()}
+    stmt = (
+        select(InvoiceItem.invoice_id, InvoiceItem.tax_rate,
+               func.sum(InvoiceItem.total_price), func.sum(InvoiceItem.tax_amount))
+        .where(InvoiceItem.invoice_id.in_(invoice_ids))
+        .group_by(InvoiceItem.invoice_id, InvoiceItem.tax_rate)
+    )
+    for invoice_id, rate, base, amount in (await db.execute(stmt)).all():
+        if invoice_id in invoices:
+            invoices[invoice_id][1].append((rate, base, amount))
+    return invoices
+
+
+def _upsert(dialect: str, rows: list):
+    module = {"postgresql": postgresql, "sqlite": sqlite}.get(dialect)
+    if module is None:
+        return None
+    stmt = module.insert(SalesMonth).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[getattr(SalesMonth, column) for column in KEY_COLUMNS],
+        set_={**{column: getattr(SalesMonth, column) + getattr(stmt.excluded, column) for column in MEASURES},
+              "updated_at": func.now()},
+    )
+
+
+async def apply(db: AsyncSession, deltas: dict):
+    # Suma las diferencias en sales_month sin hacer commit: queda en la transacción del llamador.
+    # Las claves van ordenadas para que dos transacciones no se bloqueen en orden inverso.
+    rows = [
+        {**dict(zip(KEY_COLUMNS, key)), **dict(zip(MEASURES, values))}
+        for key, values in sorted(deltas.items()) if any(values)
+    ]
+    if not rows:
+        return
+    stmt = _upsert(db.bind.dialect.name, rows)
+    if stmt is not None:
+        await db.execute(stmt)
+        return
+    for row in rows:
+        key = [getattr(SalesMonth, column) == row[column] for column in KEY_COLUMNS]
+        result = await db.execute(update(SalesMonth).where(*key).values(
+            **{column: getattr(SalesMonth, column) + row[column] for column in MEASURES}))
+        if not result.rowcount:
+            await db.execute(insert(SalesMonth).values(row))
+
+
+async def record_created(db: AsyncSession, invoice: Invoice, item_rows: list):
+    # Alta: los ítems recién calculados (crud.compute_items) evitan volver a leerlos
+    values = {column: getattr(invoice, column) for column in
+              ("user_id", "date", "status", "invoice_type", "point_of_sale", "net_amount", "tax_amount", "total_amount")}
+    vat_lines = [(row["tax_rate"], row["total_price"], row["tax_amount"]) for row in item_rows]
+    await apply(db, invoice_lines(values, vat_lines))
+
+
+async def record_updated(db: AsyncSession, invoice_id: int, values: dict):
+    # Antes del UPDATE: resta las líneas actuales y suma las que quedan con los valores nuevos
+    if not TRACKED_FIELDS.intersection(values):
+        return
+    current = (await load(db, [invoice_id])).get(invoice_id)
+    if current is None:
+        return
+    before, vat_lines = current
+    deltas = {}
+    _add(deltas, invoice_lines(before, vat_lines), -1)
+    _add(deltas, invoice_lines({**before, **{k: v for k, v in values.items() if k in TRACKED_FIELDS}}, vat_lines))
+    await apply(db, deltas)
+
+
+async def record_deleted(db: AsyncSession, invoice_id: int):
+    current = (await load(db, [invoice_id])).get(invoice_id)
+    if current is not None:
+        deltas = {}
+        _add(deltas, invoice_lines(*current), -1)
+        await apply(db, deltas)
+
+
+async def snapshot(db: AsyncSession, invoice_ids) -> dict:
+    # Líneas actuales de las facturas, para comparar antes y después de un cambio en sus ítems
+    lines = {}
+    for invoice, vat_lines in (await load(db, invoice_ids)).values():
+        _add(lines, invoice_lines(invoice, vat_lines))
+    return lines
+
+
+async def record_snapshot(db: AsyncSession, invoice_ids, before: dict):
+    # Después del cambio (sin commit): resta las líneas de snapshot() y suma las actuales
+    deltas = {}
+    _add(deltas, before, -1)
+    _add(deltas, await snapshot(db, invoice_ids))
+    await apply(db, deltas)
+
+
+async def record_status(db: AsyncSession, statuses: dict, previous: dict = None):
+    # Cambios de estado ({invoice_id: estado nuevo}); se llama antes del UPDATE de las facturas,
+    # o después si se pasa el estado anterior de cada una (previous, p. ej. de un UPDATE ... RETURNING)
+    deltas = {}
+    for invoice_id, (before, vat_lines) in (await load(db, statuses)).items():
+        if previous is not None:
+            before = {**before, "status": previous[invoice_id]}
+        if before["status"] == statuses[invoice_id]:
+            continue
+        _add(deltas, invoice_lines(before, vat_lines), -1)
+        _add(deltas, invoice_lines({**before, "status": statuses[invoice_id]}, vat_lines))
+    await apply(db, deltas)
+
+
+async def rebuild(user_id: int = None, session_factory=async_session, batch_size: int = 1000) -> int:
+    # Recalcula sales_month (de un usuario o completa) recorriendo las facturas por lotes.
+    # Las facturas que cambien mientras corre pueden quedar mal contadas: correrlo sin
+    # facturación en curso para ese usuario.
+    totals = {}
+    last_id = 0
+    async with session_factory() as db:
+        while True:
+            stmt = select(Invoice.invoice_id).where(Invoice.invoice_id > last_id).order_by(Invoice.invoice_id).limit(batch_size)
+            if user_id is not None:
+                stmt = stmt.where(Invoice.user_id == user_id)
+            invoice_ids = (await db.execute(stmt)).scalars().all()
+            if not invoice_ids:
+                break
+            for invoice, vat_lines in (await load(db, invoice_ids)).values():
+                _add(totals, invoice_lines(invoice, vat_lines))
+            last_id = invoice_ids[-1]
+
+        stmt = delete(SalesMonth)
+        if user_id is not None:
+            stmt = stmt.where(SalesMonth.user_id == user_id)
+        await db.execute(stmt)
+        await apply(db, totals)
+        await db.commit()
+    logger.info("sales_month reconstruida (usuario=%s): %s filas", user_id, len(totals))
+    return len(totals)
+
+
+def _exact(row) -> dict:
+    # SQLite devuelve SUM() de Numeric como float: los importes salen siempre con dos decimales
+    values = dict(row._mapping)
+    for column in ("tax_rate", "net_amount", "tax_amount", "total_amount"):
+        if column in values:
+            values[column] = _amount(values[column])
+    return values
+
+
+def _nonzero():
+    return or_(*(getattr(SalesMonth, column) != 0 for column in MEASURES))
+
+
+async def monthly_summary(db: AsyncSession, user_id: int, period_from: int = None, period_to: int = None,
+                          status: str = "authorized") -> list:
+    columns = [func.sum(getattr(SalesMonth, column)).label(column) for column in MEASURES]
+    stmt = (
+        select(SalesMonth.period, *columns)
+        .where(SalesMonth.user_id == user_id, SalesMonth.status == status)
+        .group_by(SalesMonth.period)
+        .order_by(SalesMonth.period)
+    )
+    if period_from is not None:
+        stmt = stmt.where(SalesMonth.period >= period_from)
+    if period_to is not None:
+        stmt = stmt.where(SalesMonth.period <= period_to)
+    return [_exact(row) for row in (await db.execute(stmt)).all()]
+
+
+async def breakdown(db: AsyncSession, user_id: int, period: int, status: str = "authorized") -> list:
+    stmt = (
+        select(SalesMonth.invoice_type, SalesMonth.point_of_sale, SalesMonth.tax_rate,
+               *(getattr(SalesMonth, column) for column in MEASURES))
+        .where(SalesMonth.user_id == user_id, SalesMonth.period == period, SalesMonth.status == status, _nonzero())
+        .order_by(SalesMonth.invoice_type, SalesMonth.point_of_sale, SalesMonth.tax_rate)
+    )
+    return [_exact(row) for row in (await db.execute(stmt)).all()]
+
+
+async def _main(args):
+    from app.database import engine
+    try:
+        print(f"Filas de sales_month: {await rebuild(args.user_id)}")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    # python -m app.services.sales rebuild [--user-id N]
+    parser = argparse.ArgumentParser(description="Totales mensuales de ventas")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--user-id", type=int, help="Solo las facturas de este usuario")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(parser.parse_args()))
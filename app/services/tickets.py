@@ -0,0 +1,251 @@
+from sqlalchemy.future import select
+from sqlalchemy import delete, update, or_
+from sqlalchemy.exc import IntegrityError
+from decouple import config
+from datetime import datetime, timedelta, timezone
+from app.database import async_session
+from app.models import AccessTicket, Certificate
+from app.services.afip_gateway import gateway
+from app.services.keystore import keystore
+from urllib.parse import urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+import asyncio
+import http.client
+import json
+import logging
+
+# Segundos antes del vencimiento del TA en los que se considera necesario renovarlo
+AFIP_TA_REFRESH_MARGIN = config("AFIP_TA_REFRESH_MARGIN", default=600, cast=int)
+# Tiempo máximo que un worker reserva el login de un TA (el SDK reintenta getServiceTA
+# hasta 25 veces cada 5 segundos); si no termina, otro worker puede tomarlo
+AFIP_TA_LOGIN_LEASE = config("AFIP_TA_LOGIN_LEASE", default=300, cast=int)
+# Cada cuántos segundos revisa la base un worker que espera el login de otro
+AFIP_TA_LOGIN_POLL = config("AFIP_TA_LOGIN_POLL", default=1.0, cast=float)
+# Vencimiento de la fila reservada antes del primer login (nunca está vigente)
+NEVER = datetime(1970, 1, 1)
+# Firmar el TRA localmente (keystore) y pedir el TA a WSAA con loginCms, en lugar de
+# delegar el login en el SDK; requiere el paquete 'cryptography'
+AFIP_TA_LOCAL_SIGN = config("AFIP_TA_LOCAL_SIGN", default=False, cast=bool)
+# Endpoint de loginCms (homologación por defecto, igual que el SDK)
+AFIP_WSAA_URL = config("AFIP_WSAA_URL", default="https://wsaahomo.afip.gov.ar/ws/services/LoginCms")
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_expiration(value) -> datetime:
+    # WSAA informa el vencimiento con zona horaria (-03:00); se guarda en UTC sin zona
+    if isinstance(value, datetime):
+        expiration = value
+    else:
+        expiration = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if expiration.tzinfo is not None:
+        expiration = expiration.astimezone(timezone.utc).replace(tzinfo=None)
+    return expiration
+
+
+def _find(element, name: str):
+    # Busca por nombre local, sin depender de los prefijos de namespace de la respuesta
+    for child in element.iter():
+        if child.tag.rsplit("}", 1)[-1] == name:
+            return child
+    return None
+
+
+def _login_cms(url: str, cms: str) -> dict:
+    # Llamada bloqueante a loginCms de WSAA (se ejecuta en el pool del gateway). Como el
+    # SDK, ante un error lanza Exception con el detalle para que el gateway lo clasifique.
+    envelope = (
+        '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+        'xmlns:wsaa="http://wsaa.view.sua.dvadac.desein.afip.gov">'
+        f"<soapenv:Header/><soapenv:Body><wsaa:loginCms><wsaa:in0>{escape(cms)}</wsaa:in0>"
+        "</wsaa:loginCms></soapenv:Body></soapenv:Envelope>"
+    ).encode()
+    parts = urlsplit(url)
+    conn = http.client.HTTPSConnection(parts.netloc, timeout=60)
+    try:
+        conn.request("POST", parts.path, envelope, {"Content-Type": "text/xml; charset=utf-8", "SOAPAction": '""'})
+        response = conn.getresponse()
+        body = response.read().decode("utf-8", errors="replace")
+    finally:
+        conn.close()
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError:
+        raise Exception(json.dumps({"status": response.status, "message": body[:500]}))
+    fault = _find(root, "faultstring")
+    if fault is not None:
+        code = _find(root, "faultcode")
+        raise Exception(f"WSAA {code.text if code is not None else ''}: {fault.text}")
+    result = _find(root, "loginCmsReturn")
+    if response.status >= 400 or result is None or not result.text:
+        raise Exception(json.dumps({"status": response.status, "message": body[:500]}))
+    try:
+        ticket = ElementTree.fromstring(result.text)
+    except ElementTree.ParseError as e:
+        raise Exception(f"Respuesta de WSAA inválida: {e}")
+    values = {}
+    for field, name in (("token", "token"), ("sign", "sign"), ("expiration", "expirationTime")):
+        element = _find(ticket, name)
+        if element is None or not element.text:
+            raise Exception(f"Respuesta de WSAA inválida: falta {name}")
+        values[field] = element.text.strip()
+    return values
+
+
+# Cache de tickets de acceso (token/sign) de WSAA por (certificado, servicio).
+#
+# Los tickets se guardan en memoria y en la tabla access_ticket, así otro worker o un
+# reinicio reutilizan los que siguen vigentes. Para cada clave hay un único login en
+# curso: en el proceso, las peticiones concurrentes esperan el resultado; entre
+# workers, el login se reserva en la fila (refreshing_until) con una transacción corta
+# y la llamada a WSAA se hace sin ninguna conexión tomada.
+class TicketCache:
+    def __init__(self, session_factory=async_session, refresh_margin: int = AFIP_TA_REFRESH_MARGIN,
+                 lease: int = AFIP_TA_LOGIN_LEASE, poll_interval: float = AFIP_TA_LOGIN_POLL,
+                 local_sign: bool = AFIP_TA_LOCAL_SIGN):
+        self.session_factory = session_factory
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.lease = timedelta(seconds=lease)
+        self.poll_interval = poll_interval
+        self.local_sign = local_sign
+        self._tickets = {}
+        self._locks = {}
+        self.logins = 0
+
+    def _is_fresh(self, expires_at: datetime) -> bool:
+        return expires_at - self.refresh_margin > datetime.utcnow()
+
+    def _cached(self, key):
+        ticket = self._tickets.get(key)
+        if ticket and self._is_fresh(ticket["expires_at"]):
+            return ticket
+        return None
+
+    async def get(self, certificate: Certificate, service: str, force: bool = False) -> dict:
+        key = (certificate.certificate_id, service)
+        ticket = None if force else self._cached(key)
+        if ticket:
+            return ticket
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            # Otra petición pudo haber renovado el ticket mientras esperábamos
+            ticket = None if force else self._cached(key)
+            if ticket:
+                return ticket
+
+            while True:
+                ticket, claimed = await self._claim(key, force)
+                if ticket:
+                    break
+                if claimed:
+                    try:
+                        ticket = await self._login(certificate, service, force)
+                    except BaseException:
+                        await self._store(key, None)
+                        raise
+                    await self._store(key, ticket)
+                    break
+                # Otro worker está haciendo el login: su ticket nuevo sirve aunque se haya pedido force
+                force = False
+                await asyncio.sleep(self.poll_interval)
+
+            self._tickets[key] = ticket
+            return ticket
+
+    async def _claim(self, key: tuple, force: bool):
+        # Devuelve (ticket vigente, None) o (None, si se reservó el login)
+        certificate_id, service = key
+        now = datetime.utcnow()
+        async with self.session_factory() as session:
+            db_ticket = (await session.execute(
+                select(AccessTicket.access_ticket_id, AccessTicket.token, AccessTicket.sign, AccessTicket.expires_at)
+                .where(AccessTicket.certificate_id == certificate_id, AccessTicket.service == service)
+            )).one_or_none()
+            if db_ticket and not force and self._is_fresh(db_ticket.expires_at):
+                return {"token": db_ticket.token, "sign": db_ticket.sign, "expires_at": db_ticket.expires_at}, None
+            if db_ticket is None:
+                session.add(AccessTicket(certificate_id=certificate_id, service=service, token="", sign="",
+                                         expires_at=NEVER, refreshing_until=now + self.lease))
+                try:
+                    await session.commit()
+                except IntegrityError:
+                    # Otro worker creó la fila primero y tiene la reserva
+                    await session.rollback()
+                    return None, False
+                return None, True
+            result = await session.execute(
+                update(AccessTicket)
+                .where(AccessTicket.access_ticket_id == db_ticket.access_ticket_id,
+                       or_(AccessTicket.refreshing_until.is_(None), AccessTicket.refreshing_until < now))
+                .values(refreshing_until=now + self.lease)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+            return None, result.rowcount == 1
+
+    async def _store(self, key: tuple, ticket: dict = None):
+        # Guarda el ticket nuevo y libera la reserva; sin ticket (login fallido) solo la libera
+        certificate_id, service = key
+        values = {"refreshing_until": None}
+        if ticket:
+            values.update(token=ticket["token"], sign=ticket["sign"], expires_at=ticket["expires_at"])
+        try:
+            async with self.session_factory() as session:
+                await session.execute(
+                    update(AccessTicket)
+                    .where(AccessTicket.certificate_id == certificate_id, AccessTicket.service == service)
+                    .values(**values)
+                    .execution_options(synchronize_session=False)
+                )
+                await session.commit()
+        except Exception as e:
+            # El ticket sigue sirviendo en memoria; la reserva vence sola
+            logger.warning("No se pudo guardar el TA de '%s' para el certificado %s: %s", service, certificate_id, e)
+
+    async def _login(self, certificate: Certificate, service: str, force: bool) -> dict:
+        cuit = certificate.user.cuit
+        if self.local_sign:
+            # La clave ya parseada queda en el keystore; WSAA siempre entrega un TA nuevo
+            logger.info("Solicitando TA de '%s' a WSAA para el certificado %s", service, certificate.certificate_id)
+            self.logins += 1
+            cms = await keystore.sign_tra(certificate, service)
+            response = await gateway.call(_login_cms, AFIP_WSAA_URL, cms, service=service, cuit=cuit)
+            return {"token": response["token"], "sign": response["sign"],
+                    "expires_at": _parse_expiration(response["expiration"])}
+        afip = gateway.client(cuit, cert=certificate.certificate, key=certificate.private_key)
+        logger.info("Solicitando TA de '%s' para el certificado %s", service, certificate.certificate_id)
+        self.logins += 1
+        response = await gateway.call(afip.getServiceTA, service, force, service=service, cuit=cuit)
+        expires_at = _parse_expiration(response["expiration"])
+        if not force and not self._is_fresh(expires_at):
+            # El TA devuelto está por vencer: forzar uno nuevo
+            self.logins += 1
+            response = await gateway.call(afip.getServiceTA, service, True, service=service, cuit=cuit)
+            expires_at = _parse_expiration(response["expiration"])
+        return {"token": response["token"], "sign": response["sign"], "expires_at": expires_at}
+
+    async def client_for(self, certificate: Certificate, *services: str):
+        # Cliente del SDK con los TA de los servicios indicados ya resueltos
+        tickets = {}
+        for service in services:
+            ticket = await self.get(certificate, service)
+            tickets[service] = {"token": ticket["token"], "sign": ticket["sign"]}
+        return gateway.client(certificate.user.cuit, tickets=tickets,
+                              cert=certificate.certificate, key=certificate.private_key)
+
+    def invalidate(self, certificate_id: int):
+        for key in [key for key in self._tickets if key[0] == certificate_id]:
+            self._tickets.pop(key, None)
+
+    async def purge(self, db, certificate_id: int):
+        # Descarta los tickets guardados cuando cambia el material del certificado
+        self.invalidate(certificate_id)
+        await db.execute(delete(AccessTicket).where(AccessTicket.certificate_id == certificate_id))
+
+    def stats(self) -> dict:
+        return {"cached": len(self._tickets), "logins": self.logins}
+
+
+ticket_cache = TicketCache()
@@ -0,0 +1,188 @@
+from sqlalchemy.future import select
+from sqlalchemy import delete
+from sqlalchemy.orm import selectinload
+from decouple import config, Csv
+from decimal import Decimal
+from datetime import datetime, timedelta
+from app.database import async_session
+from app.models import Certificate, WsfeParam
+from app.services.afip_gateway import gateway
+from app.services.tickets import ticket_cache
+from app.services import cae
+import asyncio
+import json
+import logging
+
+# Vigencia (segundos) de las tablas que casi no cambian y de las que cambian a diario
+WSFE_PARAMS_STATIC_TTL = config("WSFE_PARAMS_STATIC_TTL", default=7 * 24 * 3600, cast=int)
+WSFE_PARAMS_DAILY_TTL = config("WSFE_PARAMS_DAILY_TTL", default=24 * 3600, cast=int)
+# Cada cuánto se revisa si alguna tabla venció
+WSFE_PARAMS_CHECK_INTERVAL = config("WSFE_PARAMS_CHECK_INTERVAL", default=3600, cast=int)
+# Monedas de las que se mantiene la cotización (FEParamGetCotizacion)
+WSFE_EXCHANGE_CURRENCIES = config("WSFE_EXCHANGE_CURRENCIES", default="DOL,060", cast=Csv())
+
+logger = logging.getLogger(__name__)
+
+
+def _exchange_rates(wsfe) -> list:
+    return [wsfe.executeRequest("FEParamGetCotizacion", {"MonId": currency})["ResultGet"]
+            for currency in WSFE_EXCHANGE_CURRENCIES]
+
+
+# Tablas de parámetros compartidas por todos los emisores:
+# nombre -> (consulta al SDK, campo clave, vigencia)
+TABLES = {
+    "voucher_types": (lambda wsfe: wsfe.getVoucherTypes(), "Id", WSFE_PARAMS_STATIC_TTL),
+    "vat_rates": (lambda wsfe: wsfe.getAliquotTypes(), "Id", WSFE_PARAMS_STATIC_TTL),
+    "currencies": (lambda wsfe: wsfe.getCurrenciesTypes(), "Id", WSFE_PARAMS_STATIC_TTL),
+    "document_types": (lambda wsfe: wsfe.getDocumentTypes(), "Id", WSFE_PARAMS_STATIC_TTL),
+    "concept_types": (lambda wsfe: wsfe.getConceptTypes(), "Id", WSFE_PARAMS_STATIC_TTL),
+    "exchange_rates": (_exchange_rates, "MonId", WSFE_PARAMS_DAILY_TTL),
+}
+# Los puntos de venta dependen del emisor: se guardan como "sales_points:<cuit>"
+SALES_POINTS = (lambda wsfe: wsfe.getSalesPoints(), "Nro", WSFE_PARAMS_DAILY_TTL)
+
+
+def _definition(name: str):
+    return SALES_POINTS if name.startswith("sales_points:") else TABLES[name]
+
+
+def _fetch(afip, name: str) -> list:
+    fetch, _, _ = _definition(name)
+    return cae.as_list(fetch(afip.ElectronicBilling))
+
+
+# Cache local de las tablas de parámetros de WSFE (FEParamGet*).
+#
+# Las tablas se guardan en memoria indexadas por su clave, así las consultas son
+# O(1) y no generan tráfico con AFIP, y en la tabla wsfe_param para no tener que
+# pedirlas de nuevo al reiniciar. Una tarea de fondo renueva cada tabla cuando vence
+# su vigencia: semanal para las tablas fijas y diaria para las cotizaciones.
+class WsfeParamCache:
+    def __init__(self, session_factory=async_session, interval: int = WSFE_PARAMS_CHECK_INTERVAL):
+        self.session_factory = session_factory
+        self.interval = interval
+        self._tables = {}
+        self._locks = {}
+        self._task = None
+        self.refreshes = 0
+        self.errors = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        try:
+            await self.load()
+        except Exception as e:
+            logger.error("No se pudieron leer los parámetros de WSFE guardados: %s", e)
+        while True:
+            try:
+                await self.refresh_stale()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error al renovar los parámetros de WSFE: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def _is_fresh(self, name: str) -> bool:
+        table = self._tables.get(name)
+        _, _, ttl = _definition(name)
+        return table is not None and table["fetched_at"] + timedelta(seconds=ttl) > datetime.utcnow()
+
+    def _store(self, name: str, rows: list, fetched_at: datetime):
+        _, key, _ = _definition(name)
+        self._tables[name] = {"rows": {str(row.get(key)): row for row in rows}, "fetched_at": fetched_at}
+
+    async def load(self):
+        async with self.session_factory() as db:
+            for db_param in (await db.execute(select(WsfeParam))).scalars().all():
+                self._store(db_param.name, json.loads(db_param.payload), db_param.fetched_at)
+
+    async def _certificate(self, db):
+        # Las tablas compartidas se piden con cualquier certificado vigente
+        stmt = (
+            select(Certificate)
+            .options(selectinload(Certificate.user))
+            .order_by(Certificate.created_at.desc())
+            .limit(1)
+        )
+        return (await db.execute(stmt)).scalar_one_or_none()
+
+    async def refresh(self, name: str, certificate, force: bool = False):
+        async with self._locks.setdefault(name, asyncio.Lock()):
+            if not force and self._is_fresh(name):
+                return
+            afip = await ticket_cache.client_for(certificate, "wsfe")
+            rows = await gateway.call(_fetch, afip, name, service="wsfe", cuit=certificate.user.cuit)
+            fetched_at = datetime.utcnow()
+            async with self.session_factory() as db:
+                await db.execute(delete(WsfeParam).where(WsfeParam.name == name))
+                db.add(WsfeParam(name=name, payload=json.dumps(rows, default=str), fetched_at=fetched_at))
+                await db.commit()
+            self._store(name, rows, fetched_at)
+            self.refreshes += 1
+            logger.info("Parámetros de WSFE '%s' actualizados (%s filas)", name, len(rows))
+
+    async def refresh_stale(self, force: bool = False):
+        stale = [name for name in TABLES if force or not self._is_fresh(name)]
+        if not stale:
+            return
+        async with self.session_factory() as db:
+            certificate = await self._certificate(db)
+        if not certificate:
+            return
+        for name in stale:
+            try:
+                await self.refresh(name, certificate, force=force)
+            except Exception as e:
+                self.errors += 1
+                logger.error("No se pudo actualizar la tabla de WSFE '%s': %s", name, e)
+
+    def table(self, name: str) -> dict:
+        table = self._tables.get(name)
+        return table["rows"] if table else None
+
+    def get(self, name: str, key):
+        table = self._tables.get(name)
+        return table["rows"].get(str(key)) if table else None
+
+    async def sales_points(self, certificate) -> dict:
+        name = f"sales_points:{certificate.user.cuit}"
+        if not self._is_fresh(name):
+            await self.refresh(name, certificate)
+        return self.table(name)
+
+    def is_valid_voucher_type(self, invoice_type: str) -> bool:
+        # Sin la tabla cargada no se puede validar contra AFIP: solo se exige un tipo reconocible
+        try:
+            code = cae.voucher_type_code(invoice_type)
+        except cae.CaeError:
+            return False
+        voucher_types = self.table("voucher_types")
+        return voucher_types is None or str(code) in voucher_types
+
+    def exchange_rate(self, currency: str):
+        if currency == "PES":
+            return Decimal("1")
+        row = self.get("exchange_rates", currency)
+        return Decimal(str(row["MonCotiz"])) if row else None
+
+    def stats(self) -> dict:
+        return {
+            "tables": {
+                name: {"rows": len(table["rows"]), "fetched_at": table["fetched_at"], "fresh": self._is_fresh(name)}
+                for name, table in self._tables.items()
+            },
+            "refreshes": self.refreshes,
+            "errors": self.errors,
+        }
+
+
+param_cache = WsfeParamCache()
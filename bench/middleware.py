@@ -0,0 +1,101 @@
+# Costo por petición del manejo de errores: compara el middleware anterior
+# (@app.middleware("http") con traceback.format_exc() y el traceback en la respuesta)
+# contra app.errors.ErrorMiddleware (ASGI puro, logs limitados y traceback muestreado).
+#
+# Llama a la aplicación ASGI directamente, sin httpx ni red, para que la diferencia no
+# quede tapada por el cliente:
+#
+#   python -m bench.middleware
+#   python -m bench.middleware --requests 20000
+import argparse
+import asyncio
+import logging
+import time
+import traceback
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from app.errors import ErrorMiddleware, ErrorLogLimiter
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Overhead del middleware de errores")
+    parser.add_argument("--requests", type=int, default=5000, help="Peticiones por variante y camino")
+    return parser.parse_args(argv)
+
+
+def build_app(variant: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/ok")
+    async def ok():
+        return {"status": "ok"}
+
+    @app.get("/boom")
+    async def boom():
+        raise RuntimeError("falla simulada")
+
+    if variant == "legacy":
+        # Copia del catch_exceptions_middleware que tenía app/main.py
+        @app.middleware("http")
+        async def catch_exceptions_middleware(request: Request, call_next):
+            try:
+                return await call_next(request)
+            except Exception as e:
+                error_trace = traceback.format_exc()
+                logging.getLogger("bench").error(f"Unhandled error: {e}")
+                logging.getLogger("bench").error(f"Traceback: {error_trace}")
+                return JSONResponse(status_code=500,
+                                    content={"detail": "Internal Server Error", "error": str(e), "trace": error_trace})
+    elif variant == "asgi":
+        app.add_middleware(ErrorMiddleware, details=False, limiter=ErrorLogLimiter())
+    return app
+
+
+async def request(app, path: str) -> tuple:
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+             "root_path": "", "headers": [(b"host", b"bench")], "client": ("127.0.0.1", 1), "server": ("bench", 80)}
+    status, size = None, 0
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status, size
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            size += len(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return status, size
+
+
+async def measure(app, path: str, total: int) -> dict:
+    # Calentamiento: arma el stack de middlewares y las rutas
+    for _ in range(50):
+        await request(app, path)
+    start = time.perf_counter()
+    for _ in range(total):
+        status, size = await request(app, path)
+    elapsed = time.perf_counter() - start
+    return {"status": status, "us_per_request": round(elapsed / total * 1e6, 1), "bytes": size}
+
+
+async def main(args):
+    # Los logs van a un handler nulo: se mide el formateo, no la escritura en consola
+    logging.basicConfig(handlers=[logging.NullHandler()], level=logging.ERROR, force=True)
+    print(f"{'variante':<10}{'camino':<8}{'status':>8}{'us/req':>10}{'bytes':>8}")
+    for variant in ("none", "legacy", "asgi"):
+        app = build_app(variant)
+        # Sin middleware propio Starlette responde 500 pero vuelve a lanzar la excepción
+        paths = ("/ok",) if variant == "none" else ("/ok", "/boom")
+        for path in paths:
+            result = await measure(app, path, args.requests)
+            print(f"{variant:<10}{path:<8}{result['status']:>8}{result['us_per_request']:>10}{result['bytes']:>8}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
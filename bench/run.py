@@ -0,0 +1,265 @@
+# Benchmarks de la API /api/v1 y de los caminos que llaman a AFIP.
+#
+# Levanta la aplicación en el mismo proceso (ASGI, sin red) contra una base SQLite
+# temporal o la base indicada con --database-url, y reemplaza app.afipsdk.com por el
+# servidor local de bench/fake_afip.py. Para cada escenario informa req/s, latencias
+# p50/p95/p99 y consultas a la base por petición (header X-DB-Queries; en las respuestas
+# en streaming el header sale antes de leer las filas, así que no las incluye).
+#
+#   python -m bench.run
+#   python -m bench.run --scenarios invoices,cae --requests 500 --concurrency 32
+#   python -m bench.run --afip-latency 200 --afip-error-rate 0.05
+#   python -m bench.run --json resultados.json --baseline main.json --max-regression 0.2
+#
+# Con --database-url se usa una base existente (se crean las tablas que falten y los
+# datos del benchmark llevan un sufijo propio); no usar la base de producción.
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+SCENARIOS = ["users", "clients", "invoices", "items", "cae", "authorizations", "reads", "exports"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de la API de facturación")
+    parser.add_argument("--database-url", help="URL de la base (por defecto una SQLite temporal)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Escenarios separados por coma ({', '.join(SCENARIOS)})")
+    parser.add_argument("--requests", type=int, default=200, help="Peticiones por escenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="Peticiones simultáneas")
+    parser.add_argument("--afip-latency", type=float, default=50, help="Latencia media de AFIP (ms)")
+    parser.add_argument("--afip-jitter", type=float, default=10, help="Desvío de la latencia de AFIP (ms)")
+    parser.add_argument("--afip-error-rate", type=float, default=0.0, help="Fracción de llamadas a AFIP que fallan con 503")
+    parser.add_argument("--json", help="Guardar los resultados en este archivo")
+    parser.add_argument("--baseline", help="Resultados anteriores (--json) contra los que comparar")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Empeoramiento tolerado de p95 y req/s respecto de --baseline")
+    return parser.parse_args(argv)
+
+
+class Result:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.queries = []
+        self.errors = 0
+        self.statuses = {}
+        self.elapsed = 0.0
+
+    def summary(self) -> dict:
+        latencies = sorted(self.latencies)
+        if len(latencies) >= 2:
+            cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+            p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+        else:
+            p50 = p95 = p99 = latencies[0] if latencies else 0.0
+        return {
+            "requests": len(latencies),
+            "errors": self.errors,
+            "statuses": self.statuses,
+            "req_per_s": round(len(latencies) / self.elapsed, 1) if self.elapsed else 0.0,
+            "p50_ms": round(p50 * 1000, 2),
+            "p95_ms": round(p95 * 1000, 2),
+            "p99_ms": round(p99 * 1000, 2),
+            "db_queries_avg": round(statistics.fmean(self.queries), 2) if self.queries else None,
+        }
+
+
+async def run_scenario(name: str, make_request, total: int, concurrency: int) -> Result:
+    # make_request(i) devuelve la corrutina de la petición i (una respuesta de httpx)
+    result = Result(name)
+    indexes = iter(range(total))
+
+    async def worker():
+        for i in indexes:
+            start = time.perf_counter()
+            try:
+                response = await make_request(i)
+            except Exception:
+                result.latencies.append(time.perf_counter() - start)
+                result.errors += 1
+                result.statuses["exception"] = result.statuses.get("exception", 0) + 1
+                continue
+            result.latencies.append(time.perf_counter() - start)
+            result.statuses[response.status_code] = result.statuses.get(response.status_code, 0) + 1
+            if response.status_code >= 400:
+                result.errors += 1
+            queries = response.headers.get("x-db-queries")
+            if queries is not None:
+                result.queries.append(int(queries))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, total))))
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def print_table(results: list):
+    header = f"{'escenario':<16}{'reqs':>7}{'err':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, summary in results:
+        queries = summary["db_queries_avg"]
+        print(f"{name:<16}{summary['requests']:>7}{summary['errors']:>6}{summary['req_per_s']:>9}"
+              f"{summary['p50_ms']:>10}{summary['p95_ms']:>10}{summary['p99_ms']:>10}"
+              f"{queries if queries is not None else '-':>9}")
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list:
+    regressions = []
+    for name, summary in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if before["p95_ms"] and summary["p95_ms"] > before["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{name}: p95 {before['p95_ms']} -> {summary['p95_ms']} ms")
+        if before["req_per_s"] and summary["req_per_s"] < before["req_per_s"] * (1 - max_regression):
+            regressions.append(f"{name}: req/s {before['req_per_s']} -> {summary['req_per_s']}")
+    return regressions
+
+
+async def main(args) -> int:
+    # La aplicación lee la configuración al importarse: primero el entorno
+    from bench.fake_afip import FakeAfipServer, install
+
+    afip_server = FakeAfipServer(latency=args.afip_latency / 1000, jitter=args.afip_jitter / 1000,
+                                 error_rate=args.afip_error_rate).start()
+    install(afip_server)
+
+    import httpx
+    from app.main import app
+    from app.database import engine, Base
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    run_id = int(time.time()) % 100000
+    n = args.requests
+    results = []
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench/api/v1", timeout=120) as client:
+            # Emisor con certificado para los escenarios que necesitan AFIP
+            response = await client.post("/users/", json={
+                "username": f"bench-{run_id}", "email": f"bench-{run_id}@example.com",
+                "cuit": f"20{run_id:08d}1"[:11], "password_hash": "bench"})
+            response.raise_for_status()
+            owner = response.json()
+            user_id, cuit = owner["user_id"], owner["cuit"]
+            (await client.post("/certificates/", json={"user_id": user_id})).raise_for_status()
+            response = await client.post("/clients/", json={"user_id": user_id, "name": "Cliente bench",
+                                                            "cuit": "30712345678"})
+            response.raise_for_status()
+            client_id = response.json()["client_id"]
+            today = time.strftime("%Y-%m-%dT00:00:00")
+            period = int(time.strftime("%Y%m"))
+            invoice_ids = []
+
+            def invoice_body(i: int, items: int = 3) -> dict:
+                return {"user_id": user_id, "client_id": client_id, "invoice_type": "A", "point_of_sale": 1,
+                        "date": today, "items": [{"description": f"Item {i}-{j}", "quantity": 1 + j,
+                                                  "unit_price": 100 + i % 50, "tax_rate": 21}
+                                                 for j in range(items)]}
+
+            async def users(i):
+                return await client.post("/users/", json={
+                    "username": f"bench-{run_id}-{i}", "email": f"bench-{run_id}-{i}@example.com",
+                    "cuit": f"27{i:09d}"[:11], "password_hash": "bench"})
+
+            async def clients(i):
+                return await client.post("/clients/", json={"user_id": user_id, "name": f"Cliente {i}",
+                                                            "cuit": f"30{i:09d}"[:11]})
+
+            async def invoices(i):
+                response = await client.post("/invoices/", json=invoice_body(i))
+                if response.status_code == 200:
+                    invoice_ids.append(response.json()["invoice_id"])
+                return response
+
+            async def items(i):
+                # Muchos ítems repartidos en pocas facturas
+                return await client.post("/invoice-items/", json={
+                    "invoice_id": invoice_ids[i % min(len(invoice_ids), 10)], "description": f"Item {i}",
+                    "quantity": 2, "unit_price": 50, "total_price": 100, "tax_rate": 21, "tax_amount": 21})
+
+            cae_batches = []
+
+            async def cae(i):
+                return await client.post("/invoices/cae", json={"invoice_ids": cae_batches[i]})
+
+            async def authorizations(i):
+                # Tormenta de autorizaciones: servicios nuevos, todos a la vez, mismo certificado
+                return await client.post("/authorizations/", json={"user_id": user_id,
+                                                                   "service": f"bench_ws_{run_id}_{i}"})
+
+            async def reads(i):
+                return await client.get("/invoices/", params={"user_id": user_id, "limit": 50})
+
+            async def exports(i):
+                export_format = ("csv", "ndjson", "libro_iva")[i % 3]
+                return await client.get("/invoices/export", params={"cuit": cuit, "period": period,
+                                                                    "format": export_format})
+
+            scenarios = {"users": (users, n), "clients": (clients, n), "invoices": (invoices, n),
+                         "items": (items, n), "cae": (cae, None), "authorizations": (authorizations, n),
+                         "reads": (reads, n), "exports": (exports, max(n // 10, 3))}
+            wanted = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+            unknown = [name for name in wanted if name not in scenarios]
+            if unknown:
+                print(f"Escenarios desconocidos: {', '.join(unknown)}", file=sys.stderr)
+                return 2
+
+            if any(name in wanted for name in ("items", "cae", "reads", "exports")) and "invoices" not in wanted:
+                # Los demás escenarios necesitan facturas
+                for i in range(n):
+                    await invoices(i)
+
+            for name in wanted:
+                make_request, total = scenarios[name]
+                if name == "cae":
+                    # Lotes de 10 facturas; cada uno viaja en un solo FECAESolicitar
+                    drafts = list(invoice_ids)
+                    cae_batches[:] = [drafts[start:start + 10] for start in range(0, len(drafts), 10)]
+                    total = len(cae_batches)
+                result = await run_scenario(name, make_request, total, args.concurrency)
+                results.append((name, result.summary()))
+
+    await engine.dispose()
+    afip_server.stop()
+
+    print_table(results)
+    print(f"\nAFIP simulado: {afip_server.state.requests} llamadas, {afip_server.state.errors} errores inyectados")
+
+    summaries = dict(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summaries, f, indent=2, default=str)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(summaries, json.load(f), args.max_regression)
+        if regressions:
+            print("\nRegresiones respecto de la línea base:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{tempfile.mkdtemp(prefix='afip-bench-')}/bench.db"
+    # Cantidad de consultas por petición en el header X-DB-Queries
+    os.environ["DB_QUERY_HEADER"] = "true"
+    sys.exit(asyncio.run(main(args)))
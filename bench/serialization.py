@@ -0,0 +1,132 @@
+# Costo de armar la respuesta de los listados y de la exportación NDJSON: compara el
+# camino anterior (select de objetos ORM, model_validate en el router, la segunda
+# validación de response_model y JSONResponse) con app.serialization (select por
+# columnas, dict con los campos del schema y el encoder propio).
+#
+# Usa una base SQLite temporal con facturas de prueba y llama a las funciones de FastAPI
+# que arman la respuesta, sin HTTP, para aislar la serialización:
+#
+#   python -m bench.serialization
+#   python -m bench.serialization --rows 500 --rounds 200
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serialización de listados y exportaciones")
+    parser.add_argument("--rows", type=int, default=50, help="Filas por página de listado")
+    parser.add_argument("--rounds", type=int, default=300, help="Repeticiones por variante")
+    parser.add_argument("--items", type=int, default=3, help="Ítems por factura en la exportación")
+    return parser.parse_args(argv)
+
+
+async def timed(fn, rounds: int) -> dict:
+    for _ in range(5):
+        await fn()
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        size = await fn()
+        samples.append(time.perf_counter() - start)
+    return {"p50_us": round(statistics.median(samples) * 1e6, 1),
+            "mean_us": round(statistics.fmean(samples) * 1e6, 1), "bytes": size}
+
+
+async def main(args) -> int:
+    from datetime import datetime
+    from decimal import Decimal
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_model_field
+    from app.database import engine, async_session, Base
+    from app import crud, models, schemas, serialization
+    from app.services import exports
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with async_session() as db:
+        db.add(models.User(username="bench", email="bench@example.com", cuit="20111111112", password_hash="x"))
+        await db.flush()
+        db.add(models.Client(user_id=1, name="Cliente bench", cuit="30712345678"))
+        await db.flush()
+        for i in range(args.rows):
+            total = Decimal(100 + i) + Decimal("0.21")
+            invoice = models.Invoice(user_id=1, client_id=1, invoice_type="A", point_of_sale=1,
+                                     date=datetime(2026, 10, 1 + i % 28), total_amount=total,
+                                     net_amount=(total / Decimal("1.21")).quantize(Decimal("0.01")),
+                                     tax_amount=Decimal("21.00"), status="authorized", cae=f"7{i:013d}")
+            db.add(invoice)
+            await db.flush()
+            for j in range(args.items):
+                db.add(models.InvoiceItem(invoice_id=invoice.invoice_id, description=f"Item {i}-{j}", quantity=1,
+                                          unit_price=Decimal("100.00"), total_price=Decimal("100.00"),
+                                          tax_rate=Decimal("21.00"), tax_amount=Decimal("21.00")))
+        await db.commit()
+
+    page_field = create_model_field("response", schemas.InvoicePage, mode="serialization")
+
+    async def list_before():
+        # Como era el router: objetos ORM, model_validate y después response_model
+        async with async_session() as db:
+            rows, next_cursor = await crud.list_invoices(db, user_id=1, limit=args.rows)
+            content = schemas.InvoicePage(items=[schemas.Invoice.model_validate(row) for row in rows],
+                                          next_cursor=next_cursor)
+            content = await serialize_response(field=page_field, response_content=content)
+            return len(JSONResponse(content).body)
+
+    async def list_after():
+        async with async_session() as db:
+            rows, next_cursor = await crud.list_invoices(
+                db, user_id=1, limit=args.rows, fields=serialization.columns(models.Invoice, schemas.Invoice))
+            return len(serialization.page_response(schemas.Invoice, rows, next_cursor).body)
+
+    def ndjson_before(invoice) -> str:
+        def value(v):
+            if isinstance(v, Decimal):
+                return str(v)
+            if isinstance(v, datetime):
+                return v.isoformat()
+            return v
+        row = invoice["row"]
+        data = {c.key: value(getattr(row, c.key)) for c in exports.INVOICE_COLUMNS + exports.CLIENT_COLUMNS}
+        data["items"] = [{c.key: value(getattr(item, c.key)) for c in exports.ITEM_COLUMNS} for item in invoice["items"]]
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    stmt = exports.export_query("20111111112", 202610)
+
+    def export(render):
+        async def run():
+            size = 0
+            async for invoice in exports._invoices(stmt):
+                size += len(render(invoice).encode())
+            return size
+        return run
+
+    results = {
+        "list before": await timed(list_before, args.rounds),
+        "list after": await timed(list_after, args.rounds),
+        "ndjson before": await timed(export(ndjson_before), args.rounds),
+        "ndjson after": await timed(export(exports._ndjson), args.rounds),
+    }
+    await engine.dispose()
+
+    print(f"{args.rows} facturas por página, {args.items} ítems por factura en la exportación\n")
+    print(f"{'variante':<16}{'p50 us':>10}{'media us':>10}{'bytes':>9}")
+    for name, result in results.items():
+        print(f"{name:<16}{result['p50_us']:>10}{result['mean_us']:>10}{result['bytes']:>9}")
+    for kind in ("list", "ndjson"):
+        before, after = results[f"{kind} before"]["p50_us"], results[f"{kind} after"]["p50_us"]
+        print(f"\n{kind}: {before - after:.1f} us menos por petición ({(1 - after / before) * 100:.0f}%)", end="")
+    print()
+    return 0
+
+
+if __name__ == "__main__":
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{tempfile.mkdtemp(prefix='afip-bench-')}/bench.db"
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,71 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+# La aplicación lee DATABASE_URL al importarse: se usa una SQLite temporal
+_database = os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_database}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from app import models
+from app.cache import cache
+from app.database import engine, async_session, Base
+from app.services.afip_gateway import gateway
+from app.services.numbering import allocator
+from app.services.tickets import ticket_cache
+from datetime import datetime
+from decimal import Decimal
+
+
+# SDK de AFIP falso para el login: devuelve siempre el mismo ticket
+class FakeAfip:
+    def __init__(self, options: dict, tickets: dict = None):
+        self.options = options
+
+    def getServiceTA(self, service: str, force: bool = False) -> dict:
+        return {"token": "T", "sign": "S", "expiration": "2099-01-01T10:00:00.000-03:00"}
+
+
+@pytest.fixture
+def run(monkeypatch):
+    # Cada test arranca con la base vacía y sin estado en memoria de los singletons
+    monkeypatch.setattr("app.services.afip_gateway.Afip", FakeAfip)
+    monkeypatch.setattr("app.services.afip_gateway.TicketedAfip", FakeAfip)
+    for state in (cache.local._entries, allocator._blocks, allocator._locks, allocator._seed_locks,
+                  ticket_cache._tickets, ticket_cache._locks, gateway._breakers, gateway._limiters):
+        state.clear()
+
+    def execute(coro):
+        async def main():
+            try:
+                return await coro
+            finally:
+                await engine.dispose()
+        return asyncio.run(main())
+
+    async def reset():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+
+    execute(reset())
+    return execute
+
+
+async def seed(amounts=(121,), invoice_type="A", status="draft", emission_type="CAE"):
+    # Usuario 1 con certificado 1, cliente 1 y una factura por importe
+    async with async_session() as db:
+        db.add(models.User(username="u", email="u@example.com", cuit="20111111112", password_hash="secret"))
+        await db.flush()
+        db.add(models.Certificate(user_id=1, cert_alias="afipsdk", certificate="CERT", private_key="KEY"))
+        db.add(models.Client(user_id=1, name="c", cuit="20222222223"))
+        await db.flush()
+        for amount in amounts:
+            total = Decimal(amount)
+            net = (total / Decimal("1.21")).quantize(Decimal("0.01"))
+            db.add(models.Invoice(user_id=1, client_id=1, invoice_type=invoice_type, point_of_sale=1,
+                                  date=datetime(2026, 10, 1), total_amount=total, net_amount=net,
+                                  tax_amount=total - net, status=status, emission_type=emission_type))
+        await db.commit()
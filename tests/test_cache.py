@@ -0,0 +1,32 @@
+import json
+from app import crud
+from app.cache import cache, LocalBackend
+from app.database import async_session
+from tests.conftest import seed
+
+
+def test_shared_backend_has_no_secrets(run, monkeypatch):
+    run(seed([]))
+    monkeypatch.setattr(cache, "backend", LocalBackend())
+
+    async def fill():
+        async with async_session() as db:
+            await crud.get_user(db, 1)
+            await crud.get_certificate(db, 1)
+            await crud.get_latest_certificate(db, 1)
+
+    async def from_backend():
+        cache.local._entries.clear()
+        async with async_session() as db:
+            return await crud.get_latest_certificate(db, 1), await crud.get_user(db, 1)
+
+    run(fill())
+    for raw, _ in cache.backend._data.values():
+        text = raw.decode()
+        json.loads(text)
+        assert "KEY" not in text and "secret" not in text
+
+    certificate, user = run(from_backend())
+    assert certificate.private_key == "KEY"
+    assert certificate.user.password_hash == "secret"
+    assert user.password_hash == "secret"
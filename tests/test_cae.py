@@ -0,0 +1,85 @@
+from unittest import mock
+from sqlalchemy.future import select
+from app import models
+from app.database import async_session
+from app.services import cae, numbering
+from tests.conftest import seed
+
+
+# WSFE falso: autoriza los números correlativos y rechaza los importes desde 10000
+class FakeWsfe:
+    def __init__(self):
+        self.last = 0
+
+    def last_authorized(self, afip, point_of_sale, voucher_type):
+        return self.last
+
+    def request_caes(self, afip, point_of_sale, voucher_type, details):
+        responses = []
+        for detail in details:
+            number = detail["CbteDesde"]
+            if number == self.last + 1 and detail["ImpTotal"] < 10000:
+                self.last = number
+                responses.append({"CbteDesde": number, "Resultado": "A", "CAE": f"7{number:013d}",
+                                  "CAEFchVto": "20301231"})
+            else:
+                responses.append({"CbteDesde": number, "Resultado": "R",
+                                  "Observaciones": {"Obs": {"Code": 10048, "Msg": "Rechazado"}}})
+        return {"FeDetResp": {"FECAEDetResponse": responses}}
+
+
+def _patch(wsfe):
+    return (
+        mock.patch.object(cae, "_request_caes", wsfe.request_caes),
+        mock.patch.object(numbering, "last_authorized", wsfe.last_authorized),
+        mock.patch.object(cae, "AFIP_CAE_BATCH_SIZE", 2),
+    )
+
+
+async def _issue(invoice_ids):
+    async with async_session() as db:
+        return await cae.issue_invoices(db, invoice_ids)
+
+
+async def _statuses():
+    async with async_session() as db:
+        rows = (await db.execute(select(models.Invoice).order_by(models.Invoice.invoice_id))).scalars().all()
+        return {invoice.invoice_id: (invoice.status, invoice.cae) for invoice in rows}
+
+
+def test_reconcile_failure_keeps_authorized_results(run):
+    run(seed([121, 20000, 121, 121]))
+    wsfe = FakeWsfe()
+    request, last, batch = _patch(wsfe)
+    failing = mock.patch.object(numbering.allocator, "reconcile", side_effect=RuntimeError("db down"))
+    with request, last, batch, failing:
+        results = run(_issue([1, 2, 3, 4]))
+
+    by_id = {result["invoice_id"]: result for result in results}
+    assert by_id[1]["status"] == "authorized"
+    assert by_id[2]["status"] == "rejected"
+    statuses = run(_statuses())
+    assert statuses[1] == ("authorized", "70000000000001")
+    assert statuses[2][0] == "rejected"
+
+
+def test_allocate_failure_keeps_earlier_chunks(run):
+    run(seed([121, 121, 121, 121]))
+    wsfe = FakeWsfe()
+    request, last, batch = _patch(wsfe)
+    allocate = numbering.allocator.allocate
+    calls = []
+
+    async def flaky_allocate(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 2:
+            raise RuntimeError("db down")
+        return await allocate(*args, **kwargs)
+
+    with request, last, batch, mock.patch.object(numbering.allocator, "allocate", flaky_allocate):
+        results = run(_issue([1, 2, 3, 4]))
+
+    assert [result["status"] for result in sorted(results, key=lambda r: r["invoice_id"])] == \
+        ["authorized", "authorized", "error", "error"]
+    statuses = run(_statuses())
+    assert [statuses[i][0] for i in (1, 2, 3, 4)] == ["authorized", "authorized", "draft", "draft"]
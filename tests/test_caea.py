@@ -0,0 +1,70 @@
+from unittest import mock
+import pytest
+from sqlalchemy import update
+from sqlalchemy.future import select
+from app import models
+from app.database import async_session
+from app.services import caea
+from app.services.caea import CaeaScheduler
+from tests.conftest import seed
+
+
+async def _number(numbers):
+    async with async_session() as db:
+        for invoice_id, number in numbers.items():
+            await db.execute(update(models.Invoice).where(models.Invoice.invoice_id == invoice_id)
+                             .values(invoice_number=number, cae="12345678901234"))
+        await db.commit()
+
+
+async def _reports():
+    async with async_session() as db:
+        rows = (await db.execute(select(models.Invoice).order_by(models.Invoice.invoice_id))).scalars().all()
+        return {invoice.invoice_id: (invoice.caea_reported_at is not None, invoice.caea_report_error)
+                for invoice in rows}
+
+
+def test_report_skips_invoices_with_invalid_numbers(run):
+    run(seed([121, 121, 121, 121], status="authorized", emission_type="CAEA"))
+    run(_number({1: "2", 2: "abc", 3: None, 4: "1"}))
+    sent = []
+
+    def report(afip, point_of_sale, voucher_type, details):
+        sent.extend(detail["CbteDesde"] for detail in details)
+        return {"FeDetResp": {"FECAEADetResponse": [{"CbteDesde": detail["CbteDesde"], "Resultado": "A"}
+                                                    for detail in details]}}
+
+    with mock.patch.object(caea, "_report", report):
+        run(CaeaScheduler().report())
+
+    assert sent == [1, 2]
+    reports = run(_reports())
+    assert reports[1] == (True, None)
+    assert reports[4] == (True, None)
+    assert not reports[2][0] and "inválido" in reports[2][1]
+    assert not reports[3][0] and "inválido" in reports[3][1]
+
+
+class FakeBilling:
+    def __init__(self, error):
+        self.error = error
+        self.consulted = False
+
+    def createCAEA(self, period, fortnight):
+        raise self.error
+
+    def getCAEA(self, period, fortnight):
+        self.consulted = True
+        return {"CAEA": "1"}
+
+
+def test_request_caea_consults_only_when_already_granted():
+    billing = FakeBilling(Exception("(15008) Existe un CAEA otorgado para el periodo y orden"))
+    assert caea._request_caea(mock.Mock(ElectronicBilling=billing), 202610, 1) == {"CAEA": "1"}
+    assert billing.consulted
+
+    for error in (ConnectionResetError("Connection reset"), Exception('{"status": 503}')):
+        billing = FakeBilling(error)
+        with pytest.raises(type(error)):
+            caea._request_caea(mock.Mock(ElectronicBilling=billing), 202610, 1)
+        assert not billing.consulted
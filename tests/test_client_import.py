@@ -0,0 +1,43 @@
+from sqlalchemy.future import select
+from app import models
+from app.database import async_session
+from app.services import client_import
+from tests.conftest import seed
+
+
+async def _chunks(body: bytes, size: int = 7):
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+
+async def _import(body: bytes):
+    async with async_session() as db:
+        summary = await client_import.import_clients(db, 1, _chunks(body), "csv", enrich=False)
+    async with async_session() as db:
+        clients = (await db.execute(select(models.Client.cuit, models.Client.address)
+                                    .order_by(models.Client.cuit))).all()
+    return summary, clients
+
+
+def test_csv_quoted_newlines_and_stray_quotes(run):
+    run(seed([]))
+    body = ('name,cuit,address\n'
+            'Uno,20111111112,"Calle 1\nPiso 2"\n'
+            'Dos 5",20222222223,Calle 2\n'
+            'Tres,20333333334,Calle 3\n').encode()
+    summary, clients = run(_import(body))
+    assert summary["failed"] == 0 and summary["imported"] == 3
+    assert ("20111111112", "Calle 1\nPiso 2") in clients
+    assert ("20333333334", "Calle 3") in clients
+
+
+def test_csv_malformed_rows_are_import_errors(run):
+    run(seed([]))
+    body = ('name,cuit\n'
+            '"Uno" SA,20111111112\n'
+            'Dos,20222222223\n'
+            'Tres,"20333333334\n').encode()
+    summary, clients = run(_import(body))
+    assert summary["imported"] == 1
+    assert [error["line"] for error in summary["errors"]] == [2, 4]
+    assert all(error["error"].startswith("CSV inválido") for error in summary["errors"])
@@ -0,0 +1,67 @@
+import httpx
+from app.main import app
+from tests.conftest import seed
+
+
+async def _post_and_get(payload):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test/api/v1") as client:
+        created = await client.post("/invoices/", json=payload)
+        fetched = await client.get(f"/invoices/{created.json()['invoice_id']}")
+        return created, fetched
+
+
+def test_create_invoice_uses_the_same_wire_format_as_get(run):
+    run(seed([]))
+    payload = {"user_id": 1, "client_id": 1, "invoice_type": "A", "point_of_sale": 1,
+               "date": "2026-10-01T00:00:00",
+               "items": [{"description": "x", "quantity": 1, "unit_price": 100.5, "tax_rate": 21}]}
+    created, fetched = run(_post_and_get(payload))
+
+    assert created.status_code == 200, created.text
+    body = created.json()
+    assert created.text.count('"total_amount":121.61') == 1
+    for name, value in fetched.json().items():
+        assert body[name] == value
+    assert '"unit_price":100.50' in created.text
+
+
+async def _submit(payload, key):
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test/api/v1") as client:
+        return await client.post("/invoices/", params={"submit": "true"}, json=payload,
+                                 headers={"Idempotency-Key": key})
+
+
+async def _counts():
+    from sqlalchemy import func, select
+    from app import models
+    from app.database import async_session
+    async with async_session() as db:
+        invoices = (await db.execute(select(func.count()).select_from(models.Invoice))).scalar()
+        jobs = (await db.execute(select(func.count()).select_from(models.CaeJob))).scalar()
+        return invoices, jobs
+
+
+def test_submit_creates_invoice_and_job_together(run, monkeypatch):
+    from app import crud
+    from app.services.jobs import job_pool
+    monkeypatch.setattr(job_pool, "notify", lambda: None)
+    run(seed([]))
+    payload = {"user_id": 1, "client_id": 1, "invoice_type": "A", "point_of_sale": 1,
+               "date": "2026-10-01T00:00:00", "total_amount": 121, "net_amount": 100, "tax_amount": 21}
+
+    def broken_job(**values):
+        raise RuntimeError("cae_job unavailable")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(crud.models, "CaeJob", broken_job)
+        response = run(_submit(payload, "key-1"))
+    assert response.status_code == 500
+    assert run(_counts()) == (0, 0)
+
+    response = run(_submit(payload, "key-1"))
+    assert response.status_code == 202
+    assert response.json()["status"] == "pending"
+    assert response.headers["location"].startswith("/api/v1/cae-jobs/")
+    assert run(_counts()) == (1, 1)
@@ -0,0 +1,95 @@
+from datetime import datetime
+from sqlalchemy import text
+from decimal import Decimal
+import asyncio
+import pytest
+from app import crud, models, schemas
+from app.database import async_session, count_queries
+from tests.conftest import seed
+
+
+async def _counted(operation):
+    # Cada operación en su propia sesión, como en una petición
+    async with async_session() as db:
+        with count_queries() as counter:
+            result = await operation(db)
+    assert result is not None
+    return counter.count
+
+
+def _invoice():
+    return schemas.InvoiceCreate.model_construct(
+        user_id=1, client_id=1, invoice_number=None, invoice_type="A", point_of_sale=1, date=datetime(2026, 10, 1),
+        total_amount=Decimal("121"), net_amount=Decimal("100"), tax_amount=Decimal("21"), cae=None,
+        cae_expiration_date=None, status="draft", items=[],
+    )
+
+
+# Con RETURNING (SQLite >= 3.35, PostgreSQL) cada helper es una sola sentencia
+@pytest.mark.parametrize("model, pk, values", [
+    (models.Client, models.Client.client_id, {"user_id": 1, "name": "x"}),
+    (models.Certificate, models.Certificate.certificate_id, {"user_id": 1, "cert_alias": "a", "certificate": "C",
+                                                             "private_key": "K"}),
+    (models.Invoice, models.Invoice.invoice_id, {"user_id": 1, "client_id": 1, "invoice_type": "A",
+                                                 "point_of_sale": 1, "date": datetime(2026, 10, 1),
+                                                 "total_amount": Decimal("121")}),
+])
+def test_write_helpers_are_one_round_trip(run, model, pk, values):
+    run(seed([]))
+    saved = []
+
+    async def save(db):
+        saved.append(await crud._save(db, model(**values)))
+        return saved[-1]
+
+    assert run(_counted(save)) == 1
+    key = getattr(saved[0], pk.key)
+    changes = {"name": "y"} if model is models.Client else {"cert_alias": "b"} if model is models.Certificate \
+        else {"status": "pending"}
+    assert run(_counted(lambda db: crud._update(db, model, pk, key, {}))) == 1
+    assert run(_counted(lambda db: crud._update(db, model, pk, key, changes))) == 1
+    assert run(_counted(lambda db: crud._delete(db, model, pk, key))) == 1
+
+
+def test_client_round_trips(run):
+    run(seed([]))
+    assert run(_counted(lambda db: crud.create_client(db, schemas.ClientCreate(user_id=1, name="x")))) == 1
+    assert run(_counted(lambda db: crud.update_client(db, 2, schemas.ClientUpdate(name="y")))) == 1
+    assert run(_counted(lambda db: crud.delete_client(db, 2))) == 1
+
+
+def test_certificate_round_trips(run):
+    run(seed([]))
+    create = schemas.CertificateCreate(cert_alias="a", certificate="C", private_key="K")
+    assert run(_counted(lambda db: crud.create_certificate(db, create, 1))) == 1
+    assert run(_counted(lambda db: crud.update_certificate(db, 2, schemas.CertificateUpdate(cert_alias="b")))) == 1
+    # Autorizaciones y tickets del certificado + el certificado
+    assert run(_counted(lambda db: crud.delete_certificate(db, 2))) == 3
+
+
+def test_invoice_round_trips(run):
+    run(seed([]))
+    # CAEA vigente del usuario, upsert de los totales de ventas e INSERT de la factura
+    assert run(_counted(lambda db: crud.create_invoice(db, _invoice()))) == 3
+    # Factura e ítems actuales, upsert de los totales y UPDATE ... RETURNING
+    assert run(_counted(lambda db: crud.update_invoice(db, 1, schemas.InvoiceUpdate(total_amount=242)))) == 4
+    # Factura e ítems actuales, upsert de los totales, ítems, jobs y la factura
+    assert run(_counted(lambda db: crud.delete_invoice(db, 1))) == 6
+
+
+async def _after_failed_statement():
+    async with async_session() as db:
+        with pytest.raises(Exception):
+            await db.execute(text("SELECT * FROM missing_table"))
+        await asyncio.sleep(0.3)
+        with count_queries() as counter:
+            await db.execute(text("SELECT 1"))
+        connection = await db.connection()
+        return counter, connection.info
+
+
+def test_failed_statement_does_not_skew_next_latency(run):
+    counter, info = run(_after_failed_statement())
+    assert counter.count == 1
+    assert counter.duration < 0.3
+    assert not info.get("query_start")
@@ -0,0 +1,31 @@
+from unittest import mock
+import pytest
+from app.services import tickets
+
+TICKET = ("&lt;loginTicketResponse&gt;&lt;header&gt;&lt;expirationTime&gt;2099-01-01T10:00:00-03:00"
+          "&lt;/expirationTime&gt;&lt;/header&gt;&lt;credentials&gt;{credentials}&lt;/credentials&gt;"
+          "&lt;/loginTicketResponse&gt;")
+ENVELOPE = ('<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"><soapenv:Body>'
+            '<loginCmsResponse><loginCmsReturn>{ticket}</loginCmsReturn></loginCmsResponse>'
+            '</soapenv:Body></soapenv:Envelope>')
+
+
+def _connection(body: str, status: int = 200):
+    response = mock.Mock(status=status)
+    response.read.return_value = body.encode()
+    connection = mock.Mock()
+    connection.getresponse.return_value = response
+    return mock.patch.object(tickets.http.client, "HTTPSConnection", return_value=connection)
+
+
+def test_login_cms_parses_ticket():
+    credentials = "&lt;token&gt;TOK&lt;/token&gt;&lt;sign&gt;SIG&lt;/sign&gt;"
+    with _connection(ENVELOPE.format(ticket=TICKET.format(credentials=credentials))):
+        ticket = tickets._login_cms("https://wsaa.example/ws/services/LoginCms", "CMS")
+    assert ticket == {"token": "TOK", "sign": "SIG", "expiration": "2099-01-01T10:00:00-03:00"}
+
+
+def test_login_cms_rejects_incomplete_ticket():
+    with _connection(ENVELOPE.format(ticket=TICKET.format(credentials="&lt;token&gt;TOK&lt;/token&gt;"))):
+        with pytest.raises(Exception, match="falta sign"):
+            tickets._login_cms("https://wsaa.example/ws/services/LoginCms", "CMS")